@@ -5,6 +5,18 @@
 # output.txt is dependent on its results, then you can type make -f
 # Makefile-sbatch 'USER_SUPPLIED_DEP_IDS=123456' output.txt
 #
+# SCHEDULER_PACK_RUNTIME -- pack the targets of rules that are scheduled with
+# schedule_packed_with_deps_and_store_id in jobs of at most this many minutes
+# instead of submitting a job per target, e.g. the validation of every k. The
+# targets of a pack are made one after the other in one job. A pack is
+# submitted when the next target doesn't fit or belongs to another pack, when a
+# target outside the pack depends on it and by schedulerflush, which should be
+# the last goal. Empty to submit a job per target.
+#
+# SCHEDULER_PACK_WALLTIME_FACTOR -- the walltime of a pack is this integer
+# times the summed runtime of its targets, it is added to the options of the
+# first target of the pack.
+#
 # TODO:
 #
 # - Namespaces, automated prefixing everything could be an idea. Prevents
@@ -15,6 +27,8 @@
 ########################
 USER_SUPPLIED_DEP_IDS?=
 SCHEDULER?=sbatch
+SCHEDULER_PACK_RUNTIME?=
+SCHEDULER_PACK_WALLTIME_FACTOR?=2
 ########################
 #      /Parameters     #
 ########################
@@ -51,6 +65,9 @@ PBS_JOB_SCRIPT?=$(JOB_SCRIPT_DIRECTORY)/../bin/wrapper_jobscript.pbs
 # The dependencies of a target that don't exist yet.
 NON_EXISTENT_DEPS=$(filter-out $(wildcard $^),$^)
 
+# Walltime of the pack that is being submitted in minutes
+PACK_WALLTIME=$(shell expr $(SCHEDULER_PACK_WALLTIME_FACTOR) \* $(PACK_RUNTIME))
+
 ifeq ($(SCHEDULER),sbatch)
 ##### SBATCH
 # The entire sbatch command that is to be run, $1 are sbatch options, $2 the
@@ -64,6 +81,7 @@ endef
 define GET_JOB_ID_FROM_SUBMIT_RESULT
 $(lastword $1)
 endef
+PACK_WALLTIME_OPT=-t $(PACK_WALLTIME)
 ##### /SBATCH
 else
 ##### QSUB
@@ -78,6 +96,7 @@ endef
 define GET_JOB_ID_FROM_SUBMIT_RESULT
 $1
 endef
+PACK_WALLTIME_OPT=-l walltime=$(shell expr 60 \* $(PACK_WALLTIME))
 ##### /QSUB
 endif
 ##########################################
@@ -94,22 +113,76 @@ ifeq ($(DRY_RUN),)
 # DEP_IDS: Get jobids of all dependencies from the SBATCH_DEPENDENCIES list where jobs are stored like $dep1--jobid--$jobid1 $dep2--jobid--$jobid2 $depn--jobid--$jobidn
 # SBATCH_DEP_STRING: Create the dependencies option syntax needed for sbatch
 define schedule_with_deps_and_store_id
-$(eval DEP_IDS=$(foreach dep,$^,$(patsubst $(dep)--jobid--%,%,$(filter $(dep)--jobid--%,$(DEPENDENCIES)))))
+$(if $(filter $^,$(PACK_TARGETS)),$(call schedule_pack))
+$(eval DEP_IDS=$(sort $(foreach dep,$^,$(patsubst $(dep)--jobid--%,%,$(filter $(dep)--jobid--%,$(DEPENDENCIES))))))
 $(if $(or $(DEP_IDS),$(USER_SUPPLIED_DEP_IDS)),$(eval DEP_STRING=$(call CREATE_DEP_STRING,$(DEP_IDS) $(USER_SUPPLIED_DEP_IDS))),$(eval DEP_STRING=))
 @echo $(SCHEDULE_CMD)
 $(eval SUBMIT_RESULT=$(shell $(SCHEDULE_CMD) 2>&1))
 @echo $(SUBMIT_RESULT)
 $(eval DEPENDENCIES=$(DEPENDENCIES) $@--jobid--$(lastword $(SUBMIT_RESULT)))
 endef
+# Submit the targets in PACK_TARGETS in one job that runs PACK_CMD with all
+# targets, it depends on the jobs of the prerequisites of all targets
+define schedule_pack
+$(eval DEP_IDS:=$(sort $(foreach dep,$(PACK_DEPS),$(patsubst $(dep)--jobid--%,%,$(filter $(dep)--jobid--%,$(DEPENDENCIES))))))
+$(if $(or $(DEP_IDS),$(USER_SUPPLIED_DEP_IDS)),$(eval DEP_STRING=$(call CREATE_DEP_STRING,$(DEP_IDS) $(USER_SUPPLIED_DEP_IDS))),$(eval DEP_STRING=))
+@echo $(call SCHEDULE_CMD,$(PACK_OPT) $(PACK_WALLTIME_OPT),$(PACK_CMD) $(PACK_TARGETS))
+$(eval SUBMIT_RESULT=$(shell $(call SCHEDULE_CMD,$(PACK_OPT) $(PACK_WALLTIME_OPT),$(PACK_CMD) $(PACK_TARGETS)) 2>&1))
+@echo $(SUBMIT_RESULT)
+$(eval DEPENDENCIES=$(DEPENDENCIES) $(foreach t,$(PACK_TARGETS),$(t)--jobid--$(lastword $(SUBMIT_RESULT))))
+$(eval PACK_TARGETS:=)
+endef
 else
 # This is a dry run, echo command
 # SBATCH_DEP_STRING: jobids are not known in a jobrun, except the USER_SUPPLIED_DEP_IDS, so use filenames instead for the unknowns
 define schedule_with_deps_and_store_id
+$(if $(filter $^,$(PACK_TARGETS)),$(call schedule_pack))
 $(eval DEP_IDS=$(filter $^,$(DEPENDENCIES)))
 $(if $(or $(DEP_IDS),$(USER_SUPPLIED_DEP_IDS)),$(eval DEP_STRING=$(call CREATE_DEP_STRING,$(DEP_IDS) $(USER_SUPPLIED_DEP_IDS))),$(eval DEP_STRING=))
 $(SCHEDULE_CMD)
 $(eval DEPENDENCIES=$(DEPENDENCIES) $@)
 endef
+define schedule_pack
+$(eval DEP_IDS:=$(sort $(filter $(PACK_DEPS),$(DEPENDENCIES))))
+$(if $(or $(DEP_IDS),$(USER_SUPPLIED_DEP_IDS)),$(eval DEP_STRING=$(call CREATE_DEP_STRING,$(DEP_IDS) $(USER_SUPPLIED_DEP_IDS))),$(eval DEP_STRING=))
+$(call SCHEDULE_CMD,$(PACK_OPT) $(PACK_WALLTIME_OPT),$(PACK_CMD) $(PACK_TARGETS))
+$(eval DEPENDENCIES=$(DEPENDENCIES) $(PACK_TARGETS))
+$(eval PACK_TARGETS:=)
+endef
+endif
+
+# Call with $(call schedule_packed_with_deps_and_store_id,options,cmd,pack,minutes)
+# to add the target to pack, a name for targets that can share a job, with
+# its runtime in minutes. The job of the pack runs cmd followed by all its
+# targets, e.g. make -ke t1 t2, with the options of its first target. The pack
+# is submitted first if the target doesn't fit or belongs to another pack.
+# Targets may depend on targets in their own pack, make builds them in order.
+ifeq ($(SCHEDULER_PACK_RUNTIME),)
+define schedule_packed_with_deps_and_store_id
+$(call schedule_with_deps_and_store_id,$1,$2 $@)
+endef
+else
+define schedule_packed_with_deps_and_store_id
+$(if $(and $(PACK_TARGETS),$(or $(filter-out $3,$(PACK_NAME)),$(filter 1,$(shell expr $(PACK_RUNTIME) + $4 \> $(SCHEDULER_PACK_RUNTIME))))),$(call schedule_pack))
+$(if $(PACK_TARGETS),,$(eval PACK_NAME:=$$3)$(eval PACK_OPT:=$$1)$(eval PACK_CMD:=$$2)$(eval PACK_DEPS:=)$(eval PACK_RUNTIME:=0))
+$(eval PACK_TARGETS:=$(PACK_TARGETS) $@)
+$(eval PACK_DEPS:=$(PACK_DEPS) $^)
+$(eval PACK_RUNTIME:=$(shell expr $(PACK_RUNTIME) + $4))
+endef
+endif
+
+# Submits the targets that are still waiting in a pack. Use as recipe of the
+# targets that are goals, like all, or make schedulerflush the last goal.
+define schedule_pending_pack
+$(if $(PACK_TARGETS),$(call schedule_pack))
+endef
+# Keep the default goal of the including makefile
+ifndef SCHEDULER_DEFAULT_GOAL
+SCHEDULER_DEFAULT_GOAL:=$(.DEFAULT_GOAL)
+schedulerflush:
+	$(schedule_pending_pack)
+.DEFAULT_GOAL:=$(SCHEDULER_DEFAULT_GOAL)
+.PHONY: schedulerflush
 endif
 #########################################################
 #/The actual function that should be called by the user #
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Content addressed store of velvetg graphs, shared by the velvetg and
+meta-velvetg runs of metassemble.mk.
+
+velvetg builds a PreGraph from the Roadmaps of velveth and corrects it into a
+Graph, or a Graph2 with read tracking, before it applies the coverage cutoffs
+and scaffolding. When the Graph or Graph2 is already in its directory velvetg
+starts from it and doesn't read the PreGraph. The first velvetg run of a k
+therefore builds the graph in its own directory as usual, after which it is
+published: moved into the store and linked into the velveth directory and
+the run directory. The other runs of the k fetch it from the store. The
+velvet runs share the Graph, written by the velvetg -scaffolding no run, the
+meta-velvet runs the Graph2, written by the velvetg run of meta-velvetg
+-scaffolding no. A graph that is already stored, e.g. by another output
+directory of the same reads, is fetched by the first run as well.
+
+A graph is stored in STORE/KEY, where KEY is the md5 of the graph name and of
+the md5 digests of the full Sequences and Roadmaps it is built from, so a
+graph is never reused for other reads. The digest of a file is kept in
+FILE.md5 next to it and reused while the file is unchanged. The Sequences of
+every k link to those of KMIN, so they are hashed once for all k. The store
+files are read-only, so a velvetg that would write to a linked graph fails
+instead of changing the store.
+
+    fetch   Link a stored graph into a velvetg run directory before velvetg
+    publish Store the graph of a velvetg run and link it into the velveth
+            directory
+    evict   Remove a graph from the store once the assemblies that use it exist
+    digest  Write the digests of velveth output files for the store keys
+"""
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import tempfile
+import argparse
+
+# Bytes read at a time when hashing the inputs of a graph
+BLOCK_SIZE = 1024 * 1024
+
+# Files of the velvetg run that built a graph that are stored besides the
+# graph, Log has the velvetg command
+STORED_FILES = ["Log"]
+
+
+def graph_name(read_trkg):
+    """Returns the name of the velvetg graph with or without read tracking."""
+    return("Graph2" if read_trkg else "Graph")
+
+
+def file_digest(filename):
+    """Returns the md5 hex digest of the content of filename. The digest is
+    kept in .md5 next to the file filename links to and reused as long as the
+    size and mtime of that file are unchanged."""
+    real = os.path.realpath(filename)
+    st = os.stat(real)
+    stamp = "%i\t%r" % (st.st_size, st.st_mtime)
+    digest_file = real + ".md5"
+    if os.path.exists(digest_file):
+        cached = open(digest_file).read().rstrip("\n").rsplit("\t", 1)
+        if len(cached) == 2 and cached[0] == stamp:
+            return(cached[1])
+
+    md5 = hashlib.md5()
+    with open(real, "rb") as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b""):
+            md5.update(block)
+    digest = md5.hexdigest()
+    # Not keeping the digest only costs hashing again
+    try:
+        tmp = "%s.tmp.%i" % (digest_file, os.getpid())
+        with open(tmp, "w") as fh:
+            fh.write("%s\t%s\n" % (stamp, digest))
+        os.rename(tmp, digest_file)
+    except (IOError, OSError), e:
+        sys.stderr.write("Not keeping digest of %s: %s\n" % (real, e))
+    return(digest)
+
+
+def graph_key(velveth_dir, graph):
+    """Returns the store key of graph built from the Sequences and Roadmaps in
+    velveth_dir."""
+    md5 = hashlib.md5()
+    md5.update("velvetg %s\n" % graph)
+    for f in ["Sequences", "Roadmaps"]:
+        md5.update("%s\t%s\n" % (f, file_digest(os.path.join(velveth_dir,
+                                                               f))))
+    return(md5.hexdigest())
+
+
+def replace_link(source, link):
+    """Makes link a symbolic link to source."""
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(source, link)
+
+
+def fetch(store, velveth_dir, run_dir, read_trkg=False):
+    """Links the stored graph of velveth_dir into run_dir, so velvetg starts
+    from it. Returns the store directory of the graph or None if it isn't
+    stored, then velvetg builds it."""
+    graph = graph_name(read_trkg)
+    entry = os.path.join(store, graph_key(velveth_dir, graph))
+    link = os.path.join(run_dir, graph)
+
+    if not os.path.exists(os.path.join(entry, graph)):
+        # A link to an evicted graph would make velvetg write to the store
+        if os.path.islink(link):
+            os.remove(link)
+        return(None)
+    sys.stderr.write("Using stored %s %s\n" % (graph, entry))
+    replace_link(os.path.abspath(os.path.join(entry, graph)), link)
+    return(entry)
+
+
+def publish(store, velveth_dir, run_dir, read_trkg=False):
+    """Moves the graph that velvetg built in run_dir into store, unless it is
+    stored already, and links it into velveth_dir and run_dir. Returns the
+    store directory of the graph or None if run_dir has no graph of its own,
+    e.g. after it was evicted."""
+    graph = graph_name(read_trkg)
+    entry = os.path.join(store, graph_key(velveth_dir, graph))
+    run_graph = os.path.join(run_dir, graph)
+
+    if os.path.exists(os.path.join(entry, graph)):
+        sys.stderr.write("Using stored %s %s\n" % (graph, entry))
+    elif os.path.islink(run_graph) or not os.path.exists(run_graph):
+        sys.stderr.write("No %s built in %s to store, the next velvetg runs "
+                         "build it again\n" % (graph, run_dir))
+        return(None)
+    else:
+        if not os.path.isdir(store):
+            os.makedirs(store)
+        # Store in a temporary directory in the store and rename, so
+        # concurrent runs don't see half a graph
+        tmp = tempfile.mkdtemp(prefix="tmp-", dir=store)
+        try:
+            shutil.move(run_graph, os.path.join(tmp, graph))
+            for f in STORED_FILES:
+                if os.path.exists(os.path.join(run_dir, f)):
+                    shutil.copy(os.path.join(run_dir, f), tmp)
+            for f in os.listdir(tmp):
+                os.chmod(os.path.join(tmp, f), 0444)
+            try:
+                os.rename(tmp, entry)
+            except OSError, e:
+                # Stored by a concurrent run
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+        sys.stderr.write("Stored %s %s\n" % (graph, entry))
+
+    # Touch, the graph is newer than the Roadmaps it was reused for
+    os.utime(os.path.join(entry, graph), None)
+    for d in [run_dir, velveth_dir]:
+        replace_link(os.path.abspath(os.path.join(entry, graph)),
+                     os.path.join(d, graph))
+    return(entry)
+
+
+def evict(velveth_dir, read_trkg, done):
+    """Removes the graph linked into velveth_dir from the store if all files
+    in done exist, with its links in velveth_dir and in the directories of
+    done. Returns True if the graph was removed."""
+    graph = graph_name(read_trkg)
+    missing = [f for f in done if not os.path.exists(f)]
+    if len(missing) > 0:
+        sys.stderr.write("Keeping %s of %s for %s\n" % (graph, velveth_dir,
+                                                        " ".join(missing)))
+        return(False)
+
+    link = os.path.join(velveth_dir, graph)
+    if os.path.islink(link):
+        entry = os.path.dirname(os.path.realpath(link))
+        if os.path.exists(os.path.join(entry, graph)):
+            shutil.rmtree(entry)
+            sys.stderr.write("Evicted %s %s\n" % (graph, entry))
+    for d in [velveth_dir] + [os.path.dirname(f) for f in done]:
+        if os.path.islink(os.path.join(d, graph)):
+            os.remove(os.path.join(d, graph))
+    return(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+
+    for command, help in [("fetch", "Link the graph of VELVETH_DIR from "
+                           "STORE into RUN_DIR if it is stored"),
+                          ("publish", "Store the graph velvetg built in "
+                           "RUN_DIR and link it into VELVETH_DIR")]:
+        command_parser = subparsers.add_parser(command, help=help)
+        command_parser.add_argument("store", help="Store directory")
+        command_parser.add_argument("velveth_dir", help="velveth output "
+                                    "directory with Sequences and Roadmaps")
+        command_parser.add_argument("run_dir", help="Directory of the "
+                                    "velvetg run")
+        command_parser.add_argument("--read-trkg", action="store_true",
+                                    help="Graph2 with read tracking, as used "
+                                    "by meta-velvetg")
+
+    evict_parser = subparsers.add_parser("evict", help="Remove the graph "
+                                         "of VELVETH_DIR from the store if "
+                                         "the DONE files exist")
+    evict_parser.add_argument("velveth_dir", help="velveth output directory "
+                              "the graph is linked into")
+    evict_parser.add_argument("done", nargs="+", help="Assemblies made from "
+                              "the graph, their directories' links to the "
+                              "graph are removed as well")
+    evict_parser.add_argument("--read-trkg", action="store_true",
+                              help="Graph2 with read tracking")
+
+    digest_parser = subparsers.add_parser("digest", help="Write the digests "
+                                          "of FILES to FILE.md5")
+    digest_parser.add_argument("files", nargs="+", help="velveth output "
+                               "files, e.g. the Sequences shared by all k")
+    args = parser.parse_args()
+
+    if args.command == "fetch":
+        fetch(args.store, args.velveth_dir, args.run_dir, args.read_trkg)
+    elif args.command == "publish":
+        publish(args.store, args.velveth_dir, args.run_dir, args.read_trkg)
+    elif args.command == "evict":
+        evict(args.velveth_dir, args.read_trkg, args.done)
+    else:
+        for f in args.files:
+            file_digest(f)
+
+
+if __name__ == "__main__":
+    main()
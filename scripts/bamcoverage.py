@@ -0,0 +1,186 @@
+"""
+Mean coverage and percentage covered of every contig in a BAM file, computed
+in-process with pysam and NumPy instead of with BEDTools genomeCoverageBed.
+Used by gen_contig_cov_per_bam_table.py.
+
+The numbers are the same as the ones gen_contig_cov_per_bam_table.py derives
+from the genomeCoverageBed -ibam histogram. Like genomeCoverageBed every mapped
+read covers its reference span, from reference_start to reference_end and
+clipped to the contig length, so deletions and skipped regions count as
+covered. The coverage is not kept per base. The start and end of every read
+are the steps of a difference array, which is summed over the sorted steps to
+get runs of bases with the same depth, and the run lengths are added up per
+contig and depth to get the histogram. The fraction of bases at every depth is
+rounded the way genomeCoverageBed prints it, a single precision division
+printed with 6 significant digits, before the mean coverage is summed in order
+of depth, so the results are bit-identical to parsing the histogram.
+
+The BAM file has to be sorted by coordinate. The contigs are processed in
+batches of consecutive contigs to keep memory proportional to the number of
+reads in a batch.
+"""
+from array import array
+
+import numpy
+import pysam
+
+# Number of reads after which the contigs read so far are processed
+BATCH_READS = 1 << 20
+
+# Exact powers of ten to round the fractions with
+POW10 = numpy.array([float("1e%i" % i) for i in range(23)])
+
+
+def round_like_printf(values):
+    """Returns float("%g" % v) for every v in the array values of numbers in
+    (0, 1], i.e. v rounded to 6 significant digits like C++ streams print
+    it. Values too close to a rounding tie to decide in floating point are
+    rounded by printf."""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    exponents = numpy.clip(5 - numpy.floor(numpy.log10(values)).astype(int),
+                           0, len(POW10) - 1)
+    scales = POW10[exponents]
+    scaled = values * scales
+    digits = numpy.rint(scaled)
+    rounded = digits / scales
+    # The product has an error well below 1e-9, check the rest with printf
+    unsure = ((abs(abs(scaled - numpy.floor(scaled)) - 0.5) < 1e-6) |
+              (digits < 1e5) | (digits >= 1e6))
+    for i in numpy.flatnonzero(unsure).tolist():
+        rounded[i] = float("%g" % values[i])
+
+    return(rounded)
+
+
+def sequential_sums(values, starts, lengths):
+    """Returns the sum of values[s:s + l] for every s, l in starts, lengths,
+    added from left to right like a Python loop would. numpy.add.reduceat
+    uses pairwise summation, which can differ in the last bit."""
+    order = numpy.argsort(-lengths, kind="mergesort")
+    lengths, starts = lengths[order], starts[order]
+    sums = numpy.zeros(len(order))
+    for k in range(lengths[0] if len(lengths) > 0 else 0):
+        # Number of segments longer than k
+        n = numpy.searchsorted(-lengths, -k, side="left")
+        sums[:n] += values[starts[:n] + k]
+    out = numpy.empty_like(sums)
+    out[order] = sums
+
+    return(out)
+
+
+def batch_coverage(contig_lengths, tids, starts, ends):
+    """Returns arrays (cov_mean, percentage_covered) of a batch of contigs
+    with lengths contig_lengths, given the contig index (into the batch),
+    start and end of every read. Contigs without reads get cov_mean NaN and
+    fully covered contigs get percentage_covered NaN, because there are no
+    lines for those in the genomeCoverageBed histogram."""
+    nr_contigs = len(contig_lengths)
+    offsets = numpy.zeros(nr_contigs + 1, dtype=numpy.int64)
+    numpy.cumsum(contig_lengths, out=offsets[1:])
+
+    # Steps of +1 at the start and -1 at the end of every read, plus steps of
+    # 0 at the contig boundaries so no run crosses a contig
+    lengths = contig_lengths[tids]
+    read_starts = offsets[tids] + numpy.minimum(starts, lengths)
+    read_ends = offsets[tids] + numpy.minimum(ends, lengths)
+    positions, inverse = numpy.unique(
+        numpy.concatenate((read_starts, read_ends, offsets)),
+        return_inverse=True)
+    nr_reads = len(tids)
+    steps = numpy.bincount(inverse[:nr_reads], minlength=len(positions)) - \
+        numpy.bincount(inverse[nr_reads:2 * nr_reads],
+                       minlength=len(positions))
+    depths = numpy.cumsum(steps)[:-1]
+    run_lengths = numpy.diff(positions)
+    run_contigs = numpy.searchsorted(offsets, positions[:-1], side="right") - 1
+    keep = run_lengths > 0
+    depths, run_lengths, run_contigs = depths[keep], run_lengths[keep], \
+        run_contigs[keep]
+
+    # Histogram of bases per contig and depth, in order of contig and depth
+    order = numpy.lexsort((depths, run_contigs))
+    depths, run_lengths, run_contigs = depths[order], run_lengths[order], \
+        run_contigs[order]
+    first = numpy.flatnonzero(numpy.append(True,
+                                           (depths[1:] != depths[:-1]) |
+                                           (run_contigs[1:] !=
+                                            run_contigs[:-1])))
+    hist_depths, hist_contigs = depths[first], run_contigs[first]
+    hist_bases = numpy.add.reduceat(run_lengths, first)
+    fractions = round_like_printf(
+        hist_bases.astype(numpy.float32) /
+        contig_lengths[hist_contigs].astype(numpy.float32))
+
+    percentage_covered = numpy.empty(nr_contigs)
+    percentage_covered.fill(numpy.nan)
+    zero = hist_depths == 0
+    percentage_covered[hist_contigs[zero]] = 100 - fractions[zero] * 100.0
+
+    covered = ~zero
+    contribs = hist_depths[covered] * fractions[covered]
+    contigs = hist_contigs[covered]
+    counts = numpy.bincount(contigs, minlength=nr_contigs)
+    seg_starts = numpy.zeros(nr_contigs, dtype=numpy.int64)
+    numpy.cumsum(counts[:-1], out=seg_starts[1:])
+    cov_mean = sequential_sums(contribs, seg_starts, counts)
+    cov_mean[counts == 0] = numpy.nan
+
+    return(cov_mean, percentage_covered)
+
+
+def _int64_array(a):
+    """Returns array("l") a as an int64 NumPy array."""
+    if len(a) == 0:
+        return(numpy.zeros(0, dtype=numpy.int64))
+    return(numpy.frombuffer(a, dtype=numpy.int64))
+
+
+def bam_coverage(bamfile):
+    """Returns a tuple (contigs, cov_mean, percentage_covered) with the names
+    of the contigs in the header of bamfile and arrays with their mean
+    coverage and percentage covered. NaN marks a missing value, see
+    batch_coverage."""
+    bam = pysam.AlignmentFile(bamfile, "rb")
+    contig_lengths = numpy.array(bam.lengths, dtype=numpy.int64)
+    cov_mean = numpy.empty(len(contig_lengths))
+    percentage_covered = numpy.empty(len(contig_lengths))
+
+    def flush(first, last):
+        """Processes the contigs first up to last."""
+        if last > first:
+            cm, pc = batch_coverage(
+                contig_lengths[first:last],
+                _int64_array(tids) - first, _int64_array(starts),
+                _int64_array(ends))
+            cov_mean[first:last] = cm
+            percentage_covered[first:last] = pc
+        del tids[:], starts[:], ends[:]
+
+    tids, starts, ends = array("l"), array("l"), array("l")
+    add_tid, add_start, add_end = tids.append, starts.append, ends.append
+    first, current = 0, 0
+    try:
+        for read in bam:
+            # Mapped reads without CIGAR have no reference span
+            end = read.reference_end
+            if end is None or read.is_unmapped:
+                continue
+            tid = read.reference_id
+            if tid != current:
+                if tid < current:
+                    raise ValueError("%s is not sorted by coordinate" %
+                                     bamfile)
+                current = tid
+                if len(tids) >= BATCH_READS:
+                    flush(first, current)
+                    first = current
+            add_tid(tid)
+            add_start(read.reference_start)
+            add_end(end)
+        flush(first, len(contig_lengths))
+        contigs = list(bam.references)
+    finally:
+        bam.close()
+
+    return(contigs, cov_mean, percentage_covered)
@@ -0,0 +1,400 @@
+"""
+Length and GC content of every record in a FASTA file, computed with NumPy on
+large blocks of the file instead of per record in Python. Used by
+gc-content.py and gen_contig_cov_per_bam_table.py, and for the assembly
+statistics (N50 and other NX) of coords-stats.py.
+
+Every block is mapped to 0 and 1 bytes with a byte lookup table
+(str.translate), e.g. once for bases and once for G, C and S bases. The mapped
+block is viewed as 64-bit words, the eight bytes of every word are summed
+with one multiplication and the word sums are added up between the record
+boundaries with numpy.add.reduceat. The counts of a record are the difference
+between the resulting prefix counts at the end of the record and at the end
+of its header line. Lengths and GC counts are the same as
+len(seq) and the count used by Bio.SeqUtils.GC on the parsed sequence. Large
+files can be split on record boundaries and processed in a multiprocessing
+pool.
+
+The results are cached in a sidecar file next to the FASTA file (fastafile +
+".gc-len.tsv") and reused as long as the size, mtime and inode of the FASTA
+file are unchanged.
+"""
+import os
+import sys
+import multiprocessing
+
+import numpy
+
+from fastaio import read_blocks, BLOCK_SIZE, SEQ_WHITESPACE
+
+CACHE_SUFFIX = ".gc-len.tsv"
+CACHE_VERSION = 1
+
+# Byte lookup tables that map the bytes that count towards the length or
+# towards the GC content to 1 and all other bytes to 0
+BASE_TABLE = "".join("\x00" if chr(i) in SEQ_WHITESPACE else "\x01" for i in
+                     range(256))
+GC_TABLE = "".join("\x01" if chr(i) in "GCSgcs" else "\x00" for i in
+                   range(256))
+ACGT_TABLE = "".join("\x01" if chr(i) in "ACGTacgt" else "\x00" for i in
+                     range(256))
+
+# Multiplying a 64-bit word of 0 and 1 bytes by this sums the bytes in the
+# highest byte
+LANE_SUM = numpy.uint64(0x0101010101010101)
+
+
+def prefix_counts(values, positions):
+    """Returns the number of 1 bytes in values[:p] for every p in the sorted
+    array positions, where values is a string of 0 and 1 bytes."""
+    # Pad so every position, including len(values), is in a word
+    pad = "\x00" * (8 - len(values) % 8 + 8)
+    words = numpy.frombuffer(values + pad, dtype="<u8")
+    word_sums = (words * LANE_SUM) >> numpy.uint64(56)
+
+    # Sum the words before the word every position is in. reduceat gives the
+    # first element instead of 0 for empty segments.
+    q, r = numpy.divmod(positions, 8)
+    segments = numpy.append(0, q)
+    sums = numpy.add.reduceat(word_sums, segments)[:-1]
+    sums[segments[1:] == segments[:-1]] = 0
+    word_prefix = numpy.cumsum(sums).astype(numpy.int64)
+
+    # Add the bytes of the word a position is in that come before it
+    masks = numpy.left_shift(numpy.uint64(1), (8 * r).astype(numpy.uint64)) \
+        - numpy.uint64(1)
+    partial = ((words[q] & masks) * LANE_SUM) >> numpy.uint64(56)
+
+    return(word_prefix + partial.astype(numpy.int64))
+
+
+def block_stats(block, tables=(BASE_TABLE, GC_TABLE), full_headers=False):
+    """Returns (names, counts) of the records in block, where names are the
+    ids of the records, or their header lines without > with full_headers,
+    and counts has an array for every byte lookup table in tables with the
+    number of sequence bytes the table maps to 1. Bytes before the first
+    record header are skipped."""
+    if not block.endswith("\n"):
+        block += "\n"
+    arr = numpy.frombuffer(block, dtype=numpy.uint8)
+    # Headers start at the beginning of the block or after a line break
+    newlines = numpy.flatnonzero(arr == ord("\n"))
+    line_starts = numpy.append(0, newlines[:-1] + 1)
+    header_lines = numpy.flatnonzero(arr[line_starts] == ord(">"))
+    if len(header_lines) == 0:
+        return([], [numpy.zeros(0, dtype=numpy.int64) for t in tables])
+
+    # The sequence of a record runs from the end of its header line to the
+    # start of the next record
+    starts = line_starts[header_lines]
+    header_ends = newlines[header_lines]
+    ends = numpy.append(starts[1:], len(arr))
+    bounds = numpy.column_stack((header_ends + 1, ends)).ravel()
+
+    counts = []
+    for table in tables:
+        prefix = prefix_counts(block.translate(table), bounds)
+        counts.append(prefix[1::2] - prefix[0::2])
+
+    names = []
+    for s, e in zip(starts.tolist(), header_ends.tolist()):
+        if full_headers:
+            names.append(block[s + 1:e])
+        else:
+            words = block[s + 1:e].split(None, 1)
+            names.append(words[0] if len(words) > 0 else "")
+
+    return(names, counts)
+
+
+def _range_stats(args):
+    """Returns (names, counts) like block_stats of the records in the byte
+    range [start, end) of fastafile, which starts with a record header unless
+    start is 0."""
+    fastafile, start, end, tables, full_headers = args
+    names, counts = [], [[numpy.zeros(0, dtype=numpy.int64)] for t in tables]
+    with open(fastafile, "rb") as fh:
+        fh.seek(start)
+        for block in read_blocks(fh, BLOCK_SIZE, end - start):
+            n, c = block_stats(block, tables, full_headers)
+            names.extend(n)
+            for i, a in enumerate(c):
+                counts[i].append(a)
+
+    return(names, [numpy.concatenate(c) for c in counts])
+
+
+def split_points(fastafile, nr_parts):
+    """Returns the offsets of up to nr_parts + 1 record boundaries that split
+    fastafile in parts of about equal size, starting with 0 and ending with
+    the size of the file."""
+    size = os.path.getsize(fastafile)
+    points = [0]
+    with open(fastafile, "rb") as fh:
+        for k in range(1, nr_parts):
+            # Search for the first header at or after the even split
+            pos = max(k * size // nr_parts - 1, points[-1])
+            fh.seek(pos)
+            found = -1
+            while found == -1:
+                block = fh.read(1 << 20)
+                if not block:
+                    pos = size
+                    break
+                found = block.find("\n>")
+                if found == -1:
+                    # Keep the last byte in case it is the \n of a boundary
+                    pos += max(len(block) - 1, 1)
+                    fh.seek(pos)
+                else:
+                    pos += found + 1
+            if pos > points[-1] and pos < size:
+                points.append(pos)
+    points.append(size)
+
+    return(points)
+
+
+def fasta_file_key(fastafile):
+    """Returns the line identifying fastafile in its cache file."""
+    st = os.stat(fastafile)
+    return("#version=%i\tsize=%i\tmtime=%r\tinode=%i" %
+           (CACHE_VERSION, st.st_size, st.st_mtime, st.st_ino))
+
+
+def read_cache(fastafile, cachefile):
+    """Returns (ids, lengths, gc_counts) from cachefile or None if there is no
+    cache file or if it belongs to a different version of fastafile."""
+    try:
+        fh = open(cachefile)
+    except IOError:
+        return None
+    with fh:
+        if fh.readline().rstrip("\n") != fasta_file_key(fastafile):
+            return None
+        ids, lengths, gc_counts = [], [], []
+        for line in fh:
+            i, l, g = line.rstrip("\n").split("\t")
+            ids.append(i)
+            lengths.append(int(l))
+            gc_counts.append(int(g))
+
+    return(ids, numpy.array(lengths, dtype=numpy.int64),
+           numpy.array(gc_counts, dtype=numpy.int64))
+
+
+def write_cache(fastafile, cachefile, ids, lengths, gc_counts):
+    """Writes the results for fastafile to cachefile. The file is written to a
+    temporary file first and renamed, so readers never see a partial cache.
+    Nothing is cached if the directory is not writable."""
+    tmpfile = "%s.tmp.%i" % (cachefile, os.getpid())
+    try:
+        with open(tmpfile, "w") as fh:
+            fh.write(fasta_file_key(fastafile) + "\n")
+            fh.writelines("%s\t%i\t%i\n" % r for r in
+                          zip(ids, lengths.tolist(), gc_counts.tolist()))
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError), err:
+        sys.stderr.write("Not caching GC and length in %s: %s\n" %
+                         (cachefile, err))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def fasta_stats(fastafile, tables=(BASE_TABLE, GC_TABLE), full_headers=False,
+                processes=1):
+    """Returns (names, counts) like block_stats for all records in fastafile
+    in file order. With processes > 1 the file is split in parts that are
+    processed in parallel."""
+    if processes > 1:
+        points = split_points(fastafile, 4 * processes)
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_range_stats, [(fastafile, s, e, tables,
+                                             full_headers) for s, e in
+                                            zip(points[:-1], points[1:])])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        parts = [_range_stats((fastafile, 0, os.path.getsize(fastafile),
+                               tables, full_headers))]
+
+    names = [n for p in parts for n in p[0]]
+    counts = [numpy.concatenate([p[1][i] for p in parts]) for i in
+              range(len(tables))]
+
+    return(names, counts)
+
+
+def gc_and_lengths(fastafile, processes=1, cache=True):
+    """Returns a tuple (ids, lengths, gc_counts) with a list of the ids of the
+    records in fastafile in file order and NumPy arrays with their lengths and
+    numbers of G, C and S bases. With processes > 1 the file is split in
+    parts that are processed in parallel. With cache the results are read
+    from or written to the cache file next to fastafile."""
+    cachefile = fastafile + CACHE_SUFFIX
+    if cache:
+        cached = read_cache(fastafile, cachefile)
+        if cached is not None:
+            sys.stderr.write("GC and length cache hit: %s\n" % cachefile)
+            return(cached)
+
+    ids, (lengths, gc_counts) = fasta_stats(fastafile, processes=processes)
+    if cache:
+        write_cache(fastafile, cachefile, ids, lengths, gc_counts)
+
+    return(ids, lengths, gc_counts)
+
+
+def gc_percentages(lengths, gc_counts):
+    """Returns the GC percentages for arrays of lengths and GC counts, 0 for
+    records without bases like Bio.SeqUtils.GC."""
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        gc = gc_counts * 100.0 / lengths
+
+    return(numpy.where(lengths > 0, gc, 0.0))
+
+
+def nx_stats(lengths, nx=(50,)):
+    """Returns a dict with for every X in nx a tuple (length, index) of the
+    contig at which the contigs with lengths, sorted from long to short, first
+    add up to X percent of the total length (rounded down). length is the NX
+    statistic, e.g. N50, and index + 1 the LX, e.g. L50."""
+    if len(lengths) == 0:
+        return(dict())
+    lengths = numpy.sort(lengths)[::-1]
+    cumsum = numpy.cumsum(lengths)
+    out = dict()
+    for x in nx:
+        i = int(numpy.searchsorted(cumsum, int(cumsum[-1]) * x // 100))
+        out[x] = (int(lengths[i]), i)
+
+    return(out)
+
+
+def assembly_stats(fastafile, cut_off=100, nx=(50,), gc=False, processes=1,
+                   cache=True):
+    """Returns a dict with the statistics of the assembly in fastafile from a
+    single pass over the file. Contig lengths count the ACGT bases only, like
+    coords-stats.py always did. The dict has the header lines of the contigs
+    ("headers") and their lengths ("lengths"), and for the contigs of at
+    least cut_off bases their number ("nr_contigs"), total length
+    ("sum_bases"), maximum length ("max_length") and the nx_stats ("nx").
+    With gc, the same pass also counts the bases and G, C and S bases of
+    every contig ("seq_lengths", "gc_counts") like gc_and_lengths, which are
+    written to its cache file with cache."""
+    tables = (ACGT_TABLE, BASE_TABLE, GC_TABLE) if gc else (ACGT_TABLE,)
+    headers, counts = fasta_stats(fastafile, tables, True, processes)
+    lengths = counts[0]
+    kept = lengths[lengths >= cut_off]
+    if len(kept) == 0:
+        raise ValueError("No contigs of at least %i bases in %s" %
+                         (cut_off, fastafile))
+    stats = dict(headers=headers, lengths=lengths, nr_contigs=len(kept),
+                 sum_bases=int(kept.sum()), max_length=int(kept.max()),
+                 nx=nx_stats(kept, nx))
+
+    if gc:
+        stats["seq_lengths"], stats["gc_counts"] = counts[1], counts[2]
+        if cache:
+            ids = []
+            for h in headers:
+                words = h.split(None, 1)
+                ids.append(words[0] if len(words) > 0 else "")
+            write_cache(fastafile, fastafile + CACHE_SUFFIX, ids, counts[1],
+                        counts[2])
+
+    return(stats)
+
+
+def benchmark(fastafile, processes):
+    """Times gc_and_lengths without cache against fastaio.read_fasta with
+    fastaio.gc_content per record and checks that both give the same results.
+    Writes the timings to stdout."""
+    import time
+    from fastaio import read_fasta, gc_content
+
+    start_time = time.time()
+    ids, lengths, gc_counts = gc_and_lengths(fastafile, processes,
+                                             cache=False)
+    gc = gc_percentages(lengths, gc_counts).tolist()
+    numpy_time = time.time() - start_time
+
+    start_time = time.time()
+    expected = [(i, len(s), gc_content(s)) for i, s in read_fasta(fastafile)]
+    python_time = time.time() - start_time
+    assert expected == zip(ids, lengths.tolist(), gc), \
+        "Different results for %s" % fastafile
+    sys.stdout.write("%s\t%i records\tnumpy\t%.2fs\tpython\t%.2fs\tspeedup"
+                     "\t%.1fx\n" % (fastafile, len(ids), numpy_time,
+                                    python_time, python_time / numpy_time))
+
+
+def benchmark_assembly_stats(fastafile, processes, cut_off=100):
+    """Times assembly_stats against the line by line version of
+    asm_stats_fasta in coords-stats.py that it replaced and checks that both
+    give the same results. Writes the timings to stdout."""
+    import re
+    import time
+
+    def asm_stats_fasta_lines(fafile, cut_off=100):
+        name = None
+        all_contig_lengths = {}
+        for line in open(fafile):
+            if line[0] == '>':
+                name = line[1:-1]
+                all_contig_lengths[name] = 0
+            else:
+                all_contig_lengths[name] += len("".join(re.findall(
+                    "[ACGTacgt]+", line)))
+        sorted_contigs = sorted(filter(lambda x: x >= cut_off,
+                                       all_contig_lengths.values()),
+                                reverse=True)
+        cumsum = 0
+        totbases = sum(sorted_contigs)
+        max_length = sorted_contigs[0]
+        for i in range(len(sorted_contigs)):
+            cumsum += sorted_contigs[i]
+            if cumsum >= totbases / 2:
+                l50 = sorted_contigs[i]
+                n50 = i
+                break
+        return(l50, n50, totbases, max_length, len(sorted_contigs),
+               all_contig_lengths)
+
+    start_time = time.time()
+    stats = assembly_stats(fastafile, cut_off, processes=processes)
+    numpy_time = time.time() - start_time
+
+    start_time = time.time()
+    expected = asm_stats_fasta_lines(fastafile, cut_off)
+    python_time = time.time() - start_time
+    assert expected == stats["nx"][50] + (
+        stats["sum_bases"], stats["max_length"], stats["nr_contigs"],
+        dict(zip(stats["headers"], stats["lengths"].tolist()))), \
+        "Different results for %s" % fastafile
+    sys.stdout.write("%s\t%i contigs\tassembly_stats\t%.2fs\tlines\t%.2fs"
+                     "\tspeedup\t%.1fx\n" % (fastafile, len(stats["headers"]),
+                                             numpy_time, python_time,
+                                             python_time / numpy_time))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy GC and "
+                                     "length computation against a Python "
+                                     "loop over the records")
+    parser.add_argument("fastafiles", nargs="+", help="FASTA files")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of processes (default 1)")
+    parser.add_argument("--assembly-stats", action="store_true",
+                        help="Benchmark assembly_stats against the line by "
+                        "line asm_stats_fasta of coords-stats.py instead")
+    args = parser.parse_args()
+    for f in args.fastafiles:
+        if args.assembly_stats:
+            benchmark_assembly_stats(f, args.processes)
+        else:
+            benchmark(f, args.processes)
@@ -0,0 +1,231 @@
+"""
+Streaming FASTA and FASTQ readers for the metassemble scripts, without
+Biopython. Used by cut-up-fasta.py, reads-rename.py, gc-content.py and
+gen_contig_cov_per_bam_table.py instead of Bio.SeqIO.parse, which builds a
+SeqRecord and Seq object for every record.
+
+Records are yielded as (id, sequence) tuples of plain strings, where id is the
+first word of the header like SeqRecord.id and sequence has the line breaks
+removed. The FASTA file is read in large blocks that end on a record boundary
+and every block is split into records with string methods, so there is no
+per-line Python work. With use_mmap=True the file is memory-mapped and the
+records are sliced straight out of the map instead.
+
+The scripts import this module by adding the scripts directory to sys.path.
+"""
+import os
+import sys
+import mmap
+import gzip
+import subprocess
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+
+# Bytes read at a time. Blocks are extended to the next record boundary, so
+# records longer than a block are fine.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Characters removed from sequence lines
+SEQ_WHITESPACE = " \t\r\n"
+
+
+def _records(buf, start, size):
+    """Yields (id, sequence) of the records in buf[start:size], a string or
+    mmap with a record header at start. The sequence is sliced straight out
+    of buf and has its line breaks removed in one translate."""
+    while start < size:
+        end = buf.find("\n>", start, size)
+        end = size if end == -1 else end + 1
+        header_end = buf.find("\n", start, end)
+        if header_end == -1:
+            header_end = end
+        words = buf[start + 1:header_end].split(None, 1)
+        yield(words[0] if len(words) > 0 else "",
+              buf[header_end + 1:end].translate(None, SEQ_WHITESPACE))
+        start = end
+
+
+def read_blocks(fh, block_size=BLOCK_SIZE, size=None):
+    """Yields blocks of FASTA file fh that end right before the > of a record
+    header, except for the last one. If size is given, at most size bytes are
+    read from the current position of fh."""
+    pieces = []
+    while True:
+        if size is not None:
+            block = fh.read(min(block_size, size))
+            size -= len(block)
+        else:
+            block = fh.read(block_size)
+        if not block:
+            break
+        last = block.rfind("\n>")
+        if last == -1:
+            pieces.append(block)
+            continue
+        pieces.append(block[:last + 1])
+        yield "".join(pieces)
+        pieces = [block[last + 1:]]
+    tail = "".join(pieces)
+    if tail:
+        yield tail
+
+
+def _open(fastafile):
+    """Returns an open file for a filename or file object fastafile."""
+    if hasattr(fastafile, "read"):
+        return(fastafile)
+    return(open(fastafile, "rb"))
+
+
+@contextmanager
+def open_input(filename):
+    """Opens filename for reading in a with statement. Gzipped files (.gz) are
+    decompressed in a separate process by pigz, which decompresses in
+    parallel, or by gzip if pigz is not installed. An IOError is raised at
+    the end of the with block if decompression failed."""
+    if not filename.endswith(".gz"):
+        with open(filename, "rb") as fh:
+            yield fh
+        return
+
+    prog = find_executable("pigz") or find_executable("gzip")
+    if prog is None:
+        with gzip.open(filename, "rb") as fh:
+            yield fh
+        return
+
+    p = subprocess.Popen([prog, "-dc", filename], stdout=subprocess.PIPE,
+                         bufsize=BLOCK_SIZE)
+    try:
+        yield p.stdout
+    except:
+        p.stdout.close()
+        p.wait()
+        raise
+    p.stdout.close()
+    if p.wait() != 0:
+        raise IOError("%s failed to decompress %s" % (prog, filename))
+
+
+def read_fasta(fastafile, use_mmap=False, block_size=BLOCK_SIZE):
+    """Yields (id, sequence) of every record in fastafile, a filename or an
+    open file. Text before the first header is skipped like Bio.SeqIO does.
+    With use_mmap the file is memory-mapped instead of read in blocks, which
+    requires a regular file."""
+    if use_mmap:
+        for rec in _read_fasta_mmap(fastafile):
+            yield rec
+        return
+
+    fh = _open(fastafile)
+    first = True
+    for block in read_blocks(fh, block_size):
+        start = 0
+        if first:
+            # Skip anything before the first record
+            if not block.startswith(">"):
+                start = block.find("\n>")
+                if start == -1:
+                    continue
+                start += 1
+            first = False
+        # Every other block starts with the > of a record
+        for rec in _records(block, start, len(block)):
+            yield rec
+
+
+def _read_fasta_mmap(fastafile):
+    fh = _open(fastafile)
+    if os.fstat(fh.fileno()).st_size == 0:
+        return
+    mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        # Skip anything before the first record
+        if mm[0] == ">":
+            start = 0
+        else:
+            start = mm.find("\n>")
+            if start == -1:
+                return
+            start += 1
+        for rec in _records(mm, start, len(mm)):
+            yield rec
+    finally:
+        mm.close()
+
+
+def read_fastq(fastqfile, qualities=False):
+    """Yields (id, sequence) of every record in four line FASTQ file
+    fastqfile, a filename or an open file. With qualities (id, sequence,
+    qualities) is yielded."""
+    fh = _open(fastqfile)
+    for header in fh:
+        seq = next(fh, "")
+        plus = next(fh, "")
+        qual = next(fh, "")
+        if not header.startswith("@") or not plus.startswith("+"):
+            raise ValueError("Not a four line FASTQ record: %s" %
+                             header.rstrip())
+        words = header[1:].split(None, 1)
+        rec_id = words[0] if len(words) > 0 else ""
+        if qualities:
+            yield(rec_id, seq.rstrip(), qual.rstrip())
+        else:
+            yield(rec_id, seq.rstrip())
+
+
+def gc_content(seq):
+    """Returns the GC percentage of seq, like Bio.SeqUtils.GC."""
+    gc = sum(seq.count(x) for x in ["G", "C", "g", "c", "S", "s"])
+    try:
+        return gc * 100.0 / len(seq)
+    except ZeroDivisionError:
+        return 0.0
+
+
+def benchmark(fastafile, seqio=True):
+    """Times read_fasta with blocks and with mmap against Bio.SeqIO.parse on
+    fastafile and checks that they give the same ids and number of bases.
+    Writes the timings to stdout."""
+    import time
+    import hashlib
+
+    def run(records):
+        start_time = time.time()
+        md5 = hashlib.md5()
+        nr_bases = 0
+        for rec_id, seq in records:
+            md5.update(rec_id)
+            nr_bases += len(seq)
+        return(time.time() - start_time, nr_bases, md5.hexdigest())
+
+    timings = [("blocks", run(read_fasta(fastafile))),
+               ("mmap", run(read_fasta(fastafile, use_mmap=True)))]
+    if seqio:
+        from Bio import SeqIO
+        timings.append(("SeqIO", run((rec.id, rec.seq) for rec in
+                                     SeqIO.parse(fastafile, "fasta"))))
+    sys.stdout.write("%s\t%i bases" % (fastafile, timings[0][1][1]))
+    for name, (seconds, nr_bases, digest) in timings:
+        assert (nr_bases, digest) == timings[0][1][1:], \
+            "%s gives different records" % name
+        sys.stdout.write("\t%s\t%.2fs" % (name, seconds))
+    if seqio:
+        sys.stdout.write("\tspeedup\t%.1fx" % (timings[2][1][0] /
+                                                timings[0][1][0]))
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the streaming "
+                                     "FASTA reader against Bio.SeqIO")
+    parser.add_argument("fastafiles", nargs="+",
+                        help="FASTA files to read, e.g. a multi-GB contig "
+                        "file")
+    parser.add_argument("--no-seqio", action="store_true",
+                        help="Only time the streaming reader, e.g. when "
+                        "Biopython is not installed")
+    args = parser.parse_args()
+    for f in args.fastafiles:
+        benchmark(f, seqio=not args.no_seqio)
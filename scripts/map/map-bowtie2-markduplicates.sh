@@ -38,7 +38,7 @@ Output:
     <rname>_<qname>-smds.flagstat           - results form samtools flagstat on
                                               bam file, gives read mapping stats
 
-    If -c is specified (requires genomeCoverageBed and BioPython):
+    If -c is specified (requires genomeCoverageBed):
 
     <rname>_<qname>-smds.coverage           - result from running
                                               genomeCoverageBed -ibam on the
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Adaptive k-mer sweep. Instead of assembling every k of KMIN..KMAX with step
+STEPSIZE, a coarse grid of k is assembled first and then only the k around
+the best assemblies, halving the distance every round until it is STEPSIZE.
+
+The assemblies are made with make, the k is substituted for the % in the
+target pattern, e.g. out/assemblies/velvet/noscaf/noscaf_%/ma-contigs.fa.
+Every assembly is scored on the contigs of at least --cut-off bases with
+contigstats.assembly_stats, the statistics of asm_stats_fasta: N50, total
+bases and the longest contig. The score of an assembly is the mean of the
+three divided by their maximum over all assemblies of the sweep.
+
+Writes OUTDIR/ksweep.tsv with the statistics of every k and OUTDIR/ksweep.mk,
+which sets KNUMBERS to the assembled k and KMERGE to the k of the --top best
+assemblies, used by the minimus2 and newbler merges of metassemble.mk.
+"""
+import os
+import sys
+import shlex
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from contigstats import assembly_stats
+
+# Statistics of assembly_stats that are combined in the score
+PROXIES = ["n50", "sum_bases", "max_length"]
+
+
+def grid(kmin, kmax, step):
+    """Returns the k values of kmin..kmax with step, kmax included if the
+    step ends on it."""
+    return(range(kmin, kmax + 1, step))
+
+
+def refine_distances(coarse_step, step):
+    """Returns the distances to the best k of the refinement rounds, halved
+    every round and rounded down to a multiple of step, down to step."""
+    distances = []
+    d = coarse_step // 2
+    while d >= step:
+        d = d // step * step
+        if d not in distances:
+            distances.append(d)
+        d //= 2
+    return(distances)
+
+
+def proxies(fastafile, cut_off):
+    """Returns a dict with the PROXIES of the assembly in fastafile, or None
+    if it doesn't exist or has no contigs of at least cut_off bases."""
+    if not os.path.exists(fastafile):
+        return(None)
+    try:
+        stats = assembly_stats(fastafile, cut_off)
+    except ValueError:
+        return(None)
+    return(dict(n50=stats["nx"][50][0], sum_bases=stats["sum_bases"],
+                max_length=stats["max_length"]))
+
+
+def score(results):
+    """Adds the score to every dict of proxies in results, a dict by k.
+    Returns the k of the scored assemblies sorted from best to worst."""
+    scored = [k for k in results if results[k] is not None]
+    for p in PROXIES:
+        top = max([results[k][p] for k in scored] + [1])
+        for k in scored:
+            results[k]["score_" + p] = float(results[k][p]) / top
+    for k in scored:
+        results[k]["score"] = sum(results[k]["score_" + p]
+                                  for p in PROXIES) / len(PROXIES)
+    # Ties go to the smaller k, which needs less memory
+    return(sorted(scored, key=lambda k: (-results[k]["score"], k)))
+
+
+def assemble(make_cmd, pattern, ks, cut_off, results, rounds, rnd):
+    """Makes the assemblies of ks with make_cmd and adds their proxies to
+    results. A failed assembly is not scored but the sweep goes on."""
+    targets = [pattern.replace("%", str(k)) for k in ks]
+    sys.stderr.write("ksweep round %i: k %s\n" % (rnd, " ".join(str(k) for k
+                                                                 in ks)))
+    rc = subprocess.call(make_cmd + ["-k"] + targets)
+    if rc != 0:
+        sys.stderr.write("ksweep: %s exited with %i, continuing with the "
+                         "assemblies that were made\n" % (make_cmd[0], rc))
+    for k, target in zip(ks, targets):
+        results[k] = proxies(target, cut_off)
+        rounds[k] = rnd
+        if results[k] is None:
+            sys.stderr.write("ksweep: no assembly for k %i in %s\n" %
+                             (k, target))
+
+
+def sweep(pattern, kmin, kmax, step, coarse_step, refine, make_cmd,
+          cut_off=100):
+    """Returns the results of the sweep as a dict of proxies by k, a dict
+    with the round in which every k was assembled and the ranked k."""
+    results, rounds = {}, {}
+    coarse = grid(kmin, kmax, coarse_step)
+    # Include KMAX so the coarse grid covers the whole range
+    if coarse[-1] != kmax and (kmax - kmin) % step == 0:
+        coarse.append(kmax)
+    assemble(make_cmd, pattern, coarse, cut_off, results, rounds, 0)
+
+    valid = set(grid(kmin, kmax, step))
+    for rnd, d in enumerate(refine_distances(coarse_step, step), 1):
+        best = score(results)[:refine]
+        new = sorted(set(k + o for k in best for o in (-d, d)
+                         if k + o in valid and k + o not in results))
+        if len(new) > 0:
+            assemble(make_cmd, pattern, new, cut_off, results, rounds, rnd)
+
+    ranked = score(results)
+    if len(ranked) == 0:
+        raise ValueError("None of the assemblies of the sweep succeeded")
+    return(results, rounds, ranked)
+
+
+def write_results(outdir, results, rounds, ranked, top):
+    """Writes ksweep.tsv and ksweep.mk to outdir."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    with open(os.path.join(outdir, "ksweep.tsv"), "w") as fh:
+        fh.write("k\tround\trank\t%s\tscore\n" % "\t".join(PROXIES))
+        ranks = dict((k, i + 1) for i, k in enumerate(ranked))
+        for k in sorted(results):
+            if results[k] is None:
+                fh.write("%i\t%i\tNA\t%s\tNA\n" % (k, rounds[k],
+                                                   "\t".join(["NA"] *
+                                                             len(PROXIES))))
+            else:
+                fh.write("%i\t%i\t%i\t%s\t%.4f\n" % (
+                    k, rounds[k], ranks[k],
+                    "\t".join(str(results[k][p]) for p in PROXIES),
+                    results[k]["score"]))
+
+    # Written last and renamed, make only uses a complete sweep
+    mkfile = os.path.join(outdir, "ksweep.mk")
+    with open(mkfile + ".tmp", "w") as fh:
+        fh.write("# Written by metassemble-ksweep.py, k from best to worst "
+                 "assembly: %s\n" % " ".join(str(k) for k in ranked))
+        fh.write("KNUMBERS:=%s\n" % " ".join(str(k) for k in sorted(ranked)))
+        fh.write("KMERGE:=%s\n" % " ".join(str(k) for k in
+                                           sorted(ranked[:top])))
+    os.rename(mkfile + ".tmp", mkfile)
+
+
+def main(pattern, kmin, kmax, step, coarse_step, refine, top, outdir,
+         make_cmd, cut_off=100):
+    if "%" not in pattern:
+        raise ValueError("No %% for the k in target pattern %s" % pattern)
+    if step <= 0 or coarse_step < step or coarse_step % step != 0:
+        raise ValueError("Coarse step %i is not a multiple of step %i" %
+                         (coarse_step, step))
+    results, rounds, ranked = sweep(pattern, kmin, kmax, step, coarse_step,
+                                    refine, make_cmd, cut_off)
+    write_results(outdir, results, rounds, ranked, top)
+    sys.stderr.write("ksweep: assembled %i of %i k, best %s, merging %s\n" %
+                     (len(results), len(grid(kmin, kmax, step)),
+                      ranked[0], " ".join(str(k) for k in
+                                          sorted(ranked[:top]))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pattern", help="Assembly target of k %%, e.g. "
+                        "out/assemblies/velvet/noscaf/noscaf_%%/ma-contigs.fa")
+    parser.add_argument("--kmin", type=int, required=True, help="Smallest k")
+    parser.add_argument("--kmax", type=int, required=True, help="Largest k")
+    parser.add_argument("--step", type=int, default=2,
+                        help="Step between k of the full grid (default: 2)")
+    parser.add_argument("--coarse-step", type=int, default=8,
+                        help="Step between k of the coarse grid, a multiple "
+                        "of --step (default: 8)")
+    parser.add_argument("--refine", type=int, default=2,
+                        help="Number of best k refined around every round "
+                        "(default: 2)")
+    parser.add_argument("--top", type=int, default=5,
+                        help="Number of best k to merge (default: 5)")
+    parser.add_argument("--cut-off", type=int, default=100,
+                        help="Minimum contig length for the statistics "
+                        "(default: 100)")
+    parser.add_argument("--make", default="make",
+                        help="Command that makes the targets, e.g. "
+                        "\"make -j 4\" (default: make)")
+    parser.add_argument("-o", "--outdir", required=True,
+                        help="Output directory for ksweep.tsv and ksweep.mk")
+    args = parser.parse_args()
+    try:
+        main(args.pattern, args.kmin, args.kmax, args.step, args.coarse_step,
+             args.refine, args.top, args.outdir, shlex.split(args.make),
+             args.cut_off)
+    except ValueError, e:
+        sys.stderr.write("metassemble-ksweep.py: %s\n" % e)
+        sys.exit(2)
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+"""
+Runs targets of metassemble.mk on the local machine under a memory and CPU
+budget. make -j only limits the number of jobs, so the velvetg jobs of large k
+can run out of memory when they happen to run together. This script reads the
+parameters of the pipeline (parameters.mk and the Makefile that includes it)
+from make, builds the graph of the steps of the k-mer sweep and starts every
+step with make as soon as its prerequisites are done and its memory and CPUs
+fit in what is left of the budget. The recipes, target names and output
+layout are those of metassemble.mk, a step is run as make -f MAKEFILE target.
+
+The peak memory, CPU time and wall time of every step are appended to a
+history file. The resources of a step are estimated from earlier runs of the
+same step and k, interpolated between the nearest k of the same step if it
+was not run for k yet, and --default-mem and one CPU otherwise. Ready steps
+are started in order of the longest path of estimated wall time to the end of
+the graph.
+
+The targets are the rules of metassemble.mk, i.e. all, qtrim, velvet,
+metavelvet, ray, minimus2, newbler, velvetnoscafnewbler and bambus2, or
+output files of steps. Variables can be given like with make, e.g.:
+
+    metassemble-run.py -f Makefile --mem 120G --cpus 16 velvet KMAX=41
+
+The output of every step is written to a log file in OUT/metassemble-run/logs.
+Every recipe line is recorded with steplog.py in
+OUT/metassemble-run/steps-DATE.jsonl, see steplog.py report for the slowest.
+"""
+import argparse
+import os
+import re
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from steplog import rusage_fields
+
+# Variables of the Makefile the graph is built from
+MAKE_VARIABLES = ["OUT", "KMIN", "KNUMBERS", "KMERGE", "FASTQ_TRIM_IL",
+                  "CONTIG_FILENAME", "SCAF_FILENAME", "MERGE_FILENAME",
+                  "VELVETH_OUT", "VELVET_OUT_NOSCAF", "VELVET_OUT_SCAF",
+                  "METAVELVET_OUT_NOSCAF", "METAVELVET_OUT_SCAF", "RAY_OUT",
+                  "RAY_OUT_NOSCAF", "RAY_OUT_SCAF",
+                  "MINIMUS2_OUT_VELVET_NOSCAF",
+                  "MINIMUS2_OUT_METAVELVET_NOSCAF",
+                  "MINIMUS2_OUT_RAY_NOSCAF", "NEWBLER_OUT_VELVET_NOSCAF",
+                  "NEWBLER_OUT_METAVELVET_NOSCAF", "NEWBLER_OUT_RAY_NOSCAF"]
+
+# Rule appended to the Makefile to print the variables
+PRINT_VARIABLES_TARGET = "metassemble-run-print-variables"
+PRINT_VARIABLES_RULE = """
+%s:
+\t@:$(foreach v,%s,$(info metassemble-run:$(v)=$($(v))))
+"""
+
+# Estimated wall time of steps that never ran, only used to order the steps
+DEFAULT_WALL = 1.0
+
+SIZE_UNITS = {"K": 1, "M": 1024, "G": 1024 ** 2, "T": 1024 ** 3}
+
+
+class Task(object):
+    """A step of the pipeline that makes target."""
+    def __init__(self, target, step, k, deps):
+        self.target = target
+        self.step = step
+        self.k = k
+        self.deps = deps
+        self.dependents = []
+        for d in deps:
+            d.dependents.append(self)
+        self.mem = None
+        self.cpus = None
+        self.wall = None
+        self.source = None
+        self.rank = None
+
+
+def parse_size(size):
+    """Returns size, a number of megabytes or a number followed by K, M, G or
+    T, in kilobytes."""
+    m = re.match(r"^([0-9.]+)([KMGT]?)B?$", size.strip().upper())
+    if m is None:
+        raise ValueError("Invalid size: %s" % size)
+    return(int(float(m.group(1)) * SIZE_UNITS[m.group(2) or "M"]))
+
+
+def format_size(kb):
+    return("%.1fG" % (kb / 1024.0 ** 2))
+
+
+def total_memory():
+    """Returns MemTotal of /proc/meminfo in kilobytes."""
+    for line in open("/proc/meminfo"):
+        if line.startswith("MemTotal:"):
+            return(int(line.split()[1]))
+    raise ValueError("No MemTotal in /proc/meminfo")
+
+
+def read_make_variables(makefile, assignments):
+    """Returns a dictionary with the values of MAKE_VARIABLES in makefile,
+    with variables assigned on the command line like VAR=value."""
+    fd, rulefile = tempfile.mkstemp(prefix="metassemble-run.", suffix=".mk")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(PRINT_VARIABLES_RULE % (PRINT_VARIABLES_TARGET,
+                                             " ".join(MAKE_VARIABLES)))
+        p = subprocess.Popen(["make", "--no-print-directory", "-f", makefile,
+                              "-f", rulefile] + assignments +
+                             [PRINT_VARIABLES_TARGET], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out, err = p.communicate()
+    finally:
+        os.remove(rulefile)
+    if p.returncode != 0:
+        raise ValueError("Could not read the variables of %s:\n%s" %
+                         (makefile, err))
+    variables = {}
+    for line in out.splitlines():
+        if line.startswith("metassemble-run:"):
+            name, value = line[len("metassemble-run:"):].split("=", 1)
+            variables[name] = value.strip()
+
+    return(variables)
+
+
+def build_graph(v):
+    """Returns a dictionary with the tasks of all targets in the Makefile with
+    variables v by normalized target path and a dictionary with the tasks of the rules all,
+    velvet etc. by rule name."""
+    tasks = {}
+
+    def add(target, step, k, deps):
+        task = tasks[os.path.normpath(target)] = Task(target, step, k, deps)
+        return(task)
+
+    ks = [int(k) for k in v["KNUMBERS"].split()]
+    contigs, scaf, merge = v["CONTIG_FILENAME"], v["SCAF_FILENAME"], \
+        v["MERGE_FILENAME"]
+    qtrim = add(v["FASTQ_TRIM_IL"], "qtrim", None, [])
+    sequences = add("%s/velveth_%s/Sequences" % (v["VELVETH_OUT"], v["KMIN"]),
+                    "velveth-sequences", None, [qtrim])
+    # Shared by all Ray runs, made first so they don't link it at once
+    ray_pair = add("%s/pair.fastq" % v["RAY_OUT"], "ray-pair", None, [qtrim])
+    velvet_noscaf, velvet_scaf, metavelvet_noscaf, metavelvet_scaf, \
+        ray_noscaf, ray_scaf = [], [], [], [], [], []
+    for k in ks:
+        roadmaps = add("%s/velveth_%i/Roadmaps" % (v["VELVETH_OUT"], k),
+                       "velveth", k, [sequences])
+        # Graphs of the noscaf runs, shared with the scaf runs of k
+        velvet_noscaf.append(add("%s/noscaf_%i/%s" % (v["VELVET_OUT_NOSCAF"],
+                                                      k, contigs),
+                                 "velvetg-noscaf", k, [roadmaps]))
+        graph = add("%s/velveth_%i/Graph" % (v["VELVETH_OUT"], k),
+                    "velvetg-graph", k, [velvet_noscaf[-1]])
+        velvet_scaf.append(add("%s/scaf_%i/%s" % (v["VELVET_OUT_SCAF"], k,
+                                                  scaf),
+                               "velvetg-scaf", k, [graph]))
+        metavelvet_noscaf.append(add("%s/noscaf_%i/%s" %
+                                     (v["METAVELVET_OUT_NOSCAF"], k, contigs),
+                                     "metavelvetg-noscaf", k, [roadmaps]))
+        graph2 = add("%s/velveth_%i/Graph2" % (v["VELVETH_OUT"], k),
+                     "velvetg-graph2", k, [metavelvet_noscaf[-1]])
+        metavelvet_scaf.append(add("%s/scaf_%i/%s" %
+                                   (v["METAVELVET_OUT_SCAF"], k, scaf),
+                                   "metavelvetg-scaf", k, [graph2]))
+        ray_noscaf.append(add("%s/noscaf_%i/%s" % (v["RAY_OUT_NOSCAF"], k,
+                                                   contigs),
+                              "ray", k, [ray_pair]))
+        ray_scaf.append(add("%s/scaf_%i/%s" % (v["RAY_OUT_SCAF"], k, scaf),
+                            "ray-scaf", k, [ray_noscaf[-1]]))
+
+    # Only the assemblies of the k in KMERGE are merged
+    kmerge = set(int(k) for k in v["KMERGE"].split())
+    minimus2, newbler = [], []
+    for name, noscaf in [("VELVET", velvet_noscaf),
+                         ("METAVELVET", metavelvet_noscaf),
+                         ("RAY", ray_noscaf)]:
+        noscaf = [t for t in noscaf if t.k in kmerge]
+        minimus2.append(add("%s/%s" % (v["MINIMUS2_OUT_%s_NOSCAF" % name],
+                                       merge), "minimus2", None, noscaf))
+        newbler.append(add("%s/%s" % (v["NEWBLER_OUT_%s_NOSCAF" % name],
+                                      merge), "newbler", None, noscaf))
+
+    bambus2 = [add("%s/bambus2/bambus2.scaffold.linear.fasta" %
+                   os.path.dirname(t.target), "bambus2", t.k, [t])
+               for t in velvet_noscaf + metavelvet_noscaf + ray_noscaf +
+               minimus2 + newbler]
+
+    rules = {"qtrim": [qtrim],
+             "velvet": velvet_noscaf + velvet_scaf,
+             "metavelvet": metavelvet_noscaf + metavelvet_scaf,
+             "ray": ray_noscaf + ray_scaf,
+             "minimus2": minimus2,
+             "newbler": newbler,
+             "velvetnoscafnewbler": newbler[:1],
+             "bambus2": bambus2}
+    rules["all"] = [t for r in ["velvet", "metavelvet", "ray", "minimus2",
+                                "newbler", "bambus2"] for t in rules[r]]
+
+    return(tasks, rules)
+
+
+def read_history(historyfile):
+    """Returns a dictionary with a list of the records of every step in
+    historyfile, a file with a JSON record per line."""
+    history = {}
+    if not os.path.exists(historyfile):
+        return(history)
+    for line in open(historyfile):
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            # Last line of a run that was killed while writing
+            continue
+        history.setdefault(rec["step"], []).append(rec)
+
+    return(history)
+
+
+def estimate(records, k, value):
+    """Returns the estimate of value(rec) of a step at k given its records,
+    the maximum of the records of k, interpolated linearly between the
+    nearest k below and above or the maximum of the nearest k. Returns None
+    if there are no records."""
+    per_k = {}
+    for rec in records:
+        x = value(rec)
+        if x is not None:
+            per_k[rec["k"]] = max(per_k.get(rec["k"], x), x)
+    if len(per_k) == 0:
+        return(None)
+    if k in per_k:
+        return(per_k[k])
+    if k is None or None in per_k:
+        return(max(per_k.values()))
+    below = [x for x in per_k if x < k]
+    above = [x for x in per_k if x > k]
+    if len(below) == 0 or len(above) == 0:
+        return(per_k[min(per_k, key=lambda x: abs(x - k))])
+    lo, hi = max(below), min(above)
+    return(per_k[lo] + (per_k[hi] - per_k[lo]) * float(k - lo) / (hi - lo))
+
+
+def estimate_resources(tasks, history, mem_budget, cpu_budget, default_mem,
+                       mem_margin):
+    """Sets mem, cpus, wall and source of every task in tasks, a list in
+    topological order, from the history and the rank, the estimated wall time of the longest path from the task to
+    the end of the graph."""
+    for task in tasks:
+        records = history.get(task.step, [])
+        mem = estimate(records, task.k, lambda rec: rec["maxrss_kb"])
+        wall = estimate([rec for rec in records if rec["returncode"] == 0],
+                        task.k, lambda rec: rec["wall"])
+        cpus = estimate(records, task.k,
+                        lambda rec: rec["cpu"] / rec["wall"]
+                        if rec["wall"] > 0 else None)
+        if mem is None:
+            task.source = "default"
+            task.mem = default_mem
+        else:
+            ks = set(rec["k"] for rec in records)
+            if task.k in ks or task.k is None or None in ks:
+                task.source = "k=%s" % task.k
+            elif min(ks) < task.k < max(ks):
+                task.source = "interpolated"
+            else:
+                task.source = "nearest k"
+            task.mem = int(mem * mem_margin)
+        task.mem = min(task.mem, mem_budget)
+        task.cpus = min(max(1, int(round(cpus or 1))), cpu_budget)
+        task.wall = wall if wall is not None else DEFAULT_WALL
+
+    # Dependents come after a task in topological order
+    included = set(tasks)
+    for task in reversed(tasks):
+        task.rank = task.wall + max([t.rank for t in task.dependents
+                                     if t in included] + [0])
+
+
+def needed_tasks(targets):
+    """Returns the tasks of targets and all their prerequisites in
+    topological order."""
+    order, seen = [], set()
+
+    def visit(task):
+        if task in seen:
+            return
+        seen.add(task)
+        for d in task.deps:
+            visit(d)
+        order.append(task)
+
+    for task in targets:
+        visit(task)
+
+    return(order)
+
+
+def log_file(logdir, out, target):
+    """Returns the log file of target in logdir."""
+    name = os.path.relpath(target, out) if target.startswith(out) else target
+    return(os.path.join(logdir, name.replace(os.sep, "-") + ".log"))
+
+
+class Runner(object):
+    """Runs tasks with make under a memory and CPU budget."""
+    def __init__(self, make_cmd, mem_budget, cpu_budget, historyfile, logdir,
+                 out, keep_going=False):
+        self.make_cmd = make_cmd
+        self.mem_budget = mem_budget
+        self.cpu_budget = cpu_budget
+        self.historyfile = historyfile
+        self.logdir = logdir
+        self.out = out
+        self.keep_going = keep_going
+
+    def up_to_date(self, task):
+        with open(os.devnull, "w") as devnull:
+            return(subprocess.call(self.make_cmd + ["-q", task.target],
+                                   stdout=devnull, stderr=devnull) == 0)
+
+    def start(self, task):
+        logfile = log_file(self.logdir, self.out, task.target)
+        env = dict(os.environ, OMP_NUM_THREADS=str(task.cpus))
+        with open(logfile, "w") as log:
+            p = subprocess.Popen(self.make_cmd + [task.target], stdout=log,
+                                 stderr=subprocess.STDOUT, env=env,
+                                 preexec_fn=os.setpgrp)
+        sys.stderr.write("Started %s (%s, %i CPUs, %s)\n" %
+                         (task.target, format_size(task.mem), task.cpus,
+                          task.source))
+        return(p)
+
+    def record(self, task, start, returncode, rusage):
+        rec = rusage_fields(rusage)
+        rec.update(target=task.target, step=task.step, k=task.k,
+                   start=start, wall=time.time() - start,
+                   returncode=returncode, host=socket.gethostname())
+        with open(self.historyfile, "a") as fh:
+            fh.write(json.dumps(rec, sort_keys=True) + "\n")
+        return(rec)
+
+    def run(self, tasks):
+        """Runs tasks, a list in topological order. Returns the lists of
+        failed tasks and tasks that were not run."""
+        included = set(tasks)
+        waiting = dict((t, len([d for d in t.deps if d in included]))
+                       for t in tasks)
+        ready = [t for t in tasks if waiting[t] == 0]
+        running = {}
+        failed, done = [], set()
+        free_mem, free_cpus = self.mem_budget, self.cpu_budget
+
+        def finish(task):
+            done.add(task)
+            for t in task.dependents:
+                if t in waiting:
+                    waiting[t] -= 1
+                    if waiting[t] == 0:
+                        ready.append(t)
+
+        try:
+            while True:
+                # Start the ready tasks with the longest path first while they
+                # fit, those that are up to date are done right away
+                started = True
+                while started and (len(failed) == 0 or self.keep_going):
+                    started = False
+                    ready.sort(key=lambda t: -t.rank)
+                    for task in list(ready):
+                        if task.mem > free_mem or task.cpus > free_cpus:
+                            continue
+                        ready.remove(task)
+                        if self.up_to_date(task):
+                            finish(task)
+                        else:
+                            p = self.start(task)
+                            running[p.pid] = (task, p, time.time())
+                            free_mem -= task.mem
+                            free_cpus -= task.cpus
+                        started = True
+                        break
+                if len(running) == 0:
+                    break
+
+                # Reap the steps here to get their resource usage, the Popen
+                # objects are kept so they don't reap them first
+                pid, status, rusage = os.wait4(-1, 0)
+                if pid not in running:
+                    continue
+                task, p, start = running.pop(pid)
+                free_mem += task.mem
+                free_cpus += task.cpus
+                returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+                    else os.WEXITSTATUS(status)
+                p.returncode = returncode
+                rec = self.record(task, start, returncode, rusage)
+                if returncode == 0:
+                    sys.stderr.write("Finished %s in %.1fs, peak memory %s\n" %
+                                     (task.target, rec["wall"],
+                                      format_size(rec["maxrss_kb"])))
+                    finish(task)
+                else:
+                    sys.stderr.write("Failed %s with exit status %i, see %s\n"
+                                     % (task.target, returncode,
+                                        log_file(self.logdir, self.out,
+                                                 task.target)))
+                    failed.append(task)
+        except KeyboardInterrupt:
+            sys.stderr.write("Interrupted, stopping %i running steps\n" %
+                             len(running))
+            for pid in running:
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except OSError, e:
+                    if e.errno != errno.ESRCH:
+                        raise
+            for task, p, start in running.values():
+                p.wait()
+            raise
+
+        return(failed, [t for t in tasks if t not in done and t not in failed])
+
+
+def main(makefile, targets, assignments, mem_budget, cpu_budget, default_mem,
+         mem_margin=1.2, historyfile=None, keep_going=False, dry_run=False,
+         steplog=True):
+    variables = read_make_variables(makefile, assignments)
+    tasks, rules = build_graph(variables)
+    selected = []
+    for target in targets:
+        if target in rules:
+            selected += rules[target]
+        elif os.path.normpath(target) in tasks:
+            selected.append(tasks[os.path.normpath(target)])
+        else:
+            raise ValueError("%s is not a target of the pipeline, make it "
+                             "with make" % target)
+    needed = needed_tasks(selected)
+
+    rundir = os.path.join(variables["OUT"], "metassemble-run")
+    if historyfile is None:
+        historyfile = os.path.join(rundir, "history.jsonl")
+    estimate_resources(needed, read_history(historyfile), mem_budget,
+                       cpu_budget, default_mem, mem_margin)
+
+    if dry_run:
+        print "#target\tstep\tk\tmem\tcpus\twall\testimate"
+        for task in sorted(needed, key=lambda t: -t.rank):
+            print "%s\t%s\t%s\t%s\t%i\t%.1f\t%s" % (
+                task.target, task.step, task.k if task.k is not None else "-",
+                format_size(task.mem), task.cpus, task.wall, task.source)
+        return 0
+
+    logdir = os.path.join(rundir, "logs")
+    for d in [logdir, os.path.dirname(os.path.abspath(historyfile))]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    if steplog and "STEPLOG" not in os.environ and \
+            not any(a.startswith("STEPLOG=") for a in assignments):
+        assignments = assignments + ["STEPLOG=%s" % os.path.join(
+            rundir, time.strftime("steps-%Y%m%d-%H%M%S.jsonl"))]
+    runner = Runner(["make", "--no-print-directory", "-f", makefile] +
+                    assignments, mem_budget, cpu_budget, historyfile, logdir,
+                    variables["OUT"], keep_going)
+    failed, not_run = runner.run(needed)
+    if len(failed) > 0:
+        sys.stderr.write("%i steps failed, %i steps not run\n" %
+                         (len(failed), len(not_run)))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("targets", nargs="+",
+                        help="Rules or output files to make and variable "
+                        "assignments like KMAX=41\n")
+    parser.add_argument("-f", "--file", default="Makefile",
+                        help="Makefile that includes metassemble.mk, like "
+                        "examples/chris-mock/Makefile [Makefile]\n")
+    parser.add_argument("--mem", default=None,
+                        help="Memory of all steps running at the same time, "
+                        "in MB or with a suffix K, M, G or T [MemTotal]\n")
+    parser.add_argument("--cpus", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="CPUs of all steps running at the same time "
+                        "[all]\n")
+    parser.add_argument("--default-mem", default=None,
+                        help="Memory of steps that were not run before "
+                        "[--mem divided by --cpus]\n")
+    parser.add_argument("--mem-margin", type=float, default=1.2,
+                        help="Factor the peak memory of earlier runs is "
+                        "multiplied with [1.2]\n")
+    parser.add_argument("--history", default=None,
+                        help="File with the resources used by earlier runs, "
+                        "can be shared by samples "
+                        "[OUT/metassemble-run/history.jsonl]\n")
+    parser.add_argument("--no-steplog", action="store_true",
+                        help="Don't record every recipe line with steplog.py "
+                        "in OUT/metassemble-run/steps-DATE.jsonl\n")
+    parser.add_argument("-k", "--keep-going", action="store_true",
+                        help="Keep running steps that don't depend on a "
+                        "failed step\n")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="Print the steps with their estimated resources "
+                        "in the order they are started instead\n")
+    args = parser.parse_args()
+
+    if "METASSEMBLE_DIR" not in os.environ:
+        os.environ["METASSEMBLE_DIR"] = os.path.dirname(os.path.dirname(
+            os.path.realpath(__file__)))
+    assignments = [t for t in args.targets if "=" in t]
+    targets = [t for t in args.targets if "=" not in t]
+    if len(targets) == 0:
+        parser.error("No targets given")
+    try:
+        mem_budget = parse_size(args.mem) if args.mem is not None else \
+            total_memory()
+        default_mem = parse_size(args.default_mem) if args.default_mem is not \
+            None else mem_budget / max(1, args.cpus)
+    except ValueError, e:
+        parser.error(str(e))
+
+    try:
+        sys.exit(main(args.file, targets, assignments, mem_budget, args.cpus,
+                      default_mem, args.mem_margin, args.history,
+                      args.keep_going, args.dry_run, not args.no_steplog))
+    except ValueError, e:
+        print >>sys.stderr, "Error: %s" % e
+        sys.exit(2)
+    except KeyboardInterrupt:
+        sys.exit(130)
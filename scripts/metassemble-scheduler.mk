@@ -4,6 +4,10 @@ endif
 include $(METASSEMBLE_DIR)/scripts/parameters.mk
 include $(METASSEMBLE_DIR)/lib/scheduler.mk
 
+# Runtime in minutes of the Ray scaffolding of one k, used to pack them in jobs
+# of SCHEDULER_PACK_RUNTIME minutes, see lib/scheduler.mk.
+SCHEDULER_RAY_MV_SCAF_RUNTIME?=5
+
 ################################
 # ----- general rules -------- #
 ################################
@@ -36,9 +40,11 @@ $(VELVETH_OUT)/velveth_%/Roadmaps: $(VELVETH_OUT)/velveth_$(KMIN)/Sequences
 ################################
 # --------- velvetg ---------- #
 ################################
+# The -scaffolding no job stores the velvetg Graph the -scaffolding yes job
+# starts from
 $(VELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_VELVETG_OPT),make -e $@)
-$(VELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps
+	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_VELVETG_OPT),make -e $@ $(VELVETH_OUT)/velveth_$*/Graph)
+$(VELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_VELVETG_OPT),make -e $@)
 ################################
 # --------- /velvetg --------- #
@@ -47,9 +53,11 @@ $(VELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps
 ################################
 # ------- meta-velvetg ------- #
 ################################
+# The -scaffolding no job stores the Graph2 the -scaffolding yes job starts
+# from
 $(METAVELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_METAVELVETG_OPT),make -e $@)
-$(METAVELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps
+	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_METAVELVETG_OPT),make -e $@ $(VELVETH_OUT)/velveth_$*/Graph2)
+$(METAVELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(METAVELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_METAVELVETG_OPT),make -e $@)
 ################################
 # ------- /meta-velvetg ------ #
@@ -58,11 +66,11 @@ $(METAVELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmap
 ################################
 # --------- minimus2  -------- #
 ################################
-$(MINIMUS2_OUT_VELVET_NOSCAF)/$(MERGE_FILENAME): $(VELVETG_OUT_NOSCAF)
+$(MINIMUS2_OUT_VELVET_NOSCAF)/$(MERGE_FILENAME): $(VELVETG_OUT_NOSCAF_KMERGE)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MINIMUS2_VELVET_OPT),make -e $@)
-$(MINIMUS2_OUT_METAVELVET_NOSCAF)/$(MERGE_FILENAME): $(METAVELVETG_OUT_NOSCAF)
+$(MINIMUS2_OUT_METAVELVET_NOSCAF)/$(MERGE_FILENAME): $(METAVELVETG_OUT_NOSCAF_KMERGE)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MINIMUS2_METAVELVET_OPT),make -e $@)
-$(MINIMUS2_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT)
+$(MINIMUS2_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT_KMERGE)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MINIMUS2_RAY_OPT),make -e $@)
 ################################
 # --------- /minimus2  ------- #
@@ -71,11 +79,11 @@ $(MINIMUS2_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT)
 ################################
 # --------- newbler -----------#
 ################################
-$(NEWBLER_OUT_VELVET_NOSCAF)/$(MERGE_FILENAME): $(VELVETG_OUT_NOSCAF)
+$(NEWBLER_OUT_VELVET_NOSCAF)/$(MERGE_FILENAME): $(VELVETG_OUT_NOSCAF_KMERGE)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NEWBLER_VELVET_OPT),make -e $@)
-$(NEWBLER_OUT_METAVELVET_NOSCAF)/$(MERGE_FILENAME): $(METAVELVETG_OUT_NOSCAF)
+$(NEWBLER_OUT_METAVELVET_NOSCAF)/$(MERGE_FILENAME): $(METAVELVETG_OUT_NOSCAF_KMERGE)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NEWBLER_METAVELVET_OPT),make -e $@)
-$(NEWBLER_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT)
+$(NEWBLER_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT_KMERGE)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NEWBLER_RAY_OPT),make -e $@)
 ################################
 # -------- /newbler -----------#
@@ -98,7 +106,7 @@ $(NEWBLER_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT)
 $(RAY_OUT)/noscaf/noscaf_%/$(CONTIG_FILENAME): $(FASTQ_TRIM_IL)
 	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_RAY_OPT),make -e $@)
 $(RAY_OUT)/scaf/scaf_%/$(SCAF_FILENAME): $(RAY_OUT)/noscaf/noscaf_%/$(CONTIG_FILENAME)
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_RAY_MV_SCAF_OPT),make -e $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_RAY_MV_SCAF_OPT),make -ke,rayscaf,$(SCHEDULER_RAY_MV_SCAF_RUNTIME))
 ################################
 # ---------- /ray -------------#
 ################################
@@ -8,6 +8,16 @@ endif
 include $(METASSEMBLE_DIR)/scripts/parameters.mk
 SCRIPTDIR=$(METASSEMBLE_DIR)/scripts
 
+# Record wall time, CPU time, peak memory and I/O of every recipe line in the
+# file STEPLOG, e.g. make all STEPLOG=steps.jsonl. Report the slowest steps
+# with python $(SCRIPTDIR)/steplog.py report steps.jsonl
+ifdef STEPLOG
+SHELL:=$(SCRIPTDIR)/steplog.py
+override STEPLOG:=$(abspath $(STEPLOG))
+export STEPLOG
+export STEPLOG_TARGET=$@
+endif
+
 ################################
 # ----- general rules -------- #
 ################################
@@ -53,11 +63,36 @@ $(VELVETH_OUT)/velveth_$(KMIN)/Sequences: $(FASTQ_TRIM_IL)
 	mkdir -p $(VELVETH_OUT)
 	velveth $(VELVETH_OUT)/velveth_$(KMIN) $(KMIN) -noHash -fastq \
 		-shortPaired $<
+	python $(SCRIPTDIR)/assembly/velvetg-graph-store.py digest $@
 $(VELVETH_OUT)/velveth_%/Sequences: $(VELVETH_OUT)/velveth_$(KMIN)/Sequences
 	mkdir -p $(@D)
 	ln -fs $(abspath $<) $@
 $(VELVETH_OUT)/velveth_%/Roadmaps: $(VELVETH_OUT)/velveth_%/Sequences
 	velveth $(@D) $* -reuse_Sequences
+# Graph of velvetg, built by the velvetg -scaffolding no run of a k, moved
+# into VELVETG_GRAPH_STORE and linked here. Graph2, which has read tracking,
+# is built by the velvetg run of meta-velvetg -scaffolding no. The
+# -scaffolding yes runs start from them.
+$(VELVETH_OUT)/velveth_%/Graph: $(VELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME)
+	python $(SCRIPTDIR)/assembly/velvetg-graph-store.py publish $(VELVETG_GRAPH_STORE) $(@D) $(<D)
+$(VELVETH_OUT)/velveth_%/Graph2: $(METAVELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME)
+	python $(SCRIPTDIR)/assembly/velvetg-graph-store.py publish --read-trkg $(VELVETG_GRAPH_STORE) $(@D) $(<D)
+# Remove Graph or Graph2 ($2) of k $1 from the store if the assemblies made
+# from it exist
+define evict_velvetg_graph
+python $(SCRIPTDIR)/assembly/velvetg-graph-store.py evict \
+	$(if $(filter Graph2,$2),--read-trkg $(VELVETH_OUT)/velveth_$1 \
+		$(METAVELVET_OUT_NOSCAF)/noscaf_$1/$(CONTIG_FILENAME) $(METAVELVET_OUT_SCAF)/scaf_$1/$(SCAF_FILENAME),\
+		$(VELVETH_OUT)/velveth_$1 \
+		$(VELVET_OUT_NOSCAF)/noscaf_$1/$(CONTIG_FILENAME) $(VELVET_OUT_SCAF)/scaf_$1/$(SCAF_FILENAME))
+endef
+# Link the velveth output in the directory of the first prerequisite and the
+# stored velvetg graph, Graph2 if $1 is --read-trkg
+define link_velvetg_graph
+ln -fs $(abspath $(dir $<)Sequences) $(@D)/Sequences
+ln -fs $(abspath $(dir $<)Roadmaps) $(@D)/Roadmaps
+python $(SCRIPTDIR)/assembly/velvetg-graph-store.py fetch $1 $(VELVETG_GRAPH_STORE) $(dir $<) $(@D)
+endef
 ################################
 # --------- /velveth --------- #
 ################################
@@ -67,14 +102,14 @@ $(VELVETH_OUT)/velveth_%/Roadmaps: $(VELVETH_OUT)/velveth_%/Sequences
 ################################
 define velvetg_rule
 mkdir -p $(@D)
-ln -fs $(abspath $(lastword $^)) $(@D)/Sequences
-ln -fs $(abspath $<) $(@D)/Roadmaps
+$(call link_velvetg_graph,)
 velvetg $(@D) $1
 mv $(@D)/contigs.fa $@
+$(if $(filter yes,$(VELVETG_GRAPH_EVICT)),$(call evict_velvetg_graph,$*,Graph))
 endef
 $(VELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps $(VELVETH_OUT)/velveth_%/Sequences
 	$(call velvetg_rule,-scaffolding no)
-$(VELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps $(VELVETH_OUT)/velveth_%/Sequences
+$(VELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Graph $(VELVETH_OUT)/velveth_%/Roadmaps $(VELVETH_OUT)/velveth_%/Sequences
 	$(call velvetg_rule,-scaffolding yes -exp_cov auto)
 ################################
 # --------- /velvetg --------- #
@@ -83,18 +118,18 @@ $(VELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps $(
 ################################
 # ------- meta-velvetg ------- #
 ################################
-# Copy output from velveth and run velvetg, followed by meta-velvetg -scaffolding yes or no
+# Link output from velveth and run velvetg from the stored Graph2, followed by meta-velvetg -scaffolding yes or no
 define metavelvetg_rule
 mkdir -p $(dir $@)
-ln -fs $(abspath $(lastword $^)) $(@D)/Sequences
-ln -fs $(abspath $<) $(@D)/Roadmaps
+$(call link_velvetg_graph,--read-trkg)
 velvetg $(dir $@) -scaffolding no -exp_cov auto -read_trkg yes \
 	&& meta-velvetg $(dir $@) $1
 mv $(@D)/meta-velvetg.contigs.fa $@
+$(if $(filter yes,$(VELVETG_GRAPH_EVICT)),$(call evict_velvetg_graph,$*,Graph2))
 endef
 $(METAVELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps $(VELVETH_OUT)/velveth_%/Sequences
 	$(call metavelvetg_rule,-scaffolding no)
-$(METAVELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Roadmaps $(VELVETH_OUT)/velveth_%/Sequences
+$(METAVELVET_OUT_SCAF)/scaf_%/$(SCAF_FILENAME): $(VELVETH_OUT)/velveth_%/Graph2 $(VELVETH_OUT)/velveth_%/Roadmaps $(VELVETH_OUT)/velveth_%/Sequences
 	$(call metavelvetg_rule,-scaffolding yes)
 ################################
 # ------- /meta-velvetg ------ #
@@ -109,11 +144,11 @@ mkdir -p $(@D)
 bash -x $(SCRIPTDIR)/assembly/merge-asm-minimus2.sh $(@D) $^
 mv $(@D)/all-merged.fasta $@
 endef
-$(MINIMUS2_OUT_VELVET_NOSCAF)/$(MERGE_FILENAME): $(VELVETG_OUT_NOSCAF)
+$(MINIMUS2_OUT_VELVET_NOSCAF)/$(MERGE_FILENAME): $(VELVETG_OUT_NOSCAF_KMERGE)
 	$(MINIMUS2_RULE)
-$(MINIMUS2_OUT_METAVELVET_NOSCAF)/$(MERGE_FILENAME): $(METAVELVETG_OUT_NOSCAF)
+$(MINIMUS2_OUT_METAVELVET_NOSCAF)/$(MERGE_FILENAME): $(METAVELVETG_OUT_NOSCAF_KMERGE)
 	$(MINIMUS2_RULE)
-$(MINIMUS2_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT)
+$(MINIMUS2_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT_KMERGE)
 	$(MINIMUS2_RULE)
 ################################
 # --------- /minimus2  ------- #
@@ -130,11 +165,11 @@ runAssembly $(NEWBLER_CPUS) -force -o $(@D) $(@D)/velvet-noscaf-cut-up.fasta
 rm $(@D)/velvet-noscaf-cut-up.fasta
 mv $(@D)/454AllContigs.fna $@
 endef
-$(NEWBLER_OUT_VELVET_NOSCAF)/$(MERGE_FILENAME): $(VELVETG_OUT_NOSCAF)
+$(NEWBLER_OUT_VELVET_NOSCAF)/$(MERGE_FILENAME): $(VELVETG_OUT_NOSCAF_KMERGE)
 	$(NEWBLER_RULE)
-$(NEWBLER_OUT_METAVELVET_NOSCAF)/$(MERGE_FILENAME): $(METAVELVETG_OUT_NOSCAF)
+$(NEWBLER_OUT_METAVELVET_NOSCAF)/$(MERGE_FILENAME): $(METAVELVETG_OUT_NOSCAF_KMERGE)
 	$(NEWBLER_RULE)
-$(NEWBLER_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT)
+$(NEWBLER_OUT_RAY_NOSCAF)/$(MERGE_FILENAME): $(RAY_CONTIGS_OUT_KMERGE)
 	$(NEWBLER_RULE)
 ################################
 # -------- /newbler -----------#
@@ -154,7 +189,6 @@ mkdir -p $(@D)
 bash -x $(SCRIPTDIR)/assembly/scaf-asm-bambus2.sh \
 	$(@D)/contigs_${FASTQBASE}-smds.bam $< bambus2
 endef
-	$(BAMBUS2_MAPPING_RULE)
 %/bambus2/contigs_$(FASTQBASE)-smds.bam: %/$(MERGE_FILENAME) $(FASTQ_TRIM_1) $(FASTQ_TRIM_2)
 	$(BAMBUS2_MAPPING_RULE)
 %/bambus2/contigs_$(FASTQBASE)-smds.bam: %/$(CONTIG_FILENAME) $(FASTQ_TRIM_1) $(FASTQ_TRIM_2)
@@ -192,3 +226,18 @@ $(RAY_OUT)/scaf/scaf_%/$(SCAF_FILENAME): $(RAY_OUT)/noscaf/noscaf_%/$(CONTIG_FIL
 ################################
 # ---------- /ray -------------#
 ################################
+
+################################
+# -------- k-mer sweep --------#
+################################
+# Assemble a coarse grid of k and refine around the best assemblies, writes
+# the k to use to $(KSWEEP_OUT)/ksweep.mk
+ksweep:
+	python $(SCRIPTDIR)/metassemble-ksweep.py --kmin $(KMIN) --kmax $(KMAX) \
+		--step $(STEPSIZE) --coarse-step $(KSWEEP_COARSE_STEP) \
+		--refine $(KSWEEP_REFINE) --top $(KSWEEP_TOP) \
+		--make "$(KSWEEP_MAKE) KSWEEP=no" -o $(KSWEEP_OUT) \
+		'$(KSWEEP_ASSEMBLY)'
+################################
+# -------- /k-mer sweep -------#
+################################
@@ -23,6 +23,27 @@ KMIN?=19
 KMAX?=75
 STEPSIZE?=2
 KNUMBERS=$(shell seq $(KMIN) $(STEPSIZE) $(KMAX))
+# K values of the assemblies that are merged with minimus2 and newbler
+KMERGE=$(KNUMBERS)
+# Adaptive k-mer sweep, yes or no. make ksweep assembles KSWEEP_ASSEMBLY for a
+# grid of k with step KSWEEP_COARSE_STEP and then for the k around the
+# KSWEEP_REFINE best, see scripts/metassemble-ksweep.py. It writes
+# KSWEEP_OUT/ksweep.mk, which sets KNUMBERS to the swept k and KMERGE to the
+# KSWEEP_TOP best.
+KSWEEP?=no
+KSWEEP_OUT?=$(OUT)/ksweep
+KSWEEP_COARSE_STEP?=$(shell expr 4 \* $(STEPSIZE))
+KSWEEP_REFINE?=2
+KSWEEP_TOP?=5
+KSWEEP_ASSEMBLY?=$(VELVET_OUT_NOSCAF)/noscaf_%/$(CONTIG_FILENAME)
+KSWEEP_MAKE?=$(MAKE) -f $(firstword $(MAKEFILE_LIST))
+ifeq ($(KSWEEP),yes)
+ifneq ($(wildcard $(KSWEEP_OUT)/ksweep.mk),)
+include $(KSWEEP_OUT)/ksweep.mk
+else ifneq ($(filter-out ksweep clean% keepresultsonly echo%,$(or $(MAKECMDGOALS),all)),)
+$(error No k-mer sweep in $(KSWEEP_OUT), run make ksweep first)
+endif
+endif
 ################################
 # ---- /output parameters ---- #
 ################################
@@ -56,7 +77,15 @@ VELVETH_OUT:=$(VELVET_OUT)/velveth
 VELVET_OUT_NOSCAF:=$(VELVET_OUT)/noscaf
 VELVETH_OUT_SEQ:=$(foreach i,$(KNUMBERS),$(VELVETH_OUT)/velveth_$(i)/Sequences)
 VELVETH_OUT_RD:=$(foreach i,$(KNUMBERS),$(VELVETH_OUT)/velveth_$(i)/Roadmaps)
+VELVETH_OUT_GRAPH:=$(foreach i,$(KNUMBERS),$(VELVETH_OUT)/velveth_$(i)/Graph $(VELVETH_OUT)/velveth_$(i)/Graph2)
+# Store of the velvetg graphs of every k, shared by the velvetg and
+# meta-velvetg runs. Can be shared by output directories of the same reads.
+VELVETG_GRAPH_STORE?=$(VELVET_OUT)/graph-store
+# Remove the graphs of a k from the store once the assemblies made from it
+# exist, yes or no
+VELVETG_GRAPH_EVICT?=no
 VELVETG_OUT_NOSCAF:=$(foreach i,$(KNUMBERS),$(VELVET_OUT_NOSCAF)/noscaf_$(i)/$(CONTIG_FILENAME))
+VELVETG_OUT_NOSCAF_KMERGE:=$(foreach i,$(KMERGE),$(VELVET_OUT_NOSCAF)/noscaf_$(i)/$(CONTIG_FILENAME))
 VELVET_OUT_SCAF:=$(VELVET_OUT)/scaf
 VELVETG_OUT_SCAF:=$(foreach i,$(KNUMBERS),$(VELVET_OUT_SCAF)/scaf_$(i)/$(SCAF_FILENAME))
 ################################
@@ -70,6 +99,7 @@ METAVELVET_OUT:=$(ASM_OUT)/metavelvet
 METAVELVET_OUT_NOSCAF:=$(METAVELVET_OUT)/noscaf
 METAVELVETH_OUT_NOSCAF:=$(foreach i,$(KNUMBERS),$(METAVELVET_OUT_NOSCAF)/noscaf_$(i)/Sequences)
 METAVELVETG_OUT_NOSCAF:=$(foreach i,$(KNUMBERS),$(METAVELVET_OUT_NOSCAF)/noscaf_$(i)/$(CONTIG_FILENAME))
+METAVELVETG_OUT_NOSCAF_KMERGE:=$(foreach i,$(KMERGE),$(METAVELVET_OUT_NOSCAF)/noscaf_$(i)/$(CONTIG_FILENAME))
 METAVELVET_OUT_SCAF:=$(METAVELVET_OUT)/scaf
 METAVELVETH_OUT_SCAF:=$(foreach i,$(KNUMBERS),$(METAVELVET_OUT_SCAF)/scaf_$(i)/Sequences)
 METAVELVETG_OUT_SCAF:=$(foreach i,$(KNUMBERS),$(METAVELVET_OUT_SCAF)/scaf_$(i)/$(SCAF_FILENAME))
@@ -86,6 +116,7 @@ RAY_OUT:=$(ASM_OUT)/ray
 RAY_OUT_NOSCAF:=$(RAY_OUT)/noscaf
 RAY_OUT_SCAF:=$(RAY_OUT)/scaf
 RAY_CONTIGS_OUT:=$(foreach i,$(KNUMBERS),$(RAY_OUT_NOSCAF)/noscaf_$(i)/$(CONTIG_FILENAME))
+RAY_CONTIGS_OUT_KMERGE:=$(foreach i,$(KMERGE),$(RAY_OUT_NOSCAF)/noscaf_$(i)/$(CONTIG_FILENAME))
 RAY_SCAFFOLDS_OUT:=$(foreach i,$(KNUMBERS),$(RAY_OUT_SCAF)/scaf_$(i)/$(SCAF_FILENAME))
 ################################
 # ---------- /ray -------------#
@@ -190,6 +221,9 @@ cleanmetavelvet:
 	-rm -rf $(METAVELVET_OUT)
 cleanmetavelvetg:
 	-rm $(METAVELVETG_OUT_NOSCAF) $(METAVELVETG_OUT_SCAF)
+# Remove the velvetg graphs of the k's of which the assemblies exist
+cleanvelvetgraphs:
+	-$(foreach k,$(wildcard $(VELVETH_OUT_GRAPH)),$(call evict_velvetg_graph,$(patsubst velveth_%,%,$(notdir $(patsubst %/,%,$(dir $k)))),$(notdir $k));)
 cleanqtrim:
 	-rm -rf $(PRC_READS_OUT)
 cleanminimus2:
@@ -200,6 +234,8 @@ cleannewbler:
 # /Rules to delete assemblies  #
 ################################
 
-.PHONY: all qtrim velvet metavelvet cleanall cleanasm cleanvelvetg cleanvelvet cleanmetavelvet cleanmetavelvetg cleanqtrim cleanminimus2 cleannewbler validateexisting keepresultsonly echoexisting ray bambus2existing bambus2
+.PHONY: all qtrim velvet metavelvet ksweep cleanall cleanasm cleanvelvetg cleanvelvet cleanmetavelvet cleanmetavelvetg cleanvelvetgraphs cleanqtrim cleanminimus2 cleannewbler validateexisting keepresultsonly echoexisting ray bambus2existing bambus2
 # Takes quite some time to compute some of these, so you might want to decide yourself when to delete them by using make keepcontigsonly for instance.
 .PRECIOUS: $(VELVETH_OUT_RD) $(VELVETH_OUT_SEQ) $(FASTQ_TRIM_IL)
+# Graphs are not remade when they were evicted and the assemblies are up to date
+.SECONDARY: $(VELVETH_OUT_GRAPH)
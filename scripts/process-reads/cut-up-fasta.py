@@ -15,35 +15,125 @@ Options:
     -o INT   Overlap between successive chunks. The last o bases of a chunk
              overlap with the first o bases of the next chunk. Has to be
              smaller than l. [1900]
+    -p INT   Cut up this many fasta files in parallel. The output is in the
+             same order as the input files. Files are cut up in temporary
+             files in TMPDIR first. [1]
+    -v       Write the throughput per file in MB/s to stderr.
 Citations:
    1. Luo C, Tsementzi D, Kyrpides N, Read T, Konstantinidis KT (2012) Direct
    Comparisons of Illumina vs. Roche 454 Sequencing Technologies on the Same
    Microbial Community DNA Sample. PLoS ONE 7(2): e30087.
    doi:10.1371/journal.pone.0030087
 """
+import os
 import sys
+import time
 import getopt
-from Bio import SeqIO
-
-def cut_up_fasta(fastfiles, chunk_size, overlap):
-    for ff in fastfiles:
-        for record in SeqIO.parse(ff, "fasta"):
-            if (len(record.seq) > chunk_size):
-                i = 0
-                # Output first part of contig twice
-                print ">%s.%i\n%s" % (record.id, i,
-                        record.seq[0:chunk_size])
-                for split_seq in chunks(record.seq, chunk_size, overlap):
-                    print ">%s.%i\n%s" % (record.id, i, split_seq)
-                    i = i + 1
-                # Output last chunk twice
-                print ">%s.%i\n%s" % (record.id, i,
-                        record.seq[-chunk_size + overlap:])
-            else:
-                print ">%s\n%s" % (record.id, record.seq)
+import shutil
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                ".."))
+from fastaio import read_fasta
+
+# Size of the output buffer, the output is about 20 times the input with the
+# default chunk size and overlap
+WRITE_BUFFER = 4 * 1024 * 1024
+
+
+def cut_up_fasta(fastfiles, chunk_size, overlap, processes=1, verbose=False):
+    sys.stdout.flush()
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb", WRITE_BUFFER)
+    start_time = time.time()
+    in_bytes, out_bytes = 0, 0
+
+    if processes > 1 and len(fastfiles) > 1:
+        # Cut up every file in a temporary file and concatenate those in input
+        # order as they come in
+        tmp_dir = tempfile.mkdtemp(prefix="cut-up-fasta.")
+        pool = multiprocessing.Pool(min(processes, len(fastfiles)))
+        try:
+            for ff, tmp, in_b, out_b, seconds in pool.imap(
+                    _cut_up_file_to_tmp,
+                    [(ff, os.path.join(tmp_dir, "%i.fasta" % i), chunk_size,
+                      overlap) for i, ff in enumerate(fastfiles)]):
+                with open(tmp, "rb") as fh:
+                    shutil.copyfileobj(fh, out, WRITE_BUFFER)
+                os.remove(tmp)
+                in_bytes, out_bytes = in_bytes + in_b, out_bytes + out_b
+                if verbose:
+                    print_throughput(ff, in_b, out_b, seconds)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(tmp_dir)
+    else:
+        for ff in fastfiles:
+            file_time = time.time()
+            in_b, out_b = cut_up_file(ff, out, chunk_size, overlap)
+            in_bytes, out_bytes = in_bytes + in_b, out_bytes + out_b
+            if verbose:
+                print_throughput(ff, in_b, out_b, time.time() - file_time)
+    out.close()
+
+    if verbose and len(fastfiles) > 1:
+        print_throughput("total", in_bytes, out_bytes,
+                         time.time() - start_time)
 
     return 0
 
+
+def cut_up_file(ff, out, chunk_size, overlap):
+    """Writes the chunks of all contigs in fasta file ff to out. Returns the
+    number of sequence bytes read and the number of bytes written."""
+    write = out.write
+    in_bytes, out_bytes = 0, 0
+    for rec_id, seq in read_fasta(ff):
+        in_bytes += len(seq)
+        if (len(seq) > chunk_size):
+            prefix = ">" + rec_id + "."
+            # Output first part of contig twice
+            line = prefix + "0\n" + seq[0:chunk_size] + "\n"
+            write(line)
+            out_bytes += len(line)
+            i = 0
+            for split_seq in chunks(seq, chunk_size, overlap):
+                line = prefix + str(i) + "\n" + split_seq + "\n"
+                write(line)
+                out_bytes += len(line)
+                i = i + 1
+            # Output last chunk twice
+            line = prefix + str(i) + "\n" + seq[-chunk_size + overlap:] + "\n"
+            write(line)
+            out_bytes += len(line)
+        else:
+            line = ">" + rec_id + "\n" + seq + "\n"
+            write(line)
+            out_bytes += len(line)
+
+    return(in_bytes, out_bytes)
+
+
+def _cut_up_file_to_tmp(args):
+    """Cuts up a fasta file in a temporary file for the multiprocessing
+    pool."""
+    ff, tmp, chunk_size, overlap = args
+    start_time = time.time()
+    with open(tmp, "wb", WRITE_BUFFER) as out:
+        in_bytes, out_bytes = cut_up_file(ff, out, chunk_size, overlap)
+
+    return(ff, tmp, in_bytes, out_bytes, time.time() - start_time)
+
+
+def print_throughput(name, in_bytes, out_bytes, seconds):
+    seconds = max(seconds, 1e-6)
+    print >>sys.stderr, "%s\t%.1f MB in\t%.1f MB out\t%.2fs\t%.1f MB/s in\t" \
+        "%.1f MB/s out" % (name, in_bytes / 1e6, out_bytes / 1e6, seconds,
+                           in_bytes / 1e6 / seconds, out_bytes / 1e6 / seconds)
+
+
 def chunks(l, n, o):
     """ Yield successive n-sized chunks from l with given overlap o between the
     chunks.
@@ -62,7 +152,7 @@ def main(argv=None):
         argv = sys.argv
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hl:o:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hl:o:p:v", ["help"])
         except getopt.error, msg:
              raise Usage(msg)
     except Usage, err:
@@ -72,6 +162,8 @@ def main(argv=None):
     # process options
     chunk_size = 1999
     overlap = 1900
+    processes = 1
+    verbose = False
     for o, a in opts:
         if o in ("-h", "--help"):
             print __doc__
@@ -80,12 +172,16 @@ def main(argv=None):
             chunk_size = int(a)
         if o in ("-o"):
             overlap = int(a)
+        if o in ("-p"):
+            processes = int(a)
+        if o in ("-v"):
+            verbose = True
     if overlap >= chunk_size:
         print >>sys.stderr, "Overlap not smaller than chunk size"
         return 2
     # process arguments
     if (len(args) >= 1):
-        return cut_up_fasta(args, chunk_size, overlap)
+        return cut_up_fasta(args, chunk_size, overlap, processes, verbose)
     else:
         print >>sys.stderr, "At least one argument required"
         print __doc__
@@ -1,10 +1,16 @@
 #! /usr/bin/env python
-# Biopython version of
+# Python version of
 # https://github.com/ctb/khmer/blob/master/sandbox/multi-rename.py
 """Rename accessions. New names go from '>[prefix:]1[:original name]' to
 '>[prefix:]n[:original name]' where n is the number of fasta sequences, [prefix:]
 an optional prefix and [:original name] the optional original accession.
 
+The fasta file is read in large blocks and records are found by their offsets
+in the block. Sequences with fewer bytes than the cutoff, line breaks included,
+are skipped without copying them. Other sequences are copied once with their
+line breaks removed. Gzipped fasta files (.gz) are decompressed with pigz or
+gzip.
+
 Usage:
     reads-rename.py [options] <fastafile>
 Options:
@@ -13,9 +19,13 @@ Options:
     -p/--prefix STRING  Prefix the accessions.
     -o/--original       Postfix with original name.
 """
+import os
 import sys
 import getopt
-from Bio import SeqIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                ".."))
+from fastaio import open_input, read_blocks, SEQ_WHITESPACE
 
 
 class Usage(Exception):
@@ -28,18 +38,58 @@ class Error(Exception):
         self.msg = msg
 
 
+def rename_block(block, start, prefix, cutoff, original, n):
+    """Returns the renamed records of block that are at least cutoff long,
+    starting at start, and the number of the last record. n is the number of
+    the last record of the previous block."""
+    pieces = []
+    append = pieces.append
+    size = len(block)
+
+    while start < size:
+        end = block.find("\n>", start)
+        end = size if end == -1 else end + 1
+        header_end = block.find("\n", start, end)
+        seq_start = end if header_end == -1 else header_end + 1
+
+        # The sequence is never longer than its byte range, so shorter ranges
+        # are skipped without copying. Others are copied once, without line
+        # breaks, which is needed for the output anyway.
+        if end - seq_start >= cutoff:
+            seq = block[seq_start:end].translate(None, SEQ_WHITESPACE)
+            if len(seq) >= cutoff:
+                n += 1
+                if original:
+                    words = block[start + 1:seq_start].split(None, 1)
+                    append('>%s%s:%s\n' % (prefix, n, words[0] if len(words) > 0 else ""))
+                else:
+                    append('>%s%s\n' % (prefix, n))
+                append(seq)
+                append('\n')
+        start = end
+
+    return "".join(pieces), n
+
+
 def process(fastafile, prefix, cutoff, original):
     n = 0
     if prefix != '':
         prefix += ':'
 
-    for record in SeqIO.parse(fastafile, "fasta"):
-        if len(record.seq) >= cutoff:
-            n += 1
-            if original:
-                print '>%s%s:%s\n%s' % (prefix, n, record.id, record.seq)
-            else:
-                print '>%s%s\n%s' % (prefix, n, record.seq)
+    with open_input(fastafile) as fh:
+        first = True
+        for block in read_blocks(fh):
+            start = 0
+            if first:
+                # Skip anything before the first record
+                if not block.startswith(">"):
+                    start = block.find("\n>")
+                    if start == -1:
+                        continue
+                    start += 1
+                first = False
+            out, n = rename_block(block, start, prefix, cutoff, original, n)
+            sys.stdout.write(out)
  
     if n == 0:
         raise Error('No contigs >= %i\n' % cutoff)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""
+Records the wall time, CPU time, peak memory and I/O of the steps of the
+pipeline in a log file with a JSON record per line, and reports the slowest
+steps of a run.
+
+Every recipe line of metassemble.mk and the makefiles that include it is
+recorded when make is run with STEPLOG=steps.jsonl, which makes this script
+the SHELL of make. It runs the recipe line with /bin/sh like make would and
+appends a record with the target ($@) and the command. The Python scripts
+record their own parts, e.g. every assembly of coords-stats-batch.py, with
+the step context manager when the environment variable STEPLOG is set.
+metassemble-run.py writes the records of a run to
+OUT/metassemble-run/steps-DATE.jsonl.
+
+The CPU time, the peak memory of the largest process (maxrss_kb) and the
+bytes read from and written to storage (read_bytes, write_bytes) come from
+the resource usage of the command and all its children when it exits. The
+peak memory of all processes of the command together (tree_rss_kb) and the
+bytes read and written including the page cache and pipes (rchar, wchar) are
+sampled from /proc while it runs, so they miss what happens between samples.
+
+Usage:
+    make all STEPLOG=steps.jsonl
+    steplog.py run --log steps.jsonl --step name -- command [args ...]
+    steplog.py report steps.jsonl [steps.jsonl ...]
+"""
+import argparse
+import os
+import re
+import sys
+import json
+import time
+import socket
+import resource
+import subprocess
+from contextlib import contextmanager
+
+# Seconds between samples of /proc, the first samples are taken sooner so
+# short commands don't wait for a full interval
+SAMPLE_INTERVAL = float(os.environ.get("STEPLOG_INTERVAL", "1.0"))
+FIRST_SAMPLE_INTERVAL = 0.01
+
+PAGE_KB = os.sysconf("SC_PAGE_SIZE") / 1024 if hasattr(os, "sysconf") else 4
+
+# ru_inblock and ru_oublock count blocks of 512 bytes
+BLOCK_SIZE = 512
+
+IO_FIELDS = ["rchar", "wchar"]
+
+# Programs that run the program a step is reported by
+WRAPPERS = ["bash", "sh", "python", "python2", "perl", "Rscript", "time",
+            "nice", "env", "mpiexec", "mpirun", "aprun"]
+
+
+def append_record(logfile, rec):
+    """Appends rec as a JSON line to logfile in one write, so the records of
+    steps running at the same time don't mix."""
+    line = json.dumps(rec, sort_keys=True) + "\n"
+    fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def rusage_fields(rusage, before=None):
+    """Returns a dictionary with the CPU time, peak memory and storage I/O of
+    rusage, minus the counters of rusage before if given. The peak memory
+    can't be subtracted and is the peak of the process so far."""
+    fields = dict(user=rusage.ru_utime, sys=rusage.ru_stime,
+                  maxrss_kb=rusage.ru_maxrss,
+                  read_bytes=rusage.ru_inblock * BLOCK_SIZE,
+                  write_bytes=rusage.ru_oublock * BLOCK_SIZE)
+    if before is not None:
+        before = rusage_fields(before)
+        for name in ["user", "sys", "read_bytes", "write_bytes"]:
+            fields[name] -= before[name]
+    fields["cpu"] = fields["user"] + fields["sys"]
+    return(fields)
+
+
+def _proc_children():
+    """Returns a dictionary with the pids of the children of every process
+    in /proc."""
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as fh:
+                stat = fh.read()
+        except IOError:
+            continue
+        # The command name in parentheses can contain spaces
+        ppid = int(stat[stat.rfind(")") + 2:].split(None, 2)[1])
+        children.setdefault(ppid, []).append(int(name))
+    return(children)
+
+
+def _proc_io(pid):
+    """Returns a dictionary with IO_FIELDS of /proc/pid/io, which include the
+    children the process has waited for, or None if it can't be read."""
+    try:
+        with open("/proc/%i/io" % pid) as fh:
+            fields = dict(line.split(":", 1) for line in fh)
+        return(dict((name, int(fields[name])) for name in IO_FIELDS))
+    except (IOError, KeyError, ValueError):
+        return(None)
+
+
+def sample_tree(pid):
+    """Returns the summed resident memory in kilobytes and a dictionary with
+    the summed IO_FIELDS of process pid and all its descendants, read from
+    /proc. Returns None if /proc can't be read."""
+    try:
+        children = _proc_children()
+    except OSError:
+        return(None)
+    rss_kb, io = 0, dict((name, 0) for name in IO_FIELDS)
+    todo = [pid]
+    while len(todo) > 0:
+        p = todo.pop()
+        todo.extend(children.get(p, []))
+        try:
+            with open("/proc/%i/statm" % p) as fh:
+                rss_kb += int(fh.read().split()[1]) * PAGE_KB
+        except (IOError, IndexError):
+            continue
+        p_io = _proc_io(p)
+        if p_io is not None:
+            for name in IO_FIELDS:
+                io[name] += p_io[name]
+    return(rss_kb, io)
+
+
+def run_command(args, shell=False):
+    """Runs the command args, a list or with shell a string for /bin/sh -c,
+    with the same stdin, stdout and stderr and samples it from /proc while it
+    runs. Returns the exit status, like -N if it was killed by signal N, and
+    a dictionary with the fields of the record."""
+    start = time.time()
+    p = subprocess.Popen(["/bin/sh", "-c", args] if shell else args)
+    tree_rss_kb, io = 0, dict((name, 0) for name in IO_FIELDS)
+    interval = FIRST_SAMPLE_INTERVAL
+    while True:
+        pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        sample = sample_tree(p.pid)
+        if sample is not None:
+            tree_rss_kb = max(tree_rss_kb, sample[0])
+            for name in IO_FIELDS:
+                io[name] = max(io[name], sample[1][name])
+        time.sleep(interval)
+        interval = min(interval * 2, SAMPLE_INTERVAL)
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else \
+        os.WEXITSTATUS(status)
+
+    rec = rusage_fields(rusage)
+    rec.update(io)
+    rec.update(start=start, wall=time.time() - start,
+               tree_rss_kb=max(tree_rss_kb, rec["maxrss_kb"]),
+               returncode=p.returncode, host=socket.gethostname())
+    return(p.returncode, rec)
+
+
+@contextmanager
+def step(name, logfile=None):
+    """Records the with block as step name in logfile, or in the file in the
+    environment variable STEPLOG. Does nothing if neither is set. The peak
+    memory is the peak of the whole process so far, run steps in worker
+    processes to get the peak of a step."""
+    if logfile is None:
+        logfile = os.environ.get("STEPLOG")
+    if not logfile:
+        yield
+        return
+
+    start = time.time()
+    before_self = resource.getrusage(resource.RUSAGE_SELF)
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_before = _proc_io(os.getpid())
+    returncode = 1
+    try:
+        yield
+        returncode = 0
+    finally:
+        rec = rusage_fields(resource.getrusage(resource.RUSAGE_SELF),
+                            before_self)
+        children = rusage_fields(resource.getrusage(resource.RUSAGE_CHILDREN),
+                                 before_children)
+        for field in ["user", "sys", "cpu", "read_bytes", "write_bytes"]:
+            rec[field] += children[field]
+        rec["maxrss_kb"] = max(rec["maxrss_kb"], children["maxrss_kb"])
+        io = _proc_io(os.getpid())
+        if io is not None and io_before is not None:
+            for field in IO_FIELDS:
+                rec[field] = io[field] - io_before[field]
+        rec.update(step=name, target=os.environ.get("STEPLOG_TARGET"),
+                   command=" ".join(sys.argv), start=start,
+                   wall=time.time() - start, tree_rss_kb=rec["maxrss_kb"],
+                   returncode=returncode, host=socket.gethostname())
+        append_record(logfile, rec)
+
+
+def program(command):
+    """Returns the program of shell command, the name of the script for
+    commands like bash -x script.sh or python script.py."""
+    words = command.split()
+    while len(words) > 1 and (re.match(r"^\w+=", words[0]) or
+                              words[0].startswith("-") or
+                              words[0].isdigit() or
+                              os.path.basename(words[0]) in WRAPPERS):
+        words = words[1:]
+    return(os.path.basename(words[0]) if len(words) > 0 else "")
+
+
+def read_records(logfiles):
+    """Yields the records in logfiles, skipping lines that are cut off."""
+    for logfile in logfiles:
+        for line in open(logfile):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def format_size(kb):
+    if kb >= 1024 ** 2:
+        return("%.1fG" % (kb / 1024.0 ** 2))
+    return("%.0fM" % (kb / 1024.0))
+
+
+def format_bytes(b):
+    return(format_size(b / 1024.0))
+
+
+def report(logfiles, top=20, out=sys.stdout):
+    """Writes the top slowest steps in logfiles and the totals per program
+    to out."""
+    records = list(read_records(logfiles))
+    for rec in records:
+        # Steps of Python scripts are named like "coverage sample1.bam"
+        rec["program"] = (rec.get("step") or "").split(" ", 1)[0] or \
+            program(rec.get("command") or "")
+    out.write("# %i slowest of %i steps\n" % (min(top, len(records)),
+                                              len(records)))
+    out.write("wall\tcpu\tmaxrss\ttree_rss\tread\twrite\tstatus\tstep\t"
+              "command\n")
+    for rec in sorted(records, key=lambda r: -r["wall"])[:top]:
+        out.write("%.1f\t%.1f\t%s\t%s\t%s\t%s\t%i\t%s\t%s\n" % (
+            rec["wall"], rec["cpu"], format_size(rec["maxrss_kb"]),
+            format_size(rec["tree_rss_kb"]),
+            format_bytes(max(rec["read_bytes"], rec.get("rchar", 0))),
+            format_bytes(max(rec["write_bytes"], rec.get("wchar", 0))),
+            rec["returncode"], rec.get("step") or rec.get("target") or "-",
+            (rec.get("command") or "")[:100]))
+
+    totals = {}
+    for rec in records:
+        t = totals.setdefault(rec["program"], dict(n=0, wall=0.0, cpu=0.0,
+                                                   maxrss_kb=0))
+        t["n"] += 1
+        t["wall"] += rec["wall"]
+        t["cpu"] += rec["cpu"]
+        t["maxrss_kb"] = max(t["maxrss_kb"], rec["tree_rss_kb"])
+    out.write("\n# Totals per program\n")
+    out.write("wall\tcpu\tmaxrss\tsteps\tprogram\n")
+    for name, t in sorted(totals.iteritems(), key=lambda x: -x[1]["wall"]):
+        out.write("%.1f\t%.1f\t%s\t%i\t%s\n" % (t["wall"], t["cpu"],
+                                               format_size(t["maxrss_kb"]),
+                                               t["n"], name))
+
+
+def shell_main(argv):
+    """Runs make recipe line argv[-1] like /bin/sh and records it in
+    $STEPLOG. make calls SHELL as SHELL -c line, or -ec with .POSIX."""
+    returncode, rec = run_command(argv[-1], shell=True)
+    rec.update(step=None, target=os.environ.get("STEPLOG_TARGET"),
+               command=argv[-1])
+    logfile = os.environ.get("STEPLOG")
+    if logfile:
+        try:
+            append_record(logfile, rec)
+        except (IOError, OSError), e:
+            sys.stderr.write("Could not record step in %s: %s\n" %
+                             (logfile, e))
+    return(returncode if returncode >= 0 else 128 - returncode)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1].startswith("-") and \
+            sys.argv[1].endswith("c"):
+        sys.exit(shell_main(sys.argv))
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="Run and record a command")
+    run_parser.add_argument("--log", default=os.environ.get("STEPLOG"),
+                            help="Log file to append the record to "
+                            "[$STEPLOG]\n")
+    run_parser.add_argument("--step", default=None,
+                            help="Name of the step, used to total the steps "
+                            "in the report [the program]\n")
+    run_parser.add_argument("args", nargs=argparse.REMAINDER,
+                            help="Command to run\n")
+    report_parser = subparsers.add_parser(
+        "report", help="Report the slowest steps")
+    report_parser.add_argument("logfiles", nargs="+", help="Log files\n")
+    report_parser.add_argument("--top", type=int, default=20,
+                               help="Number of slowest steps to report "
+                               "[20]\n")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        from signal import signal, SIGPIPE, SIG_DFL
+        signal(SIGPIPE, SIG_DFL)
+        report(args.logfiles, args.top)
+        sys.exit(0)
+
+    cmd = args.args[1:] if args.args[:1] == ["--"] else args.args
+    if len(cmd) == 0:
+        run_parser.error("No command given")
+    if not args.log:
+        run_parser.error("No log file given with --log or STEPLOG")
+    returncode, rec = run_command(cmd)
+    rec.update(step=args.step, target=os.environ.get("STEPLOG_TARGET"),
+               command=" ".join(cmd))
+    append_record(args.log, rec)
+    sys.exit(returncode if returncode >= 0 else 128 - returncode)
@@ -8,134 +8,328 @@ metassemble to determine contig coverage from a bam file and a fasta file.
 import sys
 import os
 import argparse
+import hashlib
 import subprocess
+import zipfile
+import multiprocessing
+from array import array
+
+import numpy
 from signal import signal, SIGPIPE, SIG_DFL
 
-from Bio import SeqIO, SeqUtils
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+from contigstats import gc_and_lengths, gc_percentages
+from steplog import step
+
+# Number of contigs formatted at a time when writing the table
+TABLE_CHUNK_SIZE = 10000
 
+COVERAGE_CACHE_SUFFIX = ".cov.npz"
+COVERAGE_CACHE_VERSION = 1
 
-def get_gc_and_len_dict(fastafile):
-    """Creates a dictionary with the fasta id as key and GC and length as keys
-    for the inner dictionary."""
-    out_dict = {}
 
-    for rec in SeqIO.parse(fastafile, "fasta"):
-        out_dict[rec.id] = {}
-        out_dict[rec.id]["length"] = len(rec.seq)
-        out_dict[rec.id]["GC"] = SeqUtils.GC(rec.seq)
+def parse_bedcov(lines):
+    """Parses the BEDTools genomeCoverageBed histogram output line by line to
+    determine mean coverage and percentage covered for each contig, so the
+    histogram is never held in memory.
 
-    return out_dict
+    Returns a tuple (contigs, cov_mean, percentage_covered) with the contig
+    names in order of appearance and arrays of their mean coverage and
+    percentage covered, where NaN marks a value without histogram lines."""
+    contigs = []
+    index = {}
+    cov_mean = array("d")
+    percentage_covered = array("d")
+    nan = float("nan")
 
+    for line in lines:
+        cols = line.split()
 
-def get_bedcov_dict(bedcoverage):
+        try:
+            i = index[cols[0]]
+        except KeyError:
+            i = len(contigs)
+            index[cols[0]] = i
+            contigs.append(cols[0])
+            cov_mean.append(nan)
+            percentage_covered.append(nan)
+
+        if int(cols[1]) == 0:
+            percentage_covered[i] = 100 - float(cols[4]) * 100.0
+        else:
+            cm = cov_mean[i]
+            cov_mean[i] = (0 if cm != cm else cm) + int(cols[1]) * float(cols[4])
+
+    return contigs, cov_mean, percentage_covered
+
+
+def get_bedcov(bedcoverage):
     """Uses the BEDTools genomeCoverageBed histogram output to determine mean
     coverage and percentage covered for each contig.
 
-    Returns dict with fasta id as key and percentage covered and cov_mean as
-    keys for the inner dictionary."""
-    out_dict = {}
-
+    Returns a tuple like parse_bedcov."""
     # Check if given argument is a file, otherwise use the content of the
     # variable
     if os.path.isfile(bedcoverage):
-        fh = open(bedcoverage)
+        with open(bedcoverage) as fh:
+            return parse_bedcov(fh)
     else:
-        fh = bedcoverage.split('\n')[:-1]
+        return parse_bedcov(bedcoverage.split('\n')[:-1])
+
+
+def bedtools_coverage(bamfile):
+    """Runs genomeCoverageBed on bamfile and parses its output while it is
+    running. Returns a tuple like parse_bedcov."""
+    # Buffer the pipe, unbuffered readline reads one byte at a time
+    p = subprocess.Popen(["genomeCoverageBed", "-ibam", bamfile], stdout=subprocess.PIPE,
+        bufsize=1024 * 1024)
+    try:
+        result = parse_bedcov(iter(p.stdout.readline, ""))
+    finally:
+        p.stdout.close()
+        p.wait()
+    if p.returncode != 0:
+        raise Exception('Error with genomeCoverageBed on %s' % bamfile)
+
+    return result
+
+
+def get_coverages(bamfiles, engine="pysam", processes=1):
+    """Determines mean coverage and percentage covered for each contig in each
+    bam file, in-process with pysam or with genomeCoverageBed. Up to processes
+    bam files are done at the same time, each in its own process that parses
+    the coverage as it is computed.
+
+    Returns a list of tuples like parse_bedcov, one for each bam file."""
+    jobs = [(engine, bf) for bf in bamfiles]
+    if processes > 1 and len(bamfiles) > 1:
+        pool = multiprocessing.Pool(min(processes, len(bamfiles)))
+        try:
+            results = pool.map(bam_file_coverage, jobs)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [bam_file_coverage(job) for job in jobs]
+
+    return results
+
+
+def bam_file_coverage(job):
+    """Returns the coverage of the bam file of job, a tuple (engine,
+    bamfile), like parse_bedcov. Recorded as a step in $STEPLOG if set."""
+    engine, bamfile = job
+    with step("coverage %s" % os.path.basename(bamfile)):
+        if engine == "pysam":
+            # Only the in-process coverage engine requires pysam
+            from bamcoverage import bam_coverage
+            return bam_coverage(bamfile)
+        return bedtools_coverage(bamfile)
+
+
+def coverage_matrices(contigs, coverages):
+    """Returns two contigs x samples matrices with the mean coverage and the
+    percentage covered of contigs in every sample, from coverages, a list of
+    tuples like parse_bedcov. Values for contigs without histogram lines are
+    NaN, contigs that are not in contigs are ignored."""
+    index = dict((c, i) for i, c in enumerate(contigs))
+    cov_mean = numpy.empty((len(contigs), len(coverages)))
+    cov_mean.fill(numpy.nan)
+    percentage_covered = cov_mean.copy()
+
+    for j, (names, cm, pc) in enumerate(coverages):
+        rows = numpy.array([index.get(n, -1) for n in names], dtype=numpy.int64)
+        found = rows >= 0
+        cov_mean[rows[found], j] = numpy.asarray(cm)[found]
+        percentage_covered[rows[found], j] = numpy.asarray(pc)[found]
+
+    return cov_mean, percentage_covered
+
+
+def contig_set_digest(contigs, lengths):
+    """Returns the md5 of the names and lengths of contigs, which identifies
+    the rows of the coverage matrices."""
+    md5 = hashlib.md5()
+    for c, l in zip(contigs, lengths.tolist()):
+        md5.update("%s\t%i\n" % (c, l))
+
+    return md5.hexdigest()
+
+
+def coverage_cache_file(bamfile, cache_dir=None):
+    """Returns the coverage cache file of bamfile, next to bamfile or in
+    cache_dir."""
+    if cache_dir is None:
+        return bamfile + COVERAGE_CACHE_SUFFIX
+    # Bam files in different directories can have the same name
+    return os.path.join(cache_dir, "%s.%s%s" % (os.path.basename(bamfile),
+        hashlib.md5(os.path.abspath(bamfile)).hexdigest()[:8], COVERAGE_CACHE_SUFFIX))
+
+
+def coverage_cache_key(bamfile, digest):
+    """Returns the string identifying bamfile and the contig set with digest
+    in a coverage cache file."""
+    st = os.stat(bamfile)
+    return "#version=%i\tsize=%i\tmtime=%r\tinode=%i\tcontigs=%s" % (
+        COVERAGE_CACHE_VERSION, st.st_size, st.st_mtime, st.st_ino, digest)
+
+
+def read_coverage_cache(bamfile, cachefile, digest):
+    """Returns the cached (cov_mean, percentage_covered) columns of bamfile or
+    None if there is no cache file or if it belongs to a different version of
+    bamfile or a different contig set."""
+    # numpy.load doesn't clean up after failing on a truncated file
+    if not zipfile.is_zipfile(cachefile):
+        return None
+    try:
+        with numpy.load(cachefile) as cache:
+            if str(cache["key"]) != coverage_cache_key(bamfile, digest):
+                return None
+            return cache["cov_mean"], cache["percentage_covered"]
+    except (IOError, KeyError, ValueError, zipfile.BadZipfile):
+        return None
+
+
+def write_coverage_cache(bamfile, cachefile, digest, cov_mean, percentage_covered):
+    """Writes the coverage columns of bamfile to cachefile. The file is
+    written to a temporary file first and renamed, so readers never see a
+    partial cache. Nothing is cached if the directory is not writable."""
+    tmpfile = "%s.tmp.%i.npz" % (cachefile, os.getpid())
+    try:
+        numpy.savez(tmpfile, key=numpy.array(coverage_cache_key(bamfile, digest)),
+                    cov_mean=cov_mean, percentage_covered=percentage_covered)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError), err:
+        sys.stderr.write("Not caching coverage in %s: %s\n" % (cachefile, err))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def cached_coverage_matrices(contigs, lengths, bamfiles, engine="pysam", processes=1, append=False, cache=True, cache_dir=None):
+    """Returns the coverage matrices of contigs like coverage_matrices. With
+    append, the columns of bam files with an up to date coverage cache are
+    read from the cache and only the other bam files are computed. With cache,
+    the computed columns are written to the cache of each bam file."""
+    digest = contig_set_digest(contigs, lengths)
+    cov_mean = numpy.empty((len(contigs), len(bamfiles)))
+    percentage_covered = numpy.empty((len(contigs), len(bamfiles)))
+
+    todo = []
+    for j, bf in enumerate(bamfiles):
+        cached = None
+        if append:
+            cachefile = coverage_cache_file(bf, cache_dir)
+            cached = read_coverage_cache(bf, cachefile, digest)
+        if cached is None:
+            todo.append(j)
+        else:
+            sys.stderr.write("Coverage cache hit: %s\n" % cachefile)
+            cov_mean[:, j], percentage_covered[:, j] = cached
 
-    for line in fh:
-        cols = line.split()
+    cm, pc = coverage_matrices(contigs, get_coverages([bamfiles[j] for j in todo], engine, processes))
+    cov_mean[:, todo] = cm
+    percentage_covered[:, todo] = pc
+    if cache:
+        for k, j in enumerate(todo):
+            write_coverage_cache(bamfiles[j], coverage_cache_file(bamfiles[j], cache_dir),
+                                 digest, cm[:, k], pc[:, k])
 
-        try:
-            d = out_dict[cols[0]]
-        except KeyError:
-            d = {}
-            out_dict[cols[0]] = d
+    return cov_mean, percentage_covered
 
-        if int(cols[1]) == 0:
-            d["percentage_covered"] = 100 - float(cols[4]) * 100.0
-        else:
-            d["cov_mean"] = d.get("cov_mean", 0) + int(cols[1]) * float(cols[4])
 
-    return out_dict
+def fill_missing(cov_mean, percentage_covered):
+    """Returns cov_mean and percentage_covered with the NaN values replaced
+    by what they stand for: no coverage for contigs without reads and 100
+    percent covered for contigs without bases at depth 0."""
+    no_reads = numpy.isnan(cov_mean)
+    return (numpy.where(no_reads, 0, cov_mean),
+            numpy.where(numpy.isnan(percentage_covered),
+                        numpy.where(no_reads, 0, 100), percentage_covered))
 
 
-def print_sample_columns(t, header="cov_mean_sample_"):
-    sys.stdout.write((("\t" + header + "%s") * len(t)) % t)
+def sample_columns(samples):
+    """Returns the names of the coverage columns of the table."""
+    return (["cov_mean_sample_%s" % s for s in samples] +
+            ["percentage_covered_sample_%s" % s for s in samples])
 
 
-def print_input_table(fastadict, bedcovdicts, samplenames=None):
+def print_input_table(contigs, lengths, gc, cov_mean, percentage_covered, samplenames=None, chunk_size=TABLE_CHUNK_SIZE):
     """Writes the input table for Probin to stdout. See hackathon google
-    docs."""
+    docs. The rows are formatted chunk_size contigs at a time."""
+    nr_samples = cov_mean.shape[1]
 
     # Header
-    sys.stdout.write("contig\tlength\tGC")
     if samplenames is None:
         # Use index if no sample names given in header
-        print_sample_columns(tuple(range(len(bedcovdicts))), "cov_mean_sample_")
-        print_sample_columns(tuple(range(len(bedcovdicts))), "percentage_covered_sample_")
+        samplenames = range(nr_samples)
     else:
         # Use given sample names in header
-        assert(len(samplenames) == len(bedcovdicts))
-        print_sample_columns(tuple(samplenames), "cov_mean_sample_")
-        print_sample_columns(tuple(samplenames), "percentage_covered_sample_")
-    sys.stdout.write("\n")
+        assert(len(samplenames) == nr_samples)
+    sys.stdout.write("\t".join(["contig", "length", "GC"] + sample_columns(samplenames)) + "\n")
 
     # Content
-    assert(len(fastadict) > 0)
-    for acc in fastadict:
-        # fasta stats
-        sys.stdout.write("%s\t%d\t%f" %
-            (
-                acc,
-                fastadict[acc]['length'],
-                fastadict[acc]['GC']
-            )
-        )
-
-        # Print mean
-        for bcd in bedcovdicts:
-            try:
-                # Print cov mean
-                sys.stdout.write("\t%f" % (bcd[acc]["cov_mean"]))
-            except KeyError:
-                # No reads mapped to this contig
-                sys.stdout.write("\t0")
-
-        # Print percentage covered
-        for bcd in bedcovdicts:
-            try:
-                # Print percentage covered
-                sys.stdout.write("\t%f" % (bcd[acc]["percentage_covered"]))
-            except KeyError:
-                if acc in bcd and "cov_mean" in bcd[acc]:
-                    # all reads were covered
-                    sys.stdout.write("\t100")
-                else:
-                    # No reads mapped to this contig
-                    sys.stdout.write("\t0")
-
-        sys.stdout.write("\n")
-
-
-def gen_contig_cov_per_bam_table(fastafile, bamfiles, samplenames=None, isbedfiles=False):
-    """Reads input files into dictionaries then prints everything in the table
-    format required for running ProBin."""
-    bedcovdicts = []
-
-    # Determine coverage information from bam file using BEDTools
-    for i, bf in enumerate(bamfiles):
-        if isbedfiles is False:
-            p = subprocess.Popen(["genomeCoverageBed", "-ibam", bf], stdout=subprocess.PIPE)
-            out, err = p.communicate()
-            if p.returncode != 0:
-                sys.stderr.write(out)
-                raise Exception('Error with genomeCoverageBed')
-            else:
-                bedcovdicts.append(get_bedcov_dict(out))
-        else:
-            bedcovdicts.append(get_bedcov_dict(bf))
-
-    print_input_table(get_gc_and_len_dict(fastafile), bedcovdicts, samplenames=samplenames)
+    assert(len(contigs) > 0)
+    row_format = "\t%d\t%f" + "\t%f" * (2 * nr_samples) + "\n"
+    for s in range(0, len(contigs), chunk_size):
+        e = min(s + chunk_size, len(contigs))
+        cm = cov_mean[s:e]
+        # Contigs without bases at depth 0 are fully covered if they have
+        # reads. Mark those with inf to print 100.
+        pc = numpy.where(numpy.isnan(percentage_covered[s:e]) & ~numpy.isnan(cm),
+                         numpy.inf, percentage_covered[s:e])
+        rows = numpy.column_stack((lengths[s:e], gc[s:e], cm, pc)).tolist()
+        block = "".join([c + row_format % tuple(r) for c, r in zip(contigs[s:e], rows)])
+        # No reads mapped to a contig prints 0, all bases covered prints 100
+        sys.stdout.write(block.replace("\tnan", "\t0").replace("\tinf", "\t100"))
+
+
+def write_binary_table(prefix, contigs, lengths, gc, cov_mean, percentage_covered, samplenames=None, formats=("npy",)):
+    """Writes the coverage matrices as float32 with the missing values filled
+    in. npy writes prefix.cov_mean.npy and prefix.percentage_covered.npy with
+    the contig names in prefix.contigs.txt and the sample names in
+    prefix.samples.txt. parquet writes the whole table to prefix.parquet,
+    which requires pyarrow."""
+    if samplenames is None:
+        samplenames = range(cov_mean.shape[1])
+    cov_mean, percentage_covered = [m.astype(numpy.float32) for m in
+                                    fill_missing(cov_mean, percentage_covered)]
+
+    if "npy" in formats:
+        numpy.save(prefix + ".cov_mean.npy", cov_mean)
+        numpy.save(prefix + ".percentage_covered.npy", percentage_covered)
+        with open(prefix + ".contigs.txt", "w") as fh:
+            fh.writelines(c + "\n" for c in contigs)
+        with open(prefix + ".samples.txt", "w") as fh:
+            fh.writelines("%s\n" % s for s in samplenames)
+    if "parquet" in formats:
+        import pyarrow
+        import pyarrow.parquet
+        arrays = [pyarrow.array(contigs, type=pyarrow.string()),
+                  pyarrow.array(lengths), pyarrow.array(gc)]
+        arrays += [pyarrow.array(m[:, j]) for m in (cov_mean, percentage_covered)
+                   for j in range(m.shape[1])]
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(
+            arrays, ["contig", "length", "GC"] + sample_columns(samplenames)),
+            prefix + ".parquet")
+
+
+def gen_contig_cov_per_bam_table(fastafile, bamfiles, samplenames=None, isbedfiles=False, processes=1, engine="pysam", binary_prefix=None, binary_formats=("npy",), append=False, cache=True, cache_dir=None):
+    """Reads input files into contigs x samples matrices then prints everything
+    in the table format required for running ProBin. The contigs are in the
+    order of fastafile. See cached_coverage_matrices for append, cache and
+    cache_dir."""
+    contigs, lengths, gc_counts = gc_and_lengths(fastafile, processes)
+    gc = gc_percentages(lengths, gc_counts)
+    if isbedfiles:
+        cov_mean, percentage_covered = coverage_matrices(contigs, [get_bedcov(bf) for bf in bamfiles])
+    else:
+        cov_mean, percentage_covered = cached_coverage_matrices(contigs, lengths, bamfiles, engine, processes, append, cache, cache_dir)
+    print_input_table(contigs, lengths, gc, cov_mean, percentage_covered, samplenames=samplenames)
+    if binary_prefix is not None:
+        write_binary_table(binary_prefix, contigs, lengths, gc, cov_mean,
+                           percentage_covered, samplenames, binary_formats)
 
 
 if __name__ == "__main__":
@@ -145,7 +339,28 @@ if __name__ == "__main__":
     parser.add_argument("--samplenames", default=None, help="File with sample names, one line each. Should be same nr as bamfiles.")
     parser.add_argument("--isbedfiles", action='store_true',
         help="The bamfiles argument are outputs of genomeCoverageBed, not the actual bam file. Skips running genomeCoverageBed from within this script.")
+    parser.add_argument("--processes", type=int, default=1,
+        help="Number of processes to compute GC and length of the contigs and the coverage of the bam files with. Coverage is computed for this many bam files at the same time, also with genomeCoverageBed (default 1)")
+    parser.add_argument("--coverage-engine", choices=["pysam", "bedtools"], default="pysam",
+        help="Compute coverage in-process with pysam or with genomeCoverageBed from BEDTools. Both give the same numbers for bam files sorted by coordinate (default pysam)")
+    parser.add_argument("--binary-prefix", default=None,
+        help="Also write the coverage matrices in binary formats to files starting with this prefix, see --binary-formats")
+    parser.add_argument("--binary-formats", nargs="+", default=["npy"], choices=["npy", "parquet"],
+        help="Binary formats for --binary-prefix. npy writes float32 contigs x samples matrices PREFIX.cov_mean.npy and PREFIX.percentage_covered.npy with PREFIX.contigs.txt and PREFIX.samples.txt, parquet writes the table to PREFIX.parquet and requires pyarrow (default npy)")
+    parser.add_argument("--append", action="store_true",
+        help="Add samples to a table made before: read the coverage of bam files that have an up to date coverage cache from the cache and only compute the coverage of the other bam files. Give all bam files, old and new, in the order of the columns")
+    parser.add_argument("--no-cache", action="store_true",
+        help="Don't write the coverage of each bam file to its coverage cache file")
+    parser.add_argument("--cache-dir", default=None,
+        help="Directory for the coverage cache files, instead of next to the bam files, which is the default. The cache of a bam file is keyed on the bam file and the contigs of fastafile")
     args = parser.parse_args()
+    if args.append and args.no_cache:
+        parser.error("--append reads the coverage cache, it can't be used with --no-cache")
+    if args.binary_prefix is not None and "parquet" in args.binary_formats:
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("--binary-formats parquet requires pyarrow")
 
     # Get sample names
     if args.samplenames is not None:
@@ -160,4 +375,7 @@ if __name__ == "__main__":
     signal(SIGPIPE, SIG_DFL)
 
     gen_contig_cov_per_bam_table(args.fastafile, args.bamfiles,
-        samplenames=samplenames, isbedfiles=args.isbedfiles)
+        samplenames=samplenames, isbedfiles=args.isbedfiles,
+        processes=args.processes, engine=args.coverage_engine,
+        binary_prefix=args.binary_prefix, binary_formats=args.binary_formats,
+        append=args.append, cache=not args.no_cache, cache_dir=args.cache_dir)
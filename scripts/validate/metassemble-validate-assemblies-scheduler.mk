@@ -16,6 +16,13 @@ endif
 
 include $(ASSEMBLY_MAKEFILE)
 
+# Runtime in minutes of the validation of one assembly, used to pack them in
+# jobs of SCHEDULER_PACK_RUNTIME minutes, see lib/scheduler.mk. The nucmer
+# alignment and asm-stats of an assembly share a pack.
+SCHEDULER_NUCMER_RUNTIME?=30
+SCHEDULER_MASMVALI_RUNTIME?=30
+SCHEDULER_KRAKEN_RUNTIME?=30
+
 ################################
 # --------- ref stats ---------#
 ################################
@@ -29,22 +36,22 @@ $(OUT)/reference-stats/ref.stats: $(FASTQ1) $(FASTQ2) $(REF)
 # --------- nucmer ------------#
 ################################
 %/val/nucmer.coords: %/bambus2.scaffold.linear.fasta $(REF)
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NUCMER_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NUCMER_OPT),make -kef $(MAKEFILE_VALIDATE),nucmer,$(SCHEDULER_NUCMER_RUNTIME))
 %/val/nucmer.coords: %/$(CONTIG_FILENAME) $(REF)
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NUCMER_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NUCMER_OPT),make -kef $(MAKEFILE_VALIDATE),nucmer,$(SCHEDULER_NUCMER_RUNTIME))
 %/val/nucmer.coords: %/$(SCAF_FILENAME) $(REF)
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NUCMER_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NUCMER_OPT),make -kef $(MAKEFILE_VALIDATE),nucmer,$(SCHEDULER_NUCMER_RUNTIME))
 %/val/nucmer.coords: %/$(MERGE_FILENAME) $(REF)
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NUCMER_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_NUCMER_OPT),make -kef $(MAKEFILE_VALIDATE),nucmer,$(SCHEDULER_NUCMER_RUNTIME))
 
 %/val/asm-stats.tsv: %/bambus2.scaffold.linear.fasta %/val/nucmer.coords $(REF) $(PHYL_REF) $(CON_TO_REF) $(OUT)/reference-stats/ref.stats
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MASMVALI_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MASMVALI_OPT),make -kef $(MAKEFILE_VALIDATE),nucmer,$(SCHEDULER_MASMVALI_RUNTIME))
 %/val/asm-stats.tsv: %/$(CONTIG_FILENAME) %/val/nucmer.coords $(REF) $(PHYL_REF) $(CON_TO_REF) $(OUT)/reference-stats/ref.stats
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MASMVALI_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MASMVALI_OPT),make -kef $(MAKEFILE_VALIDATE),nucmer,$(SCHEDULER_MASMVALI_RUNTIME))
 %/val/asm-stats.tsv: %/$(SCAF_FILENAME) %/val/nucmer.coords $(REF) $(PHYL_REF) $(CON_TO_REF) $(OUT)/reference-stats/ref.stats
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MASMVALI_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MASMVALI_OPT),make -kef $(MAKEFILE_VALIDATE),nucmer,$(SCHEDULER_MASMVALI_RUNTIME))
 %/val/asm-stats.tsv: %/$(MERGE_FILENAME) %/val/nucmer.coords $(REF) $(PHYL_REF) $(CON_TO_REF) $(OUT)/reference-stats/ref.stats
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MASMVALI_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_MASMVALI_OPT),make -kef $(MAKEFILE_VALIDATE),nucmer,$(SCHEDULER_MASMVALI_RUNTIME))
 ################################
 # ---------/nucmer ------------#
 ################################
@@ -66,11 +73,11 @@ $(OUT)/reference-stats/ref.stats: $(FASTQ1) $(FASTQ2) $(REF)
 # --------- kraken ------------#
 ################################
 %/kraken/kraken.tsv: %/$(CONTIG_FILENAME) $(KRAKEN_DB)
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_KRAKEN_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_KRAKEN_OPT),make -kef $(MAKEFILE_VALIDATE),kraken,$(SCHEDULER_KRAKEN_RUNTIME))
 %/kraken/kraken.tsv: %/$(MERGE_FILENAME) $(KRAKEN_DB)
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_KRAKEN_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_KRAKEN_OPT),make -kef $(MAKEFILE_VALIDATE),kraken,$(SCHEDULER_KRAKEN_RUNTIME))
 %/kraken/kraken.tsv: %/$(SCAF_FILENAME) $(KRAKEN_DB)
-	$(call schedule_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_KRAKEN_OPT),make -ef $(MAKEFILE_VALIDATE) $@)
+	$(call schedule_packed_with_deps_and_store_id,$(SCHEDULER_STD_OPT) $(SCHEDULER_KRAKEN_OPT),make -kef $(MAKEFILE_VALIDATE),kraken,$(SCHEDULER_KRAKEN_RUNTIME))
 ################################
 # ---------/kraken ------------#
 ################################
@@ -84,11 +91,13 @@ validateexisting: \
 	$(subst $(MERGE_FILENAME),val/asm-stats.tsv,\
 	$(subst $(SCAF_FILENAME),val/asm-stats.tsv,\
 	$(subst $(CONTIG_FILENAME),val/asm-stats.tsv,$(wildcard $(ALLASMCONTIGS) $(ALLASMSCAFFOLDS))))))
+	$(schedule_pending_pack)
 .PHONY:
 validateall: \
 	$(subst bambus2.scaffold.linear.fasta,val/asm-stats.tsv,\
 	$(subst $(MERGE_FILENAME),val/asm-stats.tsv,\
 	$(subst $(SCAF_FILENAME),val/asm-stats.tsv,\
 	$(subst $(CONTIG_FILENAME),val/asm-stats.tsv,$(ALLASMCONTIGS) $(ALLASMSCAFFOLDS)))))
+	$(schedule_pending_pack)
 
 .PRECIOUS: %/val/nucmer.coords
@@ -114,4 +114,19 @@ validateall: \
 	$(subst $(SCAF_FILENAME),val/asm-stats.tsv,\
 	$(subst $(CONTIG_FILENAME),val/asm-stats.tsv,$(ALLASMCONTIGS) $(ALLASMSCAFFOLDS)))))
 
+# Validate all existing assemblies with coords-stats in one process, the read
+# to reference map of the reference BAM file is only loaded once for all
+# assemblies. Bambus2 scaffolds are skipped, there are no reads mapped to them.
+COORDS_STATS_ASMS=$(filter-out %/bambus2.scaffold.linear.fasta,$(wildcard $(ALLASMCONTIGS) $(ALLASMSCAFFOLDS)))
+COORDS_STATS_OPT?=--processes $(THREADS)
+.PHONY:
+coordsstatsexisting: $(OUT)/reference-stats/ref.stats $(PHYL_REF) \
+	$(foreach asm,$(COORDS_STATS_ASMS),$(dir $(asm))val/nucmer.coords $(dir $(asm))val/map/bowtie2/asm_$(FASTQBASE)-smds.bam)
+	mkdir -p $(OUT)/coords-stats
+	printf '%b\n' $(foreach asm,$(COORDS_STATS_ASMS),'$(dir $(asm))val/nucmer.coords\t$(asm)\t$(dir $(asm))val/map/bowtie2/asm_$(FASTQBASE)-smds.bam\t$(dir $(asm))val/coords-stats\t$(patsubst $(OUT)/%/,%,$(dir $(asm)))') \
+		> $(OUT)/coords-stats/assemblies.tsv
+	python $(SCRIPTDIR)/validate/nucmer/stats/coords-stats-batch.py $(COORDS_STATS_OPT) \
+		$(OUT)/coords-stats/assemblies.tsv $(OUT)/reference-stats/ref.stats $(PHYL_REF) \
+		$(OUT)/reference-stats/ref_$(FASTQBASE)-smds.bam
+
 .PRECIOUS: %/val/nucmer.coords
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Validates several assemblies of the same reads with coords-stats.py in one
+process. The reference side data, i.e. the map of reads to references from the
+reference BAM file, the reference stats and the reference phylogeny, is loaded
+once and shared by all assemblies instead of being loaded again for every
+assembly.
+
+The assemblies are given in a tab separated table with one assembly per line
+and the columns coords, contigs, bamasm and outdir, optionally followed by
+name, asm_type, kmer_type, kmer_size, kmin and kmax. Lines starting with # are
+skipped.
+
+The assemblies are validated without plots. The plots and the HTML report of
+every validated assembly are made at the end, from the tables written by the
+validation, so plotting doesn't hold up the validations.
+"""
+import argparse
+import os
+import sys
+import imp
+import time
+import traceback
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "..", ".."))
+from steplog import step
+
+coords_stats = imp.load_source("coords_stats",
+                               os.path.join(os.path.dirname(
+                                   os.path.realpath(__file__)),
+                                   "coords-stats.py"))
+
+ASSEMBLY_COLUMNS = ["coords", "contigs", "bamasm", "outdir", "name",
+                    "asm_type", "kmer_type", "kmer_size", "kmin", "kmax"]
+
+# Reference side data and options shared with the worker processes, which
+# inherit them when the pool is forked
+_reference = None
+_options = None
+
+
+def read_assemblies(tablefile):
+    """Returns a list of dictionaries with the columns of every assembly in
+    tablefile. Missing optional columns are "-"."""
+    assemblies = []
+    for i, line in enumerate(open(tablefile), 1):
+        if line.startswith("#") or line.strip() == "":
+            continue
+        cols = line.rstrip("\n").split("\t")
+        if not 4 <= len(cols) <= len(ASSEMBLY_COLUMNS):
+            raise ValueError("Line %i of %s has %i columns, expected %i to %i"
+                             % (i, tablefile, len(cols), 4,
+                                len(ASSEMBLY_COLUMNS)))
+        cols += ["-"] * (len(ASSEMBLY_COLUMNS) - len(cols))
+        assemblies.append(dict(zip(ASSEMBLY_COLUMNS, cols)))
+
+    return(assemblies)
+
+
+def validate(assembly):
+    """Validates one assembly with the shared reference side data. Returns
+    the output directory, the number of seconds it took and the traceback if
+    the validation failed, so one failed assembly doesn't stop the others."""
+    start = time.time()
+    try:
+        with step("coords-stats %s" % assembly["outdir"]):
+            contig_ref_map = coords_stats.count_refs_per_contig(
+                assembly["bamasm"], _reference["refmap"], _options["cut_off"])
+            coords_stats.validate_assembly(
+                assembly["coords"], assembly["contigs"], assembly["bamasm"],
+                assembly["outdir"], _reference, contig_ref_map,
+                assembly["name"], assembly["asm_type"], assembly["kmer_type"],
+                assembly["kmer_size"], assembly["kmin"], assembly["kmax"],
+                _options["cut_off"], _options["purity_formats"], ())
+    except Exception:
+        return(assembly["outdir"], time.time() - start, traceback.format_exc())
+
+    return(assembly["outdir"], time.time() - start, None)
+
+
+def report(outdir):
+    """Makes the plots and the HTML report of the assembly validated into
+    outdir. Returns the traceback if that failed, None otherwise."""
+    try:
+        with step("coords-stats report %s" % outdir):
+            coords_stats.make_report(outdir, _options["plot_formats"])
+    except Exception:
+        return(traceback.format_exc())
+
+    return(None)
+
+
+def main(tablefile, refstatsfile, refphylfile, bamref, processes=1,
+         spill_dir=None, cut_off=100, purity_formats=(),
+         plot_formats=("png",)):
+    global _reference, _options
+    assemblies = read_assemblies(tablefile)
+
+    start = time.time()
+    with step("coords-stats-batch load reference"):
+        _reference = coords_stats.load_reference(refstatsfile, refphylfile,
+                                                 bamref)
+    _options = dict(cut_off=cut_off, purity_formats=purity_formats,
+                    plot_formats=plot_formats)
+    if spill_dir is not None:
+        spill_dir = tempfile.mkdtemp(prefix="readrefmap.", dir=spill_dir)
+    try:
+        with step("coords-stats-batch map reads to references"):
+            _reference["refmap"] = coords_stats.map_reads_to_refs(
+                bamref, spill_dir=spill_dir)
+        sys.stderr.write("Loaded reference side data in %.1fs\n" %
+                         (time.time() - start))
+
+        if processes > 1 and len(assemblies) > 1:
+            pool = multiprocessing.Pool(min(processes, len(assemblies)))
+            results = pool.imap_unordered(validate, assemblies)
+        else:
+            pool = None
+            results = itertools.imap(validate, assemblies)
+        failed = []
+        for outdir, seconds, error in results:
+            if error is None:
+                sys.stderr.write("Validated %s in %.1fs\n" % (outdir, seconds))
+            else:
+                sys.stderr.write("Validation of %s failed:\n%s" % (outdir,
+                                                                    error))
+                failed.append(outdir)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        # Plots and HTML reports of all validated assemblies at the end
+        if plot_formats:
+            for outdir in [a["outdir"] for a in assemblies if a["outdir"] not
+                           in failed]:
+                error = report(outdir)
+                if error is not None:
+                    sys.stderr.write("Report of %s failed:\n%s" % (outdir,
+                                                                   error))
+                    failed.append(outdir)
+    finally:
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir)
+
+    return(failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("assemblies", help="Tab separated table of the "
+                        "assemblies to validate\n")
+    parser.add_argument("refstats", help="Reference stats tsv file\n")
+    parser.add_argument("refphyl", help="Reference Phylogeny tsv file\n")
+    parser.add_argument(
+        "bamref", help="BAM file of the reads mapped against the reference\n")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of assemblies to validate at the same "
+                        "time. The reference side data is shared with the "
+                        "worker processes, not copied (default 1)\n")
+    parser.add_argument("--spill-dir", default=None,
+                        help="Keep the map of reads to references on disk in a "
+                        "temporary directory in this directory instead of in "
+                        "memory, for very large read sets\n")
+    parser.add_argument("--purity-formats", nargs="+", default=[],
+                        choices=["parquet", "feather"],
+                        help="Also write contig purity in these columnar "
+                        "formats next to contig-purity.tsv. Requires "
+                        "pyarrow\n")
+    parser.add_argument("--plot-formats", nargs="+", default=["png"],
+                        choices=["png", "pdf", "svg"],
+                        help="Formats to save the plots in, which are made "
+                        "after all assemblies are validated. The HTML "
+                        "reports are only made with png (default png)\n")
+    parser.add_argument("--no-plots", action="store_true",
+                        help="Don't make the plots and the HTML reports at "
+                        "the end\n")
+    args = parser.parse_args()
+    if len(args.purity_formats) > 0:
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("--purity-formats parquet and feather require "
+                         "pyarrow")
+    failed = main(args.assemblies,
+                  args.refstats,
+                  args.refphyl,
+                  args.bamref,
+                  processes=args.processes,
+                  spill_dir=args.spill_dir,
+                  purity_formats=args.purity_formats,
+                  plot_formats=[] if args.no_plots else args.plot_formats)
+    if len(failed) > 0:
+        sys.stderr.write("%i of the assemblies failed: %s\n" %
+                         (len(failed), " ".join(failed)))
+        sys.exit(1)
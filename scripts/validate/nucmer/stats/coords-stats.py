@@ -2,13 +2,26 @@ import argparse
 import sqlite3
 import re
 import os
+import sys
+import time
 import errno
+import hashlib
+import shutil
+import tempfile
+import itertools
+import multiprocessing
 import pysam
-import matplotlib.pyplot as plt
 import numpy
 from collections import Counter
 from collections import defaultdict  # is faster than Counter
 
+import intervals
+import readrefmap
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "..", ".."))
+from contigstats import assembly_stats
+
 #CONTIGS = "/bubo/glob/g16/inod/metagenomics/result/chris-mock/Project_ID793_dAmore/Sample_500pg_unbalanced/ma2-out/assemblies/velvet/noscaf/noscaf_31/contigs.fa"
 #COORDS = "/bubo/glob/g16/inod/metagenomics/result/chris-mock/Project_ID793_dAmore/Sample_500pg_unbalanced/ma2-out/assemblies/velvet/noscaf/noscaf_31/val/nucmer.coords"
 #REFSTATS = "/bubo/glob/g16/inod/metagenomics/result/chris-mock/Project_ID793_dAmore/Sample_500pg_unbalanced/ma2-out/reference-stats/ref.stats"
@@ -16,6 +29,44 @@ from collections import defaultdict  # is faster than Counter
 #BAMREF = "/bubo/glob/g16/inod/metagenomics/result/chris-mock/Project_ID793_dAmore/Sample_500pg_unbalanced/ma2-out/reference-stats/ref_500pg_unbalanced.qtrim-smds.bam"
 #BAMASM = "/bubo/glob/g16/inod/metagenomics/result/chris-mock/Project_ID793_dAmore/Sample_500pg_unbalanced/ma2-out/assemblies/velvet/noscaf/noscaf_31/bambus2/contigs_500pg_unbalanced-smds.bam"
 
+# Columns of show-coords -rclTH output, in order
+COORDS_COLUMNS = ('S1', 'E1', 'S2', 'E2', 'LEN1', 'LEN2', 'IDY', 'LENR',
+                  'LENQ', 'COVR', 'COVQ', 'REFID', 'QRYID')
+# NumPy types of the columns of the Coords table read by read_coords
+COORDS_DTYPES = dict(S1=numpy.int64, E1=numpy.int64, S2=numpy.int64,
+                     E2=numpy.int64, IDY=numpy.float64, LENQ=numpy.int64,
+                     COVQ=numpy.float64)
+# Version of the layout of the coords database. Increase when load_coords
+# changes, so databases cached by older versions are rebuilt.
+COORDS_DB_SCHEMA_VERSION = 1
+# Names of the taxonomic levels of the reference phylogeny in the output
+TAX_LVL_NAMES = dict(no_rank="life", topname="strain")
+# Columns of contig-purity.tsv. The header of the tsv keeps its historical
+# names, in which some unambiguous read counts are labeled amb_.
+CONTIG_PURITY_COLUMNS = (
+    "contig", "unamb_read_level_purity", "unamb_tot_nr_reads",
+    "unamb_dom_nr_reads", "unamb_dominant_strain", "amb_read_level_purity",
+    "amb_tot_nr_reads", "amb_dom_nr_reads", "amb_dominant_strain",
+    "max_aln_purity", "contig_length", "unamb_nr_reads_life",
+    "unamb_nr_reads_superkingdom", "unamb_nr_reads_superphylum",
+    "unamb_nr_reads_phylum", "unamb_nr_reads_class", "unamb_nr_reads_order",
+    "unamb_nr_reads_family", "unamb_nr_reads_genus",
+    "unamb_nr_reads_species", "unamb_nr_reads_strain", "unamb_lca",
+    "amb_nr_reads_life", "amb_nr_reads_superkingdom",
+    "amb_nr_reads_superphylum", "amb_nr_reads_phylum", "amb_nr_reads_class",
+    "amb_nr_reads_order", "amb_nr_reads_family", "amb_nr_reads_genus",
+    "amb_nr_reads_species", "amb_nr_reads_strain", "amb_lca")
+CONTIG_PURITY_TSV_HEADER = tuple(
+    c.replace("unamb_", "amb_") if c in ("unamb_nr_reads_superkingdom",
+                                         "unamb_nr_reads_phylum",
+                                         "unamb_nr_reads_order",
+                                         "unamb_nr_reads_genus") else c
+    for c in CONTIG_PURITY_COLUMNS)
+# Number of contigs per chunk of contig-purity output
+CONTIG_PURITY_CHUNK_SIZE = 100000
+# Runs of digits in read names, compared as numbers by samtools sort -n
+QNAME_DIGITS = re.compile(r"\d+")
+
 
 def make_dir(directory):
     """Make directory unless existing. Ignore error in the latter case."""
@@ -26,7 +77,273 @@ def make_dir(directory):
             raise
 
 
-def calc_genome_contig_cov_in_bases(cursor, cut_off=100):
+def parse_coords(coordsfile):
+    """Yields the columns of each alignment in a show-coords file as a tuple of
+    strings in the order of COORDS_COLUMNS. Type conversion is left to the
+    column affinity of the Coords table."""
+    ncols = len(COORDS_COLUMNS)
+    with open(coordsfile, "r") as cfh:
+        for line in cfh:
+            cols = line.split()
+            if len(cols) >= ncols:
+                yield tuple(cols[:ncols])
+
+
+def load_coords(dbc, coordsfile, batch_size=100000):
+    """Bulk loads the alignments in coordsfile in the Coords table of database
+    connection dbc. Rows are inserted in batches of batch_size within one
+    transaction. The indexes are created after the load, which is faster than
+    updating them for every insert.
+
+    Returns the number of loaded alignments."""
+    # The table is built once and only read afterwards, so there is no need for
+    # a rollback journal or syncing to disk while loading
+    dbc.execute("PRAGMA journal_mode = OFF")
+    dbc.execute("PRAGMA synchronous = OFF")
+    dbc.execute("PRAGMA temp_store = MEMORY")
+    dbc.execute("PRAGMA cache_size = -262144")  # 256 MiB
+
+    start_time = time.time()
+    nr_rows = 0
+    insert = "Insert into Coords values(NULL, %s)" % \
+        ", ".join("?" * len(COORDS_COLUMNS))
+    rows = parse_coords(coordsfile)
+
+    # Manage the transaction explicitly, the sqlite3 module would otherwise
+    # commit implicitly before the create statements
+    isolation_level = dbc.isolation_level
+    dbc.isolation_level = None
+    dbc.execute("BEGIN")
+    try:
+        dbc.execute("""Create table Coords (ID INTEGER PRIMARY KEY, S1 INTEGER,
+                    E1 INTEGER, S2 INTEGER, E2 INTEGER, LEN1 INTEGER, LEN2
+                    INTEGER, IDY REAL, LENR INTEGER, LENQ INTEGER, COVR REAL,
+                    COVQ REAL, REFID TEXT, QRYID TEXT)""")
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if len(batch) == 0:
+                break
+            dbc.executemany(insert, batch)
+            nr_rows += len(batch)
+        load_time = time.time() - start_time
+        dbc.execute("Create index Coords_QRYID on Coords (QRYID)")
+        dbc.execute("Create index Coords_REFID_S1 on Coords (REFID, S1)")
+        dbc.execute("COMMIT")
+    finally:
+        dbc.isolation_level = isolation_level
+    total_time = time.time() - start_time
+
+    sys.stderr.write("Loaded %i alignments from %s in %.2fs (%.0f rows/s), "
+                     "%.2fs including indexing\n" %
+                     (nr_rows, coordsfile, load_time,
+                      nr_rows / max(load_time, 1e-6), total_time))
+
+    return(nr_rows)
+
+
+def file_digest(filename, blocksize=1 << 20):
+    """Returns the SHA-1 hex digest of the content of filename."""
+    h = hashlib.sha1()
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(blocksize), b""):
+            h.update(block)
+
+    return(h.hexdigest())
+
+
+def coords_file_key(coordsfile):
+    """Returns the key identifying a coords file in the coords database cache
+    as a dictionary of strings. The content hash is added lazily under "sha1"
+    by open_coords_db, since it requires reading the whole file."""
+    st = os.stat(coordsfile)
+    key = dict(schema_version=str(COORDS_DB_SCHEMA_VERSION),
+               size=str(st.st_size), mtime=repr(st.st_mtime))
+
+    return(key)
+
+
+def read_coords_db_key(dbfile):
+    """Returns the key stored in the CoordsMeta table of dbfile or None if the
+    database can't be read or has no complete key."""
+    try:
+        dbc = sqlite3.connect(dbfile)
+        try:
+            key = dict(dbc.execute("SELECT key, value FROM CoordsMeta"))
+        finally:
+            dbc.close()
+    except sqlite3.DatabaseError:
+        return None
+
+    if set(key) != set(["schema_version", "size", "mtime", "sha1"]):
+        return None
+
+    return(key)
+
+
+def build_coords_db(coordsfile, dbfile, key):
+    """Loads coordsfile in a new database that replaces dbfile atomically. The
+    database is written to a temporary file first, so an interrupted build
+    never leaves a partial database at dbfile."""
+    tmpfile = "%s.tmp.%i" % (dbfile, os.getpid())
+    if os.path.exists(tmpfile):
+        os.remove(tmpfile)
+    try:
+        dbc = sqlite3.connect(tmpfile)
+        load_coords(dbc, coordsfile)
+        with dbc:
+            dbc.execute("Create table CoordsMeta (key TEXT PRIMARY KEY, "
+                        "value TEXT)")
+            dbc.executemany("Insert into CoordsMeta values(?, ?)",
+                            key.iteritems())
+        dbc.close()
+        os.rename(tmpfile, dbfile)
+    except:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+def open_coords_db(coordsfile, dbfile=None):
+    """Returns a connection to the SQLite database with the alignments of
+    coordsfile in the Coords table. The database is cached in dbfile (default
+    coordsfile + ".sqlite") and reused as long as the schema version and the
+    size, mtime or content hash of coordsfile are unchanged. The content hash
+    is only computed when the size matches but the mtime doesn't, e.g. after
+    copying the file. On a mismatch the database is rebuilt."""
+    if dbfile is None:
+        dbfile = coordsfile + ".sqlite"
+
+    key = coords_file_key(coordsfile)
+    cached_key = None
+    if os.path.exists(dbfile):
+        cached_key = read_coords_db_key(dbfile)
+
+    if cached_key is None:
+        reason = "no valid cache" if os.path.exists(dbfile) else "no cache"
+    elif cached_key["schema_version"] != key["schema_version"]:
+        reason = "schema version changed"
+    elif cached_key["size"] != key["size"]:
+        reason = "size changed"
+    elif cached_key["mtime"] == key["mtime"]:
+        reason = None
+    else:
+        key["sha1"] = file_digest(coordsfile)
+        if cached_key["sha1"] == key["sha1"]:
+            reason = None
+            # Content is unchanged, store the new mtime to skip hashing the
+            # next time
+            dbc = sqlite3.connect(dbfile)
+            with dbc:
+                dbc.execute("Update CoordsMeta set value = ? where key = "
+                            "'mtime'", (key["mtime"],))
+            dbc.close()
+        else:
+            reason = "content changed"
+
+    if reason is None:
+        sys.stderr.write("Coords cache hit: %s\n" % dbfile)
+    else:
+        sys.stderr.write("Coords cache miss (%s): building %s\n" %
+                         (reason, dbfile))
+        if "sha1" not in key:
+            key["sha1"] = file_digest(coordsfile)
+        build_coords_db(coordsfile, dbfile, key)
+
+    dbc = sqlite3.connect(dbfile)
+    dbc.row_factory = sqlite3.Row
+
+    return(dbc)
+
+
+def fetch_columns(cursor, query, dtypes, params=None, codes=(),
+                  chunk_size=100000):
+    """Executes query and returns the result as a dictionary with the column
+    names as keys and a NumPy array of each column as values. The rows are
+    fetched in chunks of chunk_size and every chunk is converted to arrays of
+    the types in dtypes, a dictionary by column name, so the rows are never
+    all in memory as Python objects.
+
+    The values of the text columns in codes are replaced by integer codes,
+    assigned while reading. Returns a tuple of the dictionary of columns and
+    a dictionary with an array of the names of the codes of every column in
+    codes, sorted like numpy.unique."""
+    cursor.execute(query, params or {})
+    names = [d[0] for d in cursor.description]
+    chunks = dict((n, []) for n in names)
+    code_maps = dict((n, {}) for n in codes)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+        for i, n in enumerate(names):
+            if n in code_maps:
+                code = code_maps[n]
+                values = [code.setdefault(r[i], len(code)) for r in rows]
+                chunks[n].append(numpy.array(values, dtype=numpy.int64))
+            else:
+                chunks[n].append(numpy.array([r[i] for r in rows],
+                                             dtype=dtypes[n]))
+
+    columns = {}
+    for n in names:
+        dtype = numpy.int64 if n in code_maps else dtypes[n]
+        columns[n] = numpy.concatenate(chunks[n]) if len(chunks[n]) > 0 \
+            else numpy.zeros(0, dtype=dtype)
+        del chunks[n][:]
+
+    # Renumber the codes in the order of the sorted names
+    code_names = {}
+    for n, code in code_maps.iteritems():
+        first_names = numpy.array(sorted(code, key=code.get))
+        order = numpy.argsort(first_names, kind="mergesort")
+        rank = numpy.empty(len(order), dtype=numpy.int64)
+        rank[order] = numpy.arange(len(order))
+        columns[n] = rank[columns[n]]
+        code_names[n] = first_names[order]
+
+    return(columns, code_names)
+
+
+def read_coords(dbc):
+    """Reads the columns of the Coords table that are needed for the
+    statistics in one scan. Returns a dictionary of NumPy arrays in the order
+    of the coords file. REFID and QRYID are integer codes that index the
+    arrays of names under refids and qryids respectively."""
+    coords, names = fetch_columns(
+        dbc.cursor(), """SELECT REFID, QRYID, S1, E1, S2, E2, IDY, LENQ, COVQ
+        FROM Coords ORDER BY ID""", COORDS_DTYPES, codes=("REFID", "QRYID"))
+    coords["refids"] = names["REFID"]
+    coords["qryids"] = names["QRYID"]
+
+    return(coords)
+
+
+def calc_purest_alignments(coords, cut_off=100):
+    """Determines the purest alignments of every contig of at least cut_off
+    bases. Purity is defined as COVQ * IDY / 10,000. If there are multiple
+    alignments for a contig with maximum purity, all of them are selected.
+
+    Returns a tuple of two elements, the first a boolean array that selects the
+    purest alignments in coords, the second the maximum purity per contig
+    indexed by QRYID code."""
+    purity = coords["COVQ"] * coords["IDY"] / 10000
+    if len(purity) == 0:
+        return(numpy.zeros(0, dtype=bool), purity)
+
+    # Maximum per contig over the alignments sorted by contig
+    order = numpy.argsort(coords["QRYID"], kind="mergesort")
+    qryid = coords["QRYID"][order]
+    first = numpy.ones(len(qryid), dtype=bool)
+    first[1:] = qryid[1:] != qryid[:-1]
+    max_purity = numpy.maximum.reduceat(purity[order], numpy.flatnonzero(first))
+
+    purest = (purity == max_purity[coords["QRYID"]]) & \
+        (coords["LENQ"] >= cut_off)
+
+    return(purest, max_purity)
+
+
+def calc_genome_contig_cov_in_bases(coords, purest):
     """Genome contig coverage is a metric that indicates how well the genome is
     covered by contigs. For each contig only the purest alignment is
     considered. Purity is defined as COVQ * IDY / 10,000. If there are muliple
@@ -39,60 +356,58 @@ def calc_genome_contig_cov_in_bases(cursor, cut_off=100):
     prefer to use the purest alignment in case of overlap but I'll implement
     that only if persuaded with dinner.
 
+    The purest alignments are given by the boolean array purest from
+    calc_purest_alignments.
+
     Returns a dictionary of the genome contig coverage per genome as the number
     of non-overlapping bases that are covered by contigs aligning with maximum
     purity.
     """
-    refcov = {}  # nr of bases covered by contigs aligned with max purity
-    prev_e1 = 0
-    for row in cursor.execute("""SELECT * FROM (SELECT *, max(COVQ * IDY /
-                              10000) AS purity FROM Coords GROUP BY QRYID)
-                              WHERE COVQ * IDY / 10000 == purity AND LENQ >= :cut_off ORDER BY
-                              REFID, S1 ASC""", dict(cut_off=cut_off)):
-        if row["REFID"] in refcov:
-            if prev_e1 >= row["E1"]:
-                continue
-            elif prev_e1 >= row["S1"]:
-                refcov[row["REFID"]] += int((row["E1"] -
-                                            prev_e1) * (row["IDY"] / 100.0))
-            else:
-                refcov[row["REFID"]] += int((row["E1"] - row["S1"] + 1) *
-                                            (row["IDY"] / 100.0))
-        else:
-            refcov[row["REFID"]] = int((row["E1"] - row["S1"])
-                                       * (row["IDY"] / 100.0)) + 1
-        prev_e1 = row["E1"]
+    # Alignments with equal S1 are swept in order of contig name, as the
+    # REFID, S1 ordered rows of the GROUP BY QRYID query were
+    idx = numpy.flatnonzero(purest)
+    idx = idx[numpy.argsort(coords["QRYID"][idx], kind="mergesort")]
+    refid = coords["REFID"][idx]
+    order, first, new_len = intervals.sweep(refid, coords["S1"][idx],
+                                            coords["E1"][idx])
+
+    # Covered bases are weighted by IDY. The first alignment of each genome is
+    # counted as int((E1 - S1) * IDY) + 1.
+    idy = coords["IDY"][idx][order] / 100.0
+    bases = (new_len * idy).astype(numpy.int64)
+    bases[first] = ((new_len[first] - 1) * idy[first]).astype(numpy.int64) + 1
+    refcov = dict(zip(coords["refids"][refid[order][first]].tolist(),
+                      intervals.segment_sum(bases, first).tolist()))
 
     return(refcov)
 
 
-def calc_max_purity_per_contig(cursor, cut_off=100):
-    q_max_purity = {}
-    for row in cursor.execute("""SELECT * FROM (SELECT *, max(COVQ * IDY /
-                              10000) AS purity FROM Coords GROUP BY QRYID)
-                              WHERE COVQ * IDY / 10000 == purity
-                              AND LENQ >= :cut_off""", dict(cut_off=cut_off)):
-        q_max_purity[row["QRYID"]] = dict(max_purity=row["purity"],
-                                          length=row["LENQ"])
+def calc_max_purity_per_contig(coords, purest, max_purity):
+    """Returns a dictionary with the maximum purity and the length of every
+    contig that has purest alignments."""
+    idx = numpy.flatnonzero(purest)
+    qryid, first_idx = numpy.unique(coords["QRYID"][idx], return_index=True)
+    q_max_purity = dict(
+        (q, dict(max_purity=p, length=l)) for q, p, l in
+        zip(coords["qryids"][qryid].tolist(), max_purity[qryid].tolist(),
+            coords["LENQ"][idx][first_idx].tolist()))
 
     return(q_max_purity)
 
 
-def calc_alignedbases_per_contig(cursor, cut_off=100):
-    q_aln_bases = {}  # nr of bases aligned per contig
-    prev_end = 0
-    for row in cursor.execute("""SELECT *, min(S2, E2) AS start, max(S2, E2) as end FROM COORDS WHERE LENQ >= :cut_off ORDER BY
-                              QRYID, start ASC""", dict(cut_off=cut_off)):
-        if row["QRYID"] in q_aln_bases:
-            if prev_end >= row["end"]:
-                continue
-            elif prev_end >= row["start"]:
-                q_aln_bases[row["QRYID"]] += row["end"] - prev_end
-            else:
-                q_aln_bases[row["QRYID"]] += row["end"] - row["start"] + 1
-        else:
-            q_aln_bases[row["QRYID"]] = row["end"] - row["start"]
-        prev_end = row["end"]
+def calc_alignedbases_per_contig(coords, cut_off=100):
+    """Returns a dictionary with the number of bases of every contig of at
+    least cut_off bases that are covered by any alignment."""
+    idx = numpy.flatnonzero(coords["LENQ"] >= cut_off)
+    qryid = coords["QRYID"][idx]
+    s2, e2 = coords["S2"][idx], coords["E2"][idx]
+    order, first, new_len = intervals.sweep(qryid, numpy.minimum(s2, e2),
+                                            numpy.maximum(s2, e2))
+
+    # The first alignment of each contig is counted as end - start
+    new_len[first] -= 1
+    q_aln_bases = dict(zip(coords["qryids"][qryid[order][first]].tolist(),
+                           intervals.segment_sum(new_len, first).tolist()))
 
     return(q_aln_bases)
 
@@ -123,150 +438,474 @@ def readtable(tablefile, sep=None):
 
 def asm_stats_fasta(fafile, cut_off=100):
     """Return L50 of an assembly and the total number of bases. 50% of all
-    bases in the assembly are located in contigs equal or larger than l50."""
-    name = None
-    all_contig_lengths = {}
-
-    # Determine lengths of all contigs
-    for line in open(fafile):
-        if line[0] == '>':
-            name = line[1:-1]
-            all_contig_lengths[name] = 0
-        else:
-            all_contig_lengths[name] += len("".join(re.findall(
-                "[ACGTacgt]+", line)))
-
-    # Determine l50, 50% of the bases in the fasta file are located in contigs => l50
-    sorted_contigs = sorted(filter(lambda x: x >= cut_off,
-                                   all_contig_lengths.values()),
-                            reverse=True)
-    cumsum = 0
-    totbases = sum(sorted_contigs)
-    max_length = sorted_contigs[0]
-    for i in range(len(sorted_contigs)):
-        cumsum += sorted_contigs[i]
-        if cumsum >= totbases / 2:
-            l50 = sorted_contigs[i]
-            n50 = i
+    bases in the assembly are located in contigs equal or larger than l50.
+    Only ACGT bases are counted. The contig lengths are determined in one
+    pass over large blocks of the file, see contigstats.assembly_stats."""
+    stats = assembly_stats(fafile, cut_off)
+    l50, n50 = stats["nx"][50]
+    all_contig_lengths = dict(zip(stats["headers"], stats["lengths"].tolist()))
+
+    return(l50, n50, stats["sum_bases"], stats["max_length"],
+           stats["nr_contigs"], all_contig_lengths)
+
+
+def split_tids(lengths, nr_parts):
+    """Splits the tids of references with given lengths in at most nr_parts
+    lists with roughly equal total length. Longest references are assigned
+    first, each to the part with the smallest total length so far."""
+    parts = [[] for i in range(min(nr_parts, len(lengths)))]
+    totals = [0] * len(parts)
+    for tid in sorted(range(len(lengths)), key=lambda t: -lengths[t]):
+        i = totals.index(min(totals))
+        parts[i].append(tid)
+        totals[i] += lengths[tid]
+
+    return([sorted(p) for p in parts if len(p) > 0])
+
+
+def fetch_tids(samfile, tids=None):
+    """Iterates over the records of samfile. If tids is given, only over the
+    records mapping to those references, which requires an index."""
+    if tids is None:
+        return iter(samfile)
+    else:
+        return itertools.chain.from_iterable(
+            samfile.fetch(samfile.getrname(tid)) for tid in tids)
+
+
+def pair_chunks(pairs, chunk_size=262144):
+    """Yields the integer pairs of iterable pairs in chunks of at most
+    chunk_size as tuples of two int64 arrays. Fills preallocated arrays, so a
+    chunk takes 16 bytes per pair instead of a Python tuple per pair."""
+    first = numpy.empty(chunk_size, dtype=numpy.int64)
+    second = numpy.empty(chunk_size, dtype=numpy.int64)
+    i = 0
+    for first[i], second[i] in pairs:
+        i += 1
+        if i == chunk_size:
+            yield(first.copy(), second.copy())
+            i = 0
+    if i > 0:
+        yield(first[:i].copy(), second[:i].copy())
+
+
+def ref_pairs(bamref, tids=None):
+    """Yields chunks of the reads with mapping quality > 0 in bamref as tuples
+    of arrays (read name hashes, reference tids). If tids is given, only reads
+    mapping to those references are considered."""
+    reffile = pysam.Samfile(bamref, "rb")
+    for hashes, ref_tids in pair_chunks(
+            (readrefmap.hash_read_name(r.qname), r.tid) for r in
+            fetch_tids(reffile, tids) if r.mapq > 0):
+        yield(hashes, ref_tids.astype(numpy.int32))
+    reffile.close()
+
+
+def map_reads_to_refs(bamref, tids=None, spill_dir=None):
+    """Returns the readrefmap of the reads with mapping quality > 0 in bamref
+    to the tids of the references they map to. If tids is given, only reads
+    mapping to those references are considered. If spill_dir is given, the
+    map is built on disk in spill_dir."""
+    return readrefmap.build(ref_pairs(bamref, tids), spill_dir)
+
+
+def count_refs_per_contig(bamasm, refmap, cut_off=100, tids=None):
+    """Determines for every contig (or scaffold) in bamasm which reads map to
+    what reference. Returns a dictionary with the contig tid as key and a
+    dictionary with an "unamb" and "amb" Counter of reads per reference tid as
+    value. Unambiguous reads map to one reference only, ambiguous reads are
+    counted for all references they map to. Reads that are not in readrefmap
+    refmap are ignored. If tids is given, only contigs with those tids are
+    considered."""
+    asmfile = pysam.Samfile(bamasm, "rb")
+    contig_ref_map = {}
+    for contigs, hashes in pair_chunks(
+            (r.tid, readrefmap.hash_read_name(r.qname)) for r in
+            fetch_tids(asmfile, tids) if r.mapq > 0 and r.qlen >= cut_off):
+        unamb, amb = readrefmap.count_contig_refs(refmap, contigs, hashes)
+        # Every read that maps to the reference genomes is in amb
+        for contig, ref, count in zip(*[a.tolist() for a in amb]):
+            if contig not in contig_ref_map:
+                contig_ref_map[contig] = {}
+                contig_ref_map[contig]["unamb"] = Counter()
+                contig_ref_map[contig]["amb"] = Counter()
+            contig_ref_map[contig]["amb"][ref] += count
+        for contig, ref, count in zip(*[a.tolist() for a in unamb]):
+            contig_ref_map[contig]["unamb"][ref] += count
+    asmfile.close()
+
+    return(contig_ref_map)
+
+
+# Read to reference map shared with the count_refs_per_contig workers. It is
+# set before the pool is created, so the forked workers inherit it instead of
+# receiving a pickled copy.
+_worker_refmap = None
+
+
+def _ref_pairs_worker(args):
+    return list(ref_pairs(*args))
+
+
+def _count_refs_per_contig_worker(args):
+    bamasm, cut_off, tids = args
+    return count_refs_per_contig(bamasm, _worker_refmap, cut_off, tids)
+
+
+def is_indexed(bamfile):
+    return os.path.exists(bamfile + ".bai")
+
+
+def is_name_sorted(bamfile):
+    """Returns True if the header of bamfile says it is sorted by read
+    name."""
+    samfile = pysam.Samfile(bamfile, "rb")
+    sort_order = samfile.header.get("HD", {}).get("SO")
+    samfile.close()
+
+    return(sort_order == "queryname")
+
+
+def _encode_digits(match):
+    digits = match.group().lstrip("0")
+    zeros = len(match.group()) - len(digits)
+    return "0" + chr(len(digits)) + digits + chr(255 - min(zeros, 255))
+
+
+def qname_key(qname):
+    """Returns a key that sorts read names like samtools sort -n does, i.e.
+    runs of digits are compared as numbers and equal numbers with more leading
+    zeros come first. Every run of digits is replaced by a "0", the number of
+    significant digits, those digits and the inverted number of leading
+    zeros, so the key still compares to other characters like a digit
+    does."""
+    return QNAME_DIGITS.sub(_encode_digits, qname)
+
+
+def qname_groups(samfile, bamfile, keep):
+    """Yields a tuple (qname_key, tids) for every read name in name sorted
+    samfile, where tids are the tids of the records of that read for which
+    keep returns True. Reads without such records are skipped."""
+    prev_key, prev_qname = None, None
+    for qname, records in itertools.groupby(samfile, lambda r: r.qname):
+        key = qname_key(qname)
+        if prev_key is not None and key < prev_key:
+            raise ValueError("%s is not sorted by read name like samtools "
+                             "sort -n does (%s after %s)" %
+                             (bamfile, qname, prev_qname))
+        prev_key, prev_qname = key, qname
+        tids = [r.tid for r in records if keep(r)]
+        if len(tids) > 0:
+            yield(key, tids)
+
+
+def merge_join_contig_refs(bamref, bamasm, cut_off=100):
+    """Returns the same contig_ref_map as count_refs_per_contig, but by
+    merging name sorted bamref and bamasm on read name. Only the records of
+    one read are kept in memory at a time."""
+    reffile = pysam.Samfile(bamref, "rb")
+    asmfile = pysam.Samfile(bamasm, "rb")
+    refs = qname_groups(reffile, bamref, lambda r: r.mapq > 0)
+    asms = qname_groups(asmfile, bamasm,
+                        lambda r: r.mapq > 0 and r.qlen >= cut_off)
+
+    contig_ref_map = {}
+    ref_key, ref_tids = next(refs, (None, None))
+    for asm_key, contig_tids in asms:
+        while ref_key is not None and ref_key < asm_key:
+            ref_key, ref_tids = next(refs, (None, None))
+        if ref_key is None:
             break
+        elif ref_key != asm_key:
+            continue
+
+        # The read is mapped to the reference genomes
+        ref_tids = sorted(set(ref_tids))
+        for contig_tid in contig_tids:
+            if not contig_tid in contig_ref_map:
+                contig_ref_map[contig_tid] = {}
+                contig_ref_map[contig_tid]["unamb"] = Counter()
+                contig_ref_map[contig_tid]["amb"] = Counter()
+            if len(ref_tids) == 1:
+                contig_ref_map[contig_tid]["unamb"][ref_tids[0]] += 1
+            for ref_tid in ref_tids:
+                contig_ref_map[contig_tid]["amb"][ref_tid] += 1
+    reffile.close()
+    asmfile.close()
+
+    return(contig_ref_map)
+
+
+def sort_by_name(bamfile, outdir, processes=1):
+    """Sorts bamfile by read name with samtools sort -n into outdir, which is
+    an external merge sort in bounded memory. Returns the path of the sorted
+    BAM file."""
+    sorted_bam = os.path.join(outdir, os.path.basename(bamfile))
+    sys.stderr.write("Sorting %s by read name into %s\n" % (bamfile,
+                                                          sorted_bam))
+    pysam.sort("-n", "-@", str(processes), "-T", sorted_bam + ".tmp",
+               "-o", sorted_bam, bamfile)
+
+    return(sorted_bam)
+
+
+def calc_contig_ref_map_name_sorted(bamref, bamasm, cut_off=100, processes=1,
+                                    sort_dir=None):
+    """Returns the contig_ref_map of merge_join_contig_refs. BAM files that
+    are not sorted by read name are sorted first in a temporary directory in
+    sort_dir. BAM files with SO:queryname in their header are used as they
+    are, unless they turn out not to be in the order of samtools sort -n, e.g.
+    the lexicographic order of Picard. Then they are sorted as well."""
+    tmp_dir = None
+    try:
+        tmp_dir = tempfile.mkdtemp(prefix="namesort.", dir=sort_dir)
+        bamfiles = []
+        for bamfile in (bamref, bamasm):
+            if not is_name_sorted(bamfile):
+                bamfile = sort_by_name(bamfile, tmp_dir, processes)
+            bamfiles.append(bamfile)
 
-    return(l50, n50, totbases, max_length, len(sorted_contigs), all_contig_lengths)
+        try:
+            return merge_join_contig_refs(bamfiles[0], bamfiles[1], cut_off)
+        except ValueError, e:
+            sys.stderr.write("%s, sorting it again\n" % e)
+        bamfiles = [bamfile if bamfile.startswith(tmp_dir) else
+                    sort_by_name(bamfile, tmp_dir, processes)
+                    for bamfile in bamfiles]
+        return merge_join_contig_refs(bamfiles[0], bamfiles[1], cut_off)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+def calc_contig_ref_map(bamref, bamasm, cut_off=100, processes=1,
+                        spill_dir=None, name_sorted=False):
+    """Returns the contig_ref_map of count_refs_per_contig for reads mapped
+    to the references in bamref and to the contigs in bamasm. With processes >
+    1 and indexed BAM files both BAM files are split by reference over a pool
+    of processes. The partial results are merged and are equal to those of a
+    serial run. If spill_dir is given, the map of reads to references is kept
+    on disk in a temporary directory in spill_dir instead of in memory.
+
+    If name_sorted is True, the BAM files are merge-joined on read name
+    instead, which takes constant memory per read. BAM files that aren't
+    sorted by read name like samtools sort -n are sorted first, in spill_dir
+    if given."""
+    global _worker_refmap
+
+    if name_sorted:
+        return calc_contig_ref_map_name_sorted(bamref, bamasm, cut_off,
+                                               processes, spill_dir)
+
+    if spill_dir is not None:
+        spill_dir = tempfile.mkdtemp(prefix="readrefmap.", dir=spill_dir)
+    try:
+        if processes <= 1 or not (is_indexed(bamref) and is_indexed(bamasm)):
+            refmap = map_reads_to_refs(bamref, spill_dir=spill_dir)
+            return count_refs_per_contig(bamasm, refmap, cut_off)
+
+        reffile = pysam.Samfile(bamref, "rb")
+        ref_parts = split_tids(reffile.lengths, processes * 4)
+        reffile.close()
+        asmfile = pysam.Samfile(bamasm, "rb")
+        asm_parts = split_tids(asmfile.lengths, processes * 4)
+        asmfile.close()
+
+        # Reads can map to references in multiple parts, the map is built from
+        # the pairs of all parts
+        pool = multiprocessing.Pool(processes)
+        refmap = readrefmap.build(itertools.chain.from_iterable(
+            pool.imap_unordered(_ref_pairs_worker,
+                                [(bamref, p) for p in ref_parts])), spill_dir)
+        pool.close()
+        pool.join()
+
+        # Contigs are in exactly one part, so the partial results are disjoint
+        _worker_refmap = refmap
+        pool = multiprocessing.Pool(processes)
+        contig_ref_map = {}
+        for partial in pool.imap_unordered(_count_refs_per_contig_worker,
+                                           [(bamasm, cut_off, p) for p in
+                                            asm_parts]):
+            contig_ref_map.update(partial)
+        pool.close()
+        pool.join()
+
+        return(contig_ref_map)
+    finally:
+        _worker_refmap = None
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir)
+
+
+def load_reference(refstatsfile, refphylfile, bamref):
+    """Loads the reference side data that is the same for every assembly.
+    Returns a dictionary with the reference stats under "reflens", the names
+    of the references in bamref under "refnames" and the taxonomy_matrix of
+    those references in the phylogeny under "taxonomy", "in_rp" and
+    "tax_lvls"."""
+    refnames = pysam.Samfile(bamref, "rb").references
+    rp = numpy.atleast_1d(numpy.genfromtxt(refphylfile, names=True,
+                                           dtype=None, missing_values="-",
+                                           delimiter="\t"))
+    tax_lvls = [rp.dtype.names[i] for i in range(4, 14)]
+    taxonomy, in_rp = taxonomy_matrix(rp, refnames, tax_lvls)
 
+    return(dict(reflens=readtable(refstatsfile, sep="\t"), refnames=refnames,
+                taxonomy=taxonomy, in_rp=in_rp, tax_lvls=tax_lvls))
 
-def calc_read_level_purity(bamref, bamasm, refphylfile, cut_off=100):
-    reffile = pysam.Samfile(bamref, "rb")
-    # Determine which reads map uniquely to what reference
-    read_ref_map = {}
-    for record in reffile:
-        if record.mapq > 0:
-            if record.qname in read_ref_map:
-                if record.tid not in read_ref_map[record.qname]:
-                    read_ref_map[record.qname].append(record.tid)
-            else:
-                read_ref_map[record.qname] = [record.tid]
 
-    # Determine for every contig (or scaffold) which reads map to what reference
-    asmfile = pysam.Samfile(bamasm, "rb")
-    contig_ref_map = {}
-    for record in asmfile:
-        if record.mapq > 0 and record.qlen >= cut_off:
-            # The read should be mapped to the reference genomes
-            if record.qname in read_ref_map:
-                # Check unambigiuously mapping reads and ambiguously mapping reads
-                if not record.tid in contig_ref_map:
-                    contig_ref_map[record.tid] = {}
-                    contig_ref_map[record.tid]["unamb"] = Counter()
-                    contig_ref_map[record.tid]["amb"] = Counter()
-
-                if len(read_ref_map[record.qname]) == 1:
-                    ref_tid = read_ref_map[record.qname][0]
-                    contig_ref_map[record.tid]["unamb"][reffile.getrname(ref_tid)] += 1
-                    contig_ref_map[record.tid]["amb"][reffile.getrname(ref_tid)] += 1
-                else:
-                    for ref_tid in read_ref_map[record.qname]:
-                        contig_ref_map[record.tid]["amb"][reffile.getrname(ref_tid)] += 1
+def calc_read_level_purity(contig_ref_map, contignames, reference):
+    """Returns a dictionary with the names of the contigs under "contigs" and
+    the read level purity of the contigs for both unambiguous and ambiguous
+    reads under "unamb" and "amb". Those are dictionaries of columns indexed
+    by contig tid, with an extra last element for contigs that are not in
+    contignames. Contigs without reads are False in column "has_reads".
 
+    Keyword arguments:
+    contig_ref_map -- reads per reference tid of every contig tid, from
+                      calc_contig_ref_map or count_refs_per_contig
+    contignames    -- names of the contigs by tid
+    reference      -- reference side data from load_reference
+    """
     # Determine read level purity for every contig i.e. (number of reads
     # mapping to most dominant strain / number of reads mapping to contig).
     # Both for unambiguous and ambiguous reads. Also determine nr reads mapping
     # at each taxonomic level to give an indication at what level chimericity
     # occurs
-    contig_read_level_purity = {}
-    rp = numpy.genfromtxt(refphylfile, names=True, dtype=None,
-                          missing_values="-", delimiter="\t")
-    tax_lvls = [rp.dtype.names[i] for i in range(4, 14)]
-    for k, v in contig_ref_map.iteritems():
-        contig_read_level_purity[asmfile.getrname(k)] = {}
+    tax_lvls = reference["tax_lvls"]
+    taxonomy, in_rp = reference["taxonomy"], reference["in_rp"]
 
-        # Calculate for both "unamb" and "amb"
+    # One group of read counts per contig for both "unamb" and "amb"
+    group_contigs, group_kinds = [], []
+    groups, tids, counts = [], [], []
+    for k, v in contig_ref_map.iteritems():
         for kj, vj in v.iteritems():
-            # Get most dominant strain and number of reads
-            mc = vj.most_common(1)
-            if len(mc) != 0:
-                dom_nr_reads = mc[0][1]
-                tot_nr_reads = sum(vj.itervalues())
-                read_level_purity = float(dom_nr_reads) / tot_nr_reads
-                dominant_strain = mc[0][0]
-
-                contig_read_level_purity[asmfile.getrname(k)][kj] = \
-                    dict(read_level_purity=read_level_purity,
-                         dominant_strain=dominant_strain,
-                         tot_nr_reads=tot_nr_reads,
-                         dom_nr_reads=dom_nr_reads)
-
-                # Determine nr of reads per taxon and the taxonomic level of
-                # the lowest common ancestor (LCA)
-                if dom_nr_reads != tot_nr_reads:
-                    nr_reads_per_taxon, lca = calc_nr_reads_per_taxon(vj, rp,
-                                                                      tax_lvls)
-                    contig_read_level_purity[asmfile.getrname(k)][kj]["lca"] =\
-                            lca
-                else:
-                    nr_reads_per_taxon = [(tl, tot_nr_reads) for tl in
-                                          tax_lvls]
-                    contig_read_level_purity[asmfile.getrname(k)][kj]["lca"] =\
-                            tax_lvls[-1]
-                contig_read_level_purity[asmfile.getrname(k)][kj].update(nr_reads_per_taxon)
+            if len(vj) != 0:
+                groups.extend([len(group_contigs)] * len(vj))
+                tids.extend(vj.iterkeys())
+                counts.extend(vj.itervalues())
+                group_contigs.append(k)
+                group_kinds.append(kj)
+    dom_tids, dom_nr_reads, tot_nr_reads, nr_reads_per_taxon, lca = \
+        calc_nr_reads_per_taxon(numpy.array(groups, dtype=numpy.int64),
+                                numpy.array(tids, dtype=numpy.int64),
+                                numpy.array(counts, dtype=numpy.int64),
+                                taxonomy)
+    # Strains of contigs with reads of multiple strains should be in rp
+    assert(in_rp[dom_tids[dom_nr_reads != tot_nr_reads]].all())
+
+    # Scatter the groups into columns indexed by contig tid. The columns have
+    # an extra last element without reads, for contigs that are not in bamasm
+    group_contigs = numpy.array(group_contigs, dtype=numpy.int64)
+    group_kinds = numpy.array(group_kinds)
+    refnames = numpy.array(reference["refnames"], dtype=object)
+    lca_names = numpy.array([TAX_LVL_NAMES.get(tl, tl) for tl in tax_lvls],
+                            dtype=object)
+    contig_read_level_purity = dict(contigs=contignames)
+    for kj in ("unamb", "amb"):
+        sel = group_kinds == kj
+        tid = group_contigs[sel]
+        columns = dict(
+            has_reads=numpy.zeros(len(contignames) + 1, dtype=bool),
+            read_level_purity=numpy.zeros(len(contignames) + 1),
+            tot_nr_reads=numpy.zeros(len(contignames) + 1, dtype=numpy.int64),
+            dom_nr_reads=numpy.zeros(len(contignames) + 1, dtype=numpy.int64),
+            dominant_strain=numpy.empty(len(contignames) + 1, dtype=object),
+            lca=numpy.empty(len(contignames) + 1, dtype=object))
+        columns["has_reads"][tid] = True
+        columns["read_level_purity"][tid] = \
+            dom_nr_reads[sel] / tot_nr_reads[sel].astype(numpy.float64)
+        columns["tot_nr_reads"][tid] = tot_nr_reads[sel]
+        columns["dom_nr_reads"][tid] = dom_nr_reads[sel]
+        columns["dominant_strain"][tid] = refnames[dom_tids[sel]]
+        columns["lca"][tid] = lca_names[lca[sel]]
+        for j, tl in enumerate(tax_lvls):
+            columns[tl] = numpy.zeros(len(contignames) + 1, dtype=numpy.int64)
+            columns[tl][tid] = nr_reads_per_taxon[sel, j]
+        contig_read_level_purity[kj] = columns
 
     return(contig_read_level_purity)
 
 
-def calc_nr_reads_per_taxon(refcounts, rp, tax_lvls):
-    """Determines the number of reads per taxon if the reads map to multiple
-    strains (otherwise the number would be equal for all taxa). Returns a tuple
-    of two elements, first item is  a list of (taxon, number of reads) in
-    decreasing taxonomic rank, the second the taxonomic rank of the lowest
-    common ancestor (LCA) of the reads.
+def taxonomy_matrix(rp, refnames, tax_lvls):
+    """Encodes the taxa of the references in refnames as integers. Returns a
+    tuple (taxonomy, in_rp). taxonomy has a row for every reference tid and a
+    column for every taxonomic level in tax_lvls, equal taxa at a level have
+    equal codes. References that are not in rp and missing numeric values
+    have code -1, which doesn't match any taxon. in_rp is a boolean array that
+    is True for the references in rp."""
+    rows = dict((name, i) for i, name in enumerate(rp["fasta_name"].tolist()))
+    ref_rows = numpy.array([rows.get(name, -1) for name in refnames],
+                           dtype=numpy.int64)
+    in_rp = ref_rows >= 0
+
+    taxonomy = numpy.empty((len(refnames), len(tax_lvls)), dtype=numpy.int64)
+    taxonomy.fill(-1)
+    for j, tl in enumerate(tax_lvls):
+        codes = numpy.unique(rp[tl], return_inverse=True)[1]
+        if rp[tl].dtype.kind == "f":
+            codes[numpy.isnan(rp[tl])] = -1
+        taxonomy[in_rp, j] = codes[ref_rows[in_rp]]
+
+    return(taxonomy, in_rp)
+
+
+def calc_nr_reads_per_taxon(groups, tids, counts, taxonomy):
+    """Determines for groups of read counts per reference, e.g. the reads of
+    every contig, the dominant strain, the number of reads per taxon of the
+    dominant strain and the taxonomic rank of the lowest common ancestor (LCA)
+    of the reads. The number of reads is counted from the lowest taxonomic
+    rank up to the LCA, higher taxa have all reads of the group.
 
     Keyword arguments:
-    refcounts -- dictionary with 'reference : count' pairs
-    rp        -- numpy array of references phylogeny
-    tax_lvls  -- list of taxonomic levels, must be in rp.dtype.names
+    groups   -- group of every count, numbered from 0 without gaps
+    tids     -- reference tid of every count
+    counts   -- number of reads of the reference in the group
+    taxonomy -- taxonomy matrix from taxonomy_matrix, with the taxonomic
+                levels in decreasing taxonomic rank
+
+    Returns a tuple (dom_tids, dom_nr_reads, tot_nr_reads, nr_reads_per_taxon,
+    lca) of arrays with an element per group. nr_reads_per_taxon has a column
+    per taxonomic level and lca is the column of the LCA. The dominant strain
+    is the reference with most reads, ties are broken by the lowest tid.
     """
-    mc = refcounts.most_common(1)
-    assert(len(mc) == 1)
-
-    dom_str = rp["fasta_name"] == mc[0][0]
-    assert(len(rp[dom_str]) == 1)  # Strain should appear only once in array
-
-    # Count number of reads at each taxon. Start from lowest taxonomic level to
-    # highest and stop at sum
-    nr_reads_per_taxon = []
-    sum_reads = sum(refcounts.itervalues())
-    taxon_sum_reads = -1
-    for tl in reversed(tax_lvls):
-        if taxon_sum_reads < sum_reads:
-            dom_str_taxon = rp[dom_str][tl]
-            taxon_sum_reads = sum(v for k, v in refcounts.iteritems() if
-                                  rp[rp["fasta_name"] == k][tl] ==
-                                  dom_str_taxon)
-            lca = tl
-        nr_reads_per_taxon.append((tl, taxon_sum_reads))
-
-    # Reverse back so taxa or from highest to lowest rank
-    nr_reads_per_taxon.reverse()
-
-    return(nr_reads_per_taxon, lca)
+    nr_groups = groups.max() + 1 if len(groups) > 0 else 0
+    nr_lvls = taxonomy.shape[1]
+
+    # The first reference of every group sorted by decreasing count and tid
+    order = numpy.lexsort((tids, -counts, groups))
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    dom_tids = tids[order][first]
+    dom_nr_reads = counts[order][first]
+    tot_nr_reads = numpy.bincount(groups, weights=counts,
+                                  minlength=nr_groups).astype(numpy.int64)
+
+    # Number of reads with the taxon of the dominant strain at every level
+    dom_taxa = taxonomy[dom_tids][groups]
+    same_taxon = (taxonomy[tids] == dom_taxa) & (dom_taxa >= 0)
+    nr_reads_per_taxon = numpy.empty((nr_groups, nr_lvls), dtype=numpy.int64)
+    for j in range(nr_lvls):
+        nr_reads_per_taxon[:, j] = numpy.bincount(
+            groups, weights=counts * same_taxon[:, j], minlength=nr_groups)
+
+    # The LCA is the lowest level with all reads, or the highest level if no
+    # level has all reads
+    all_reads = nr_reads_per_taxon == tot_nr_reads[:, None]
+    has_lca = all_reads.any(axis=1)
+    lca = numpy.where(has_lca,
+                      nr_lvls - 1 - numpy.argmax(all_reads[:, ::-1], axis=1),
+                      0)
+    above_lca = (numpy.arange(nr_lvls) <= lca[:, None]) & has_lca[:, None]
+    nr_reads_per_taxon = numpy.where(above_lca, tot_nr_reads[:, None],
+                                     nr_reads_per_taxon)
+    # Reads of one strain only
+    pure = dom_nr_reads == tot_nr_reads
+    nr_reads_per_taxon[pure] = tot_nr_reads[pure, None]
+    lca[pure] = nr_lvls - 1
+
+    return(dom_tids, dom_nr_reads, tot_nr_reads, nr_reads_per_taxon, lca)
 
 
 def print_dict2tsv(d, filepath):
@@ -275,52 +914,131 @@ def print_dict2tsv(d, filepath):
         fh.write("\t".join(str(v) for v in d.itervalues()) + "\n")
 
 
-def get_default_nested_dict(d, keys, default="-", map_values=False):
-    di = d
-
-    for k in keys:
-        try:
-            di = di[k]
-        except KeyError:
-            return default
-
-    if map_values:
-        return map_values.get(di, di)
+def contig_purity_columns(contig_read_level_purity, contig_max_purity,
+                          contig_lengths, cut_off=100):
+    """Returns the columns of contig-purity.tsv for the contigs of at least
+    cut_off bases as a list of tuples (name, values, present) of arrays, where
+    present is False for missing values."""
+    contigs = [c for c, l in contig_lengths.iteritems() if l >= cut_off]
+    tids = dict(zip(contig_read_level_purity["contigs"], itertools.count()))
+    # Contigs that are not in bamasm get the last element of the columns
+    idx = numpy.array([tids.get(c, -1) for c in contigs], dtype=numpy.int64)
+
+    present = numpy.ones(len(contigs), dtype=bool)
+    columns = dict(contig=(numpy.array(contigs, dtype=object), present),
+                   contig_length=(numpy.array([contig_lengths[c] for c in
+                                               contigs], dtype=numpy.int64),
+                                  present))
+    max_aln_purity = [contig_max_purity.get(c, {}).get("max_purity") for c in
+                      contigs]
+    columns["max_aln_purity"] = (
+        numpy.array([p if p is not None else numpy.nan for p in
+                     max_aln_purity], dtype=numpy.float64),
+        numpy.array([p is not None for p in max_aln_purity], dtype=bool))
+    for kj in ("unamb", "amb"):
+        purity = contig_read_level_purity[kj]
+        has_reads = purity["has_reads"][idx]
+        for k, v in purity.iteritems():
+            if k != "has_reads":
+                name = "%s_%s" % (kj, k if k in ("read_level_purity",
+                                                 "tot_nr_reads",
+                                                 "dom_nr_reads",
+                                                 "dominant_strain", "lca")
+                                  else "nr_reads_" + TAX_LVL_NAMES.get(k, k))
+                columns[name] = (v[idx], has_reads)
+
+    return([(c,) + columns[c] for c in CONTIG_PURITY_COLUMNS])
+
+
+def format_column(values, present):
+    """Returns the values of a column as strings, "-" for missing values."""
+    cells = map(str, values.tolist())
+    for i in numpy.flatnonzero(~present).tolist():
+        cells[i] = "-"
+
+    return(cells)
+
+
+def arrow_type(values):
+    import pyarrow
+    if values.dtype == object:
+        return pyarrow.string()
     else:
-        return di
+        return pyarrow.from_numpy_dtype(values.dtype)
+
+
+def write_contig_purity(columns, outdir, formats=("tsv",),
+                        chunk_size=CONTIG_PURITY_CHUNK_SIZE):
+    """Writes columns of contig_purity_columns to outdir/contig-purity.tsv,
+    .parquet and .feather for the given formats, in chunks of chunk_size
+    contigs. Missing values are "-" in the tsv and null in Parquet and
+    Feather, which require pyarrow. The Feather file is an Arrow IPC file,
+    i.e. Feather version 2."""
+    nr_contigs = len(columns[0][1])
+    names = [c[0] for c in columns]
+    writers = []
+    if "tsv" in formats:
+        fh = open(outdir + "/contig-purity.tsv", "w")
+        fh.write("\t".join(CONTIG_PURITY_TSV_HEADER) + "\n")
+        writers.append(("tsv", fh))
+    if "parquet" in formats or "feather" in formats:
+        import pyarrow
+        import pyarrow.parquet
+        schema = pyarrow.schema([pyarrow.field(n, arrow_type(v)) for n, v, p
+                                 in columns])
+        if "parquet" in formats:
+            writers.append(("parquet", pyarrow.parquet.ParquetWriter(
+                outdir + "/contig-purity.parquet", schema)))
+        if "feather" in formats:
+            writers.append(("feather", pyarrow.RecordBatchFileWriter(
+                outdir + "/contig-purity.feather", schema)))
+
+    for s in range(0, nr_contigs, chunk_size):
+        e = min(s + chunk_size, nr_contigs)
+        for fmt, writer in writers:
+            if fmt == "tsv":
+                writer.write("".join("\t".join(row) + "\n" for row in zip(
+                    *[format_column(v[s:e], p[s:e]) for n, v, p in columns])))
+            else:
+                batch = pyarrow.RecordBatch.from_arrays(
+                    [pyarrow.array(v[s:e], type=schema.field_by_name(n).type,
+                                   mask=~p[s:e]) for n, v, p in columns],
+                    names)
+                if fmt == "parquet":
+                    writer.write_table(pyarrow.Table.from_batches([batch]))
+                else:
+                    writer.write_batch(batch)
+    for fmt, writer in writers:
+        writer.close()
 
 
 def main(coordsfile, refstatsfile, refphylfile, contigs, bamref, bamasm,
          outdir, name="-", asm_type="-", kmer_type="-", kmer_size="-",
-         kmin="-", kmax="-", cut_off=100):
-    # Create db
-    #dbc = sqlite3.connect(':memory:')
-    dbc = sqlite3.connect(coordsfile + ".sqlite")
-    try:
-        dbc.execute("""Create table Coords (ID INTEGER PRIMARY KEY, S1 INTEGER, E1
-                    INTEGER, S2 INTEGER, E2 INTEGER, LEN1 INTEGER, LEN2 INTEGER,
-                    IDY REAL, LENR INTEGER, LENQ INTEGER, COVR REAL, COVQ REAL,
-                    REFID TEXT, QRYID TEXT)""")
-        dbc.row_factory = sqlite3.Row
-
-        # Parse file and add to db
-        columns = ('S1', 'E1', 'S2', 'E2', 'LEN1', 'LEN2', 'IDY', 'LENR',
-                   'LENQ', 'COVR', 'COVQ', 'REFID', 'QRYID')
-        cfh = open(coordsfile, "r")
-        for line in cfh:
-            parsed_line = dict(zip(columns, line.split()))
-            dbc.execute("""Insert into Coords values(NULL, :S1, :E1, :S2, :E2,
-                        :LEN1, :LEN2, :IDY, :LENR, :LENQ, :COVR, :COVQ, :REFID,
-                        :QRYID)""", parsed_line)
-    except:
-        dbc.row_factory = sqlite3.Row
-        pass
-
-    dbc.commit()
-    cur = dbc.cursor()
-    gconcov = calc_genome_contig_cov_in_bases(cur)
-    q_aln_bases = calc_alignedbases_per_contig(cur)
-    contig_max_purity = calc_max_purity_per_contig(cur)
+         kmin="-", kmax="-", cut_off=100, processes=1, spill_dir=None,
+         name_sorted=False, purity_formats=(), plot_formats=("png",)):
+    reference = load_reference(refstatsfile, refphylfile, bamref)
+    contig_ref_map = calc_contig_ref_map(bamref, bamasm, cut_off, processes,
+                                         spill_dir, name_sorted)
+    validate_assembly(coordsfile, contigs, bamasm, outdir, reference,
+                      contig_ref_map, name, asm_type, kmer_type, kmer_size,
+                      kmin, kmax, cut_off, purity_formats, plot_formats)
+
+
+def validate_assembly(coordsfile, contigs, bamasm, outdir, reference,
+                      contig_ref_map, name="-", asm_type="-", kmer_type="-",
+                      kmer_size="-", kmin="-", kmax="-", cut_off=100,
+                      purity_formats=(), plot_formats=("png",)):
+    """Validates one assembly and writes the results to outdir. reference is
+    the reference side data from load_reference and contig_ref_map the reads
+    per reference of every contig in bamasm."""
+    # Create db, or reuse the one of a previous run on the same coords
+    dbc = open_coords_db(coordsfile)
+
+    coords = read_coords(dbc)
+    purest, max_purity = calc_purest_alignments(coords, cut_off)
+    gconcov = calc_genome_contig_cov_in_bases(coords, purest)
+    q_aln_bases = calc_alignedbases_per_contig(coords, cut_off)
+    contig_max_purity = calc_max_purity_per_contig(coords, purest, max_purity)
     sum_purest_bases = sum(
         c["max_purity"] * c["length"] for c in contig_max_purity.itervalues())
     sum_aln_bases = sum(q_aln_bases.itervalues())
@@ -334,7 +1052,7 @@ def main(coordsfile, refstatsfile, refphylfile, contigs, bamref, bamasm,
     aln_ratio = float(sum_aln_bases) / q_sum_bases
 
     # Get all reference lengths
-    reflens = readtable(refstatsfile, sep="\t")
+    reflens = reference["reflens"]
     # Add 0 covered bases for genomes with no max purity aligned contigs
     for genome in reflens.keys():
         if genome not in gconcov.keys():
@@ -366,179 +1084,156 @@ def main(coordsfile, refstatsfile, refphylfile, contigs, bamref, bamasm,
                      float(reflens[genome]["ratio_covered"])))
 
     # Print contig purity
-    contig_read_level_purity = calc_read_level_purity(bamref, bamasm,
-                                                      refphylfile, cut_off)
-    with open(outdir + "/contig-purity.tsv", "w") as fh:
-        fh.write("contig\tunamb_read_level_purity\tunamb_tot_nr_reads\t"
-                 "unamb_dom_nr_reads\t"
-                 "unamb_dominant_strain\tamb_read_level_purity\t"
-                 "amb_tot_nr_reads\tamb_dom_nr_reads\t"
-                 "amb_dominant_strain\tmax_aln_purity\t"
-                 "contig_length\t"
-                 "unamb_nr_reads_life\tamb_nr_reads_superkingdom\t"
-                 "unamb_nr_reads_superphylum\tamb_nr_reads_phylum\t"
-                 "unamb_nr_reads_class\tamb_nr_reads_order\t"
-                 "unamb_nr_reads_family\tamb_nr_reads_genus\t"
-                 "unamb_nr_reads_species\tunamb_nr_reads_strain\t"
-                 "unamb_lca\t"
-                 "amb_nr_reads_life\tamb_nr_reads_superkingdom\t"
-                 "amb_nr_reads_superphylum\tamb_nr_reads_phylum\t"
-                 "amb_nr_reads_class\tamb_nr_reads_order\t"
-                 "amb_nr_reads_family\tamb_nr_reads_genus\t"
-                 "amb_nr_reads_species\tamb_nr_reads_strain\t"
-                 "amb_lca"
-                 "\n")
-        for c in dict((k, v) for k, v in all_contig_lengths.iteritems() if v >= cut_off):
-            fh.write(
-                "\t".join(str(x) for x in
-                [c,
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                    "read_level_purity"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                    "tot_nr_reads"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                    "dom_nr_reads"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                    "dominant_strain"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                    "read_level_purity"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                    "tot_nr_reads"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                    "dom_nr_reads"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                    "dominant_strain"]),
-                 get_default_nested_dict(contig_max_purity, [c, "max_purity"]),
-                 all_contig_lengths[c],
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "no_rank"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "superkingdom"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "superphylum"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "phylum"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "class"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "order"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "family"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "genus"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "species"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                     "topname"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "unamb",
-                                                                    "lca"],
-                                         map_values=dict(topname="strain",
-                                                         no_rank="life")),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "no_rank"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "superkingdom"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "superphylum"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "phylum"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "class"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "order"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "family"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "genus"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "species"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                     "topname"]),
-                 get_default_nested_dict(contig_read_level_purity, [c, "amb",
-                                                                    "lca"],
-                                         map_values=dict(topname="strain",
-                                                         no_rank="life"))
-                 ]) + "\n")
-
-    # Make plots genome contig coverage
-    a = numpy.genfromtxt(
-        outdir + '/genome-contig-coverage.tsv', names=True, dtype=None)
-    make_dir(outdir + '/plots')
-    plt.plot(a['GC_content'], a['read_cov_ratio'], '.')
-    plt.xlabel('GC content of genome')
-    plt.ylabel('Read coverage ratio of genome')
-    plt.savefig(outdir + '/plots/GC_content_vs_read_cov_ratio.pdf')
-    plt.savefig(outdir + '/plots/GC_content_vs_read_cov_ratio.svg')
-    plt.savefig(outdir + '/plots/GC_content_vs_read_cov_ratio.png')
-    plt.clf()
-    plt.plot(a['GC_content'], a['genome_contig_cov_ratio'], '.')
-    plt.xlabel('GC content of genome')
-    plt.ylabel('Contig coverage ratio of genome')
-    plt.savefig(outdir + '/plots/GC_content_vs_genome_contig_cov_ratio.pdf')
-    plt.savefig(outdir + '/plots/GC_content_vs_genome_contig_cov_ratio.svg')
-    plt.savefig(outdir + '/plots/GC_content_vs_genome_contig_cov_ratio.png')
-    plt.clf()
-    plt.plot(a['read_cov_ratio'], a['genome_contig_cov_ratio'], '.')
-    plt.xlabel('Read coverage ratio of genome')
-    plt.ylabel('Genome contig coverage ratio of genome')
-    plt.savefig(
-        outdir + '/plots/read_cov_ratio_vs_genome_contig_cov_ratio.pdf')
-    plt.savefig(
-        outdir + '/plots/read_cov_ratio_vs_genome_contig_cov_ratio.svg')
-    plt.savefig(
-        outdir + '/plots/read_cov_ratio_vs_genome_contig_cov_ratio.png')
+    contig_read_level_purity = calc_read_level_purity(
+        contig_ref_map, pysam.Samfile(bamasm, "rb").references, reference)
+    purity_columns = contig_purity_columns(contig_read_level_purity,
+                                           contig_max_purity,
+                                           all_contig_lengths, cut_off)
+    write_contig_purity(purity_columns, outdir,
+                        ("tsv",) + tuple(purity_formats))
+
+    # Make plots from the tables in memory and the HTML report, which shows
+    # the png plots
+    if plot_formats:
+        genome_cov = dict(
+            GC_content=[float(reflens[g]["GC_content"]) for g in reflens],
+            read_cov_ratio=[float(reflens[g]["ratio_covered"]) for g in
+                            reflens],
+            genome_contig_cov_ratio=[gconcov[g] / float(reflens[g]["length"])
+                                     for g in reflens])
+        make_plots(outdir, genome_cov, purity_columns, plot_formats)
+        if "png" in plot_formats:
+            write_html_report(outdir)
+
+
+def pyplot():
+    """Returns matplotlib.pyplot with the non-interactive Agg backend.
+    matplotlib is only imported once plots are made."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return(plt)
+
+
+def scatter_plot(x, y, xlabel, ylabel, filename, formats=("png",)):
+    plt = pyplot()
+    plt.plot(x, y, '.')
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    for fmt in formats:
+        plt.savefig("%s.%s" % (filename, fmt))
     plt.clf()
 
-    # Make plots contig purity
-    a = numpy.genfromtxt(outdir + '/contig-purity.tsv', names=True,
-                         dtype=None, missing_values="-")
-    plt.plot(a['contig_length'], a['unamb_read_level_purity'], '.')
-    plt.xlabel('Contig length')
-    plt.ylabel('Unambiguous read level purity of contig')
-    plt.savefig(outdir + '/plots/contig_length_vs_unamb_read_level_purity.pdf')
-    plt.savefig(outdir + '/plots/contig_length_vs_unamb_read_level_purity.svg')
-    plt.savefig(outdir + '/plots/contig_length_vs_unamb_read_level_purity.png')
-    plt.clf()
-    plt.plot(a['contig_length'], a['amb_read_level_purity'], '.')
-    plt.xlabel('Contig length')
-    plt.ylabel('Ambiguous read level purity of contig')
-    plt.savefig(outdir + '/plots/contig_length_vs_amb_read_level_purity.pdf')
-    plt.savefig(outdir + '/plots/contig_length_vs_amb_read_level_purity.svg')
-    plt.savefig(outdir + '/plots/contig_length_vs_amb_read_level_purity.png')
-    plt.clf()
-    plt.plot(a['contig_length'], a['max_aln_purity'], '.')
-    plt.xlabel('Contig length')
-    plt.ylabel('Alignment purity of contig')
-    plt.savefig(outdir + '/plots/contig_length_vs_max_aln_purity.pdf')
-    plt.savefig(outdir + '/plots/contig_length_vs_max_aln_purity.svg')
-    plt.savefig(outdir + '/plots/contig_length_vs_max_aln_purity.png')
-    plt.clf()
-    plt.plot(a['unamb_read_level_purity'], a['max_aln_purity'], '.')
-    plt.xlabel('Unambiguous read level purity of contig')
-    plt.ylabel('Alignment purity of contig')
-    plt.savefig(outdir + '/plots/unamb_read_level_purity_vs_max_aln_purity.pdf')
-    plt.savefig(outdir + '/plots/unamb_read_level_purity_vs_max_aln_purity.svg')
-    plt.savefig(outdir + '/plots/unamb_read_level_purity_vs_max_aln_purity.png')
-    plt.clf()
-    plt.plot(a['amb_read_level_purity'], a['max_aln_purity'], '.')
-    plt.xlabel('Ambiguous read level purity of contig')
-    plt.ylabel('Alignment purity of contig')
-    plt.savefig(outdir + '/plots/amb_read_level_purity_vs_max_aln_purity.pdf')
-    plt.savefig(outdir + '/plots/amb_read_level_purity_vs_max_aln_purity.svg')
-    plt.savefig(outdir + '/plots/amb_read_level_purity_vs_max_aln_purity.png')
-    plt.clf()
 
-    chimer = a['max_aln_purity'] < 0.95
+def make_plots(outdir, genome_cov, purity_columns, formats=("png",)):
+    """Plots genome contig coverage and contig purity in outdir/plots in the
+    given formats. genome_cov is a dictionary of lists per genome,
+    purity_columns the columns of contig_purity_columns."""
+    make_dir(outdir + '/plots')
+    plots = outdir + '/plots/'
+
+    # Make plots genome contig coverage
+    a = genome_cov
+    scatter_plot(a['GC_content'], a['read_cov_ratio'],
+                 'GC content of genome', 'Read coverage ratio of genome',
+                 plots + 'GC_content_vs_read_cov_ratio', formats)
+    scatter_plot(a['GC_content'], a['genome_contig_cov_ratio'],
+                 'GC content of genome', 'Contig coverage ratio of genome',
+                 plots + 'GC_content_vs_genome_contig_cov_ratio', formats)
+    scatter_plot(a['read_cov_ratio'], a['genome_contig_cov_ratio'],
+                 'Read coverage ratio of genome',
+                 'Genome contig coverage ratio of genome',
+                 plots + 'read_cov_ratio_vs_genome_contig_cov_ratio', formats)
+
+    # Make plots contig purity, missing values are not plotted
+    a = dict((n, numpy.where(p, v, numpy.nan)) for n, v, p in purity_columns
+             if n in ('contig_length', 'unamb_read_level_purity',
+                      'amb_read_level_purity', 'max_aln_purity'))
+    scatter_plot(a['contig_length'], a['unamb_read_level_purity'],
+                 'Contig length', 'Unambiguous read level purity of contig',
+                 plots + 'contig_length_vs_unamb_read_level_purity', formats)
+    scatter_plot(a['contig_length'], a['amb_read_level_purity'],
+                 'Contig length', 'Ambiguous read level purity of contig',
+                 plots + 'contig_length_vs_amb_read_level_purity', formats)
+    scatter_plot(a['contig_length'], a['max_aln_purity'],
+                 'Contig length', 'Alignment purity of contig',
+                 plots + 'contig_length_vs_max_aln_purity', formats)
+    scatter_plot(a['unamb_read_level_purity'], a['max_aln_purity'],
+                 'Unambiguous read level purity of contig',
+                 'Alignment purity of contig',
+                 plots + 'unamb_read_level_purity_vs_max_aln_purity', formats)
+    scatter_plot(a['amb_read_level_purity'], a['max_aln_purity'],
+                 'Ambiguous read level purity of contig',
+                 'Alignment purity of contig',
+                 plots + 'amb_read_level_purity_vs_max_aln_purity', formats)
+
+    with numpy.errstate(invalid='ignore'):
+        chimer = a['max_aln_purity'] < 0.95
+    amb_lca = dict((n, (v, p)) for n, v, p in purity_columns)['amb_lca']
     d = defaultdict(int)
-    for lca in a[chimer]['amb_lca']:
-        if lca != "-":
-            d[lca] += 1
+    for lca in amb_lca[0][chimer & amb_lca[1]].tolist():
+        d[lca] += 1
     TAX_ORDER = ["strain", "species", "genus", "family", "order", "class",
                  "phylum", "superphylum", "superkingdom", "life"]
-    bar_plot(d, TAX_ORDER, outdir=outdir)
+    bar_plot(d, TAX_ORDER, outdir=outdir, formats=formats)
+
+
+def read_report_tables(outdir):
+    """Reads the genome_cov and the purity_columns of make_plots back from
+    genome-contig-coverage.tsv and contig-purity.tsv in outdir, for plots
+    made after the validation."""
+    genome_cov = dict(GC_content=[], read_cov_ratio=[],
+                      genome_contig_cov_ratio=[])
+    with open(outdir + "/genome-contig-coverage.tsv") as fh:
+        header = fh.readline().rstrip("\n").split("\t")
+        for line in fh:
+            row = dict(zip(header, line.rstrip("\n").split("\t")))
+            for k in genome_cov:
+                genome_cov[k].append(float(row[k]))
+
+    # The tsv header has some duplicate names, the columns are taken by
+    # position
+    names = ("contig_length", "unamb_read_level_purity",
+             "amb_read_level_purity", "max_aln_purity", "amb_lca")
+    pos = [CONTIG_PURITY_COLUMNS.index(n) for n in names]
+    cells = dict((n, []) for n in names)
+    with open(outdir + "/contig-purity.tsv") as fh:
+        fh.readline()
+        for line in fh:
+            cols = line.rstrip("\n").split("\t")
+            for n, i in zip(names, pos):
+                cells[n].append(cols[i])
+
+    purity_columns = []
+    for n in names:
+        present = numpy.array([c != "-" for c in cells[n]], dtype=bool)
+        if n == "amb_lca":
+            values = numpy.array(cells[n], dtype=object)
+        else:
+            values = numpy.array([float(c) if c != "-" else numpy.nan for c
+                                  in cells[n]], dtype=numpy.float64)
+        purity_columns.append((n, values, present))
 
-    # Output plots in HTML
+    return(genome_cov, purity_columns)
+
+
+def make_report(outdir, formats=("png",)):
+    """Makes the plots and, with png plots, the HTML report of an assembly
+    that was validated into outdir without plots."""
+    genome_cov, purity_columns = read_report_tables(outdir)
+    make_plots(outdir, genome_cov, purity_columns, formats)
+    if "png" in formats:
+        write_html_report(outdir)
+
+
+def write_html_report(outdir):
+    """Writes outdir/index.html with the tables and the PNG plots."""
     sdir = os.path.dirname(os.path.realpath(__file__))
+    if not os.path.exists(sdir + '/validate-template.html'):
+        sys.stderr.write("No HTML report, %s not found\n" %
+                         (sdir + '/validate-template.html'))
+        return
     template = open(sdir + '/validate-template.html').read()
     with open(outdir + '/index.html', 'w') as fh:
         fh.write(template.format(asmtsv='asm-stats.tsv',
@@ -555,14 +1250,16 @@ def main(coordsfile, refstatsfile, refphylfile, contigs, bamref, bamasm,
                                  ))
 
 
-def bar_plot(d, bars, outdir='.'):
+def bar_plot(d, bars, outdir='.', formats=("png",)):
+    plt = pyplot()
     N = len(bars)
     ind = numpy.arange(N)
     width = 0.35
     plt.title("LCA of reads for contigs with alignment purity < 0.95", size='x-small')
 
     # add bars
-    sum_values = sum(d.values())
+    # All bars are 0 if no contig has an alignment purity < 0.95
+    sum_values = max(sum(d.values()), 1)
     plt.bar(ind, [d[k] * 100 / sum_values for k in bars], width, color='red')
     # Final bar is not really visible, increase xlim
     xmin, xmax = plt.xlim()
@@ -580,7 +1277,8 @@ def bar_plot(d, bars, outdir='.'):
     plt.gca().yaxis.set_major_formatter(formatter)
     plt.gca().yaxis.grid(which='major')
 
-    plt.savefig(outdir + "/plots/barplot.png")
+    for fmt in formats:
+        plt.savefig(outdir + "/plots/barplot." + fmt)
     plt.close()
 
 
@@ -596,11 +1294,45 @@ if __name__ == "__main__":
     parser.add_argument(
         "bamasm", help="BAM file of the reads mapped against the contigs\n")
     parser.add_argument("outdir", help="Output directory\n")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of processes to read the BAM files with. "
+                        "Requires indexed BAM files (default 1)\n")
+    parser.add_argument("--spill-dir", default=None,
+                        help="Keep the map of reads to references on disk in a "
+                        "temporary directory in this directory instead of in "
+                        "memory, for very large read sets\n")
+    parser.add_argument("--name-sorted", action="store_true",
+                        help="Merge-join the BAM files on read name in "
+                        "constant memory. BAM files that are not sorted by "
+                        "read name are sorted with samtools sort -n first, in "
+                        "--spill-dir if given\n")
+    parser.add_argument("--purity-formats", nargs="+", default=[],
+                        choices=["parquet", "feather"],
+                        help="Also write contig purity in these columnar "
+                        "formats next to contig-purity.tsv. Requires "
+                        "pyarrow\n")
+    parser.add_argument("--plot-formats", nargs="+", default=["png"],
+                        choices=["png", "pdf", "svg"],
+                        help="Formats to save the plots in. The HTML report "
+                        "is only made with png (default png)\n")
+    parser.add_argument("--no-plots", action="store_true",
+                        help="Don't make plots or the HTML report\n")
     args = parser.parse_args()
+    if len(args.purity_formats) > 0:
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("--purity-formats parquet and feather require "
+                         "pyarrow")
     main(args.coords,
          args.refstats,
          args.refphyl,
          args.contigs,
          args.bamref,
          args.bamasm,
-         args.outdir)
+         args.outdir,
+         processes=args.processes,
+         spill_dir=args.spill_dir,
+         name_sorted=args.name_sorted,
+         purity_formats=args.purity_formats,
+         plot_formats=[] if args.no_plots else args.plot_formats)
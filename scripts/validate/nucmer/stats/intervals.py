@@ -0,0 +1,180 @@
+"""
+Vectorized interval union on NumPy arrays. Used by coords-stats.py to count
+the bases covered by alignments per genome (REFID) or per contig (QRYID)
+without looping over the alignments in Python.
+
+Intervals are given as parallel arrays of integer group codes (e.g. from
+numpy.unique(names, return_inverse=True)), 1-based inclusive starts and
+inclusive ends. Within each group the intervals are swept in order of their
+start, like the SQL ORDER BY GROUP, START sweeps they replace. Every interval
+is assigned the number of bases it adds to the union of the intervals before
+it in the same group.
+"""
+import numpy
+
+
+def _sort_order(groups, starts):
+    """Returns the stable permutation that sorts by group and start. Sorting a
+    single combined int64 key is a lot faster than numpy.lexsort, so that is
+    used whenever the key can't overflow."""
+    if len(groups) == 0:
+        return(numpy.zeros(0, dtype=numpy.intp))
+
+    g_min, g_max = int(groups.min()), int(groups.max())
+    s_min, s_max = int(starts.min()), int(starts.max())
+    span = s_max - s_min + 1
+    if (g_max - g_min + 1) * span < 2 ** 62:
+        key = (groups.astype(numpy.int64) - g_min) * span + (starts - s_min)
+        return(numpy.argsort(key, kind="mergesort"))
+    else:
+        return(numpy.lexsort((starts, groups)))
+
+
+def sweep(groups, starts, ends):
+    """Sweeps the intervals of every group in order of start position.
+
+    Returns a tuple (order, first, new_len) of arrays in sorted order:
+    order   -- permutation that sorts the input by group and start. The sort is
+               stable, so intervals with equal start keep their input order.
+    first   -- boolean mask of the first interval of each group
+    new_len -- number of bases the interval adds to the union of the previous
+               intervals in its group, 0 if it is contained in them
+    """
+    groups = numpy.asarray(groups)
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+
+    order = _sort_order(groups, starts)
+    g = groups[order]
+    s = starts[order]
+    e = ends[order]
+    n = len(g)
+
+    first = numpy.ones(n, dtype=bool)
+    first[1:] = g[1:] != g[:-1]
+    if n == 0:
+        return(order, first, numpy.zeros(0, dtype=numpy.int64))
+
+    # Running maximum of the ends within a group. Offsetting the ends by the
+    # rank of the group makes every group start above the maximum of the
+    # previous one, so one cumulative maximum doesn't cross group boundaries.
+    e_min = e.min()
+    span = e.max() - e_min + 1
+    rank = numpy.cumsum(first) - 1
+    offset = rank * span - e_min
+    cummax = numpy.maximum.accumulate(e + offset) - offset
+
+    # End of the union of the preceding intervals in the same group
+    prev_end = numpy.empty(n, dtype=numpy.int64)
+    prev_end[0] = 0
+    prev_end[1:] = cummax[:-1]
+
+    new_start = numpy.where(first, s, numpy.maximum(s, prev_end + 1))
+    new_len = numpy.maximum(e - new_start + 1, 0)
+    new_len[first] = e[first] - s[first] + 1
+
+    return(order, first, new_len)
+
+
+def segment_sum(values, first):
+    """Sums values over the segments that start at every True in first.
+    Values should be in the order returned by sweep."""
+    if len(values) == 0:
+        return(numpy.zeros(0, dtype=values.dtype))
+
+    return(numpy.add.reduceat(values, numpy.flatnonzero(first)))
+
+
+def union_lengths(groups, starts, ends, weights=None):
+    """Returns a tuple (group codes, covered bases) with the number of bases in
+    the union of the intervals of every group that has intervals. If weights
+    are given, each interval's new bases are multiplied by its weight and
+    truncated to an integer before summing."""
+    order, first, new_len = sweep(groups, starts, ends)
+    if weights is not None:
+        weights = numpy.asarray(weights, dtype=numpy.float64)[order]
+        new_len = (new_len * weights).astype(numpy.int64)
+
+    return(numpy.asarray(groups)[order][first], segment_sum(new_len, first))
+
+
+def python_union_lengths(groups, starts, ends):
+    """Reference implementation of union_lengths without weights, sweeping the
+    intervals one by one in Python like coords-stats.py used to."""
+    order = sorted(range(len(groups)), key=lambda i: (groups[i], starts[i]))
+    covered = {}
+    prev_end = 0
+    for i in order:
+        g, s, e = groups[i], starts[i], ends[i]
+        if g in covered:
+            if prev_end >= e:
+                continue
+            elif prev_end >= s:
+                covered[g] += e - prev_end
+            else:
+                covered[g] += e - s + 1
+        else:
+            covered[g] = e - s + 1
+        prev_end = e
+
+    return(covered)
+
+
+def benchmark(n, ngroups=1000, max_start=10 ** 6, max_len=10 ** 4,
+              python=True, python_chunk=5 * 10 ** 6):
+    """Times union_lengths against python_union_lengths on n random intervals
+    and checks that both give the same result. Writes the timings to
+    stdout. The Python sweep is run on the groups in chunks of about
+    python_chunk intervals, so the Python lists of large n fit in memory."""
+    import time
+    import sys
+
+    rs = numpy.random.RandomState(42)
+    groups = rs.randint(0, ngroups, n)
+    starts = rs.randint(1, max_start, n).astype(numpy.int64)
+    ends = starts + rs.randint(0, max_len, n)
+
+    start_time = time.time()
+    codes, covered = union_lengths(groups, starts, ends)
+    numpy_time = time.time() - start_time
+    sys.stdout.write("%i intervals\tnumpy\t%.2fs" % (n, numpy_time))
+
+    if python:
+        expected = {}
+        python_time = 0.0
+        step = max(1, ngroups * python_chunk // n)
+        for lo in range(0, ngroups, step):
+            chunk = (groups >= lo) & (groups < lo + step)
+            glist = groups[chunk].tolist()
+            slist = starts[chunk].tolist()
+            elist = ends[chunk].tolist()
+            del chunk
+            start_time = time.time()
+            expected.update(python_union_lengths(glist, slist, elist))
+            python_time += time.time() - start_time
+            del glist, slist, elist
+        assert expected == dict(zip(codes.tolist(), covered.tolist()))
+        sys.stdout.write("\tpython\t%.2fs\tspeedup\t%.1fx" %
+                         (python_time, python_time / numpy_time))
+    else:
+        sys.stdout.write("\tpython\tskipped, numpy only")
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized "
+                                     "interval union against the Python sweep")
+    parser.add_argument("n", nargs="*", type=int,
+                        default=[10 ** 6, 10 ** 7, 5 * 10 ** 7],
+                        help="Number of random intervals to benchmark")
+    parser.add_argument("--no-python", action="store_true",
+                        help="Only time the vectorized union, no speedup is "
+                        "reported")
+    parser.add_argument("--python-chunk", type=int, default=5 * 10 ** 6,
+                        help="Intervals per chunk of groups of the Python "
+                        "sweep (default: 5000000)")
+    args = parser.parse_args()
+    for n in args.n:
+        benchmark(n, python=not args.no_python,
+                  python_chunk=args.python_chunk)
@@ -0,0 +1,195 @@
+"""
+Compact map of read names to the references they map to, used by
+coords-stats.py to determine read level purity of contigs.
+
+Read names are hashed to 64-bit integers. The map is a tuple (keys, offsets,
+tids) of NumPy arrays in CSR layout: keys holds the sorted unique read name
+hashes and the references of read keys[i] are tids[offsets[i]:offsets[i + 1]].
+That takes 12 bytes per read plus 4 per mapping instead of a Python string
+and list per read. With 10^8 reads the chance of a hash collision is about
+3 * 10^-4, a collision merges the references of the two reads.
+
+The map is built from chunks of (hash, tid) pairs. If a spill directory is
+given, the pairs are partitioned on disk by the high bits of the hash, each
+partition is sorted in memory and the resulting arrays are memory-mapped, so
+only one partition has to fit in memory.
+"""
+import os
+import struct
+import hashlib
+
+import numpy
+
+# Number of on disk partitions when spilling, must be a power of two
+SPILL_PARTITIONS = 256
+
+
+def hash_read_name(qname):
+    """Returns a signed 64-bit hash of read name qname."""
+    return struct.unpack("<q", hashlib.md5(qname).digest()[:8])[0]
+
+
+def _sort_unique_pairs(hashes, tids):
+    """Returns the (hash, tid) pairs sorted by hash and tid without
+    duplicates."""
+    order = numpy.lexsort((tids, hashes))
+    hashes = hashes[order]
+    tids = tids[order]
+    keep = numpy.ones(len(hashes), dtype=bool)
+    keep[1:] = (hashes[1:] != hashes[:-1]) | (tids[1:] != tids[:-1])
+
+    return(hashes[keep], tids[keep])
+
+
+def _csr(hashes, tids):
+    """Converts sorted unique (hash, tid) pairs to keys and the number of
+    references per key."""
+    first = numpy.ones(len(hashes), dtype=bool)
+    first[1:] = hashes[1:] != hashes[:-1]
+    starts = numpy.flatnonzero(first)
+    counts = numpy.diff(numpy.append(starts, len(hashes)))
+
+    return(hashes[starts], counts)
+
+
+def build(chunks, spill_dir=None):
+    """Builds the map from an iterable of (hashes, tids) array pairs. Pairs may
+    be repeated. If spill_dir is given, the pairs are partitioned and sorted
+    on disk in spill_dir and the returned arrays are memory-mapped files in
+    spill_dir, which should stay until the map is no longer used.
+
+    Returns the tuple (keys, offsets, tids)."""
+    if spill_dir is None:
+        chunks = list(chunks)
+        hashes = numpy.concatenate([numpy.asarray(h, dtype=numpy.int64) for
+                                    h, t in chunks] +
+                                   [numpy.zeros(0, dtype=numpy.int64)])
+        tids = numpy.concatenate([numpy.asarray(t, dtype=numpy.int32) for
+                                  h, t in chunks] +
+                                 [numpy.zeros(0, dtype=numpy.int32)])
+        del chunks
+        hashes, tids = _sort_unique_pairs(hashes, tids)
+        keys, counts = _csr(hashes, tids)
+        offsets = numpy.zeros(len(keys) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+
+        return(keys, offsets, tids)
+
+    return(_build_spilled(chunks, spill_dir))
+
+
+def _partition(hashes):
+    """Returns the partition of each hash. Partitions are ordered like the
+    signed hashes, so concatenating sorted partitions gives a sorted array."""
+    shift = 64 - (SPILL_PARTITIONS.bit_length() - 1)
+    return((hashes >> shift) + SPILL_PARTITIONS // 2)
+
+
+def _build_spilled(chunks, spill_dir):
+    part_path = os.path.join(spill_dir, "part%i.%s")
+    for p in range(SPILL_PARTITIONS):
+        for ext in ("hashes", "tids"):
+            open(part_path % (p, ext), "wb").close()
+
+    # Partition the pairs on disk
+    for hashes, tids in chunks:
+        hashes = numpy.asarray(hashes, dtype=numpy.int64)
+        tids = numpy.asarray(tids, dtype=numpy.int32)
+        parts = _partition(hashes)
+        order = numpy.argsort(parts, kind="mergesort")
+        parts, hashes, tids = parts[order], hashes[order], tids[order]
+        bounds = numpy.searchsorted(parts, numpy.arange(SPILL_PARTITIONS + 1))
+        for p in numpy.flatnonzero(numpy.diff(bounds)):
+            s, e = bounds[p], bounds[p + 1]
+            with open(part_path % (p, "hashes"), "ab") as fh:
+                hashes[s:e].tofile(fh)
+            with open(part_path % (p, "tids"), "ab") as fh:
+                tids[s:e].tofile(fh)
+
+    # Sort and deduplicate each partition in memory and append it to the
+    # final arrays
+    files = dict((ext, open(os.path.join(spill_dir, ext), "wb")) for ext in
+                 ("keys", "counts", "tids"))
+    nr_keys = 0
+    nr_tids = 0
+    for p in range(SPILL_PARTITIONS):
+        hashes = numpy.fromfile(part_path % (p, "hashes"), dtype=numpy.int64)
+        tids = numpy.fromfile(part_path % (p, "tids"), dtype=numpy.int32)
+        os.remove(part_path % (p, "hashes"))
+        os.remove(part_path % (p, "tids"))
+        hashes, tids = _sort_unique_pairs(hashes, tids)
+        keys, counts = _csr(hashes, tids)
+        keys.tofile(files["keys"])
+        counts.astype(numpy.int64).tofile(files["counts"])
+        tids.tofile(files["tids"])
+        nr_keys += len(keys)
+        nr_tids += len(tids)
+    for fh in files.itervalues():
+        fh.close()
+
+    def memmap(name, dtype, shape, mode="r"):
+        if shape == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(os.path.join(spill_dir, name), dtype=dtype,
+                            mode=mode, shape=(shape,))
+
+    offsets = memmap("offsets", numpy.int64, nr_keys + 1, mode="w+")
+    offsets[0] = 0
+    if nr_keys > 0:
+        numpy.cumsum(memmap("counts", numpy.int64, nr_keys), out=offsets[1:])
+        offsets.flush()
+    os.remove(os.path.join(spill_dir, "counts"))
+
+    return(memmap("keys", numpy.int64, nr_keys), offsets,
+           memmap("tids", numpy.int32, nr_tids))
+
+
+def lookup(refmap, hashes):
+    """Looks up read name hashes in refmap by binary search. Returns a tuple
+    (found, idx) of a boolean array that is True for hashes in the map and
+    the index of those hashes in keys."""
+    keys = refmap[0]
+    idx = numpy.searchsorted(keys, hashes)
+    found = idx < len(keys)
+    found[found] = keys[idx[found]] == hashes[found]
+
+    return(found, idx[found])
+
+
+def count_contig_refs(refmap, contigs, hashes):
+    """Counts reads per contig and reference for reads with given contig tids
+    and name hashes. Reads mapping to one reference only are unambiguous, all
+    mapped reads are counted for all their references as ambiguous.
+
+    Returns a tuple (unamb, amb), both a tuple (contigs, refs, counts) of
+    arrays with one element per contig and reference pair."""
+    keys, offsets, tids = refmap
+    found, idx = lookup(refmap, hashes)
+    contigs = numpy.asarray(contigs, dtype=numpy.int64)[found]
+    starts = offsets[idx]
+    nr_refs = offsets[idx + 1] - starts
+
+    unamb = nr_refs == 1
+    unamb_pairs = _count_pairs(contigs[unamb], tids[starts[unamb]])
+
+    # Expand every read to all of its references
+    amb_contigs = numpy.repeat(contigs, nr_refs)
+    first = numpy.cumsum(nr_refs) - nr_refs
+    amb_idx = numpy.repeat(starts - first, nr_refs) + \
+        numpy.arange(len(amb_contigs))
+    amb_pairs = _count_pairs(amb_contigs, tids[amb_idx])
+
+    return(unamb_pairs, amb_pairs)
+
+
+def _count_pairs(contigs, refs):
+    """Returns (contigs, refs, counts) of the unique contig and reference
+    pairs."""
+    if len(contigs) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return(empty, empty, empty)
+    refs = numpy.asarray(refs, dtype=numpy.int64)
+    nr_refs = refs.max() + 1
+    codes, counts = numpy.unique(contigs * nr_refs + refs, return_counts=True)
+
+    return(codes // nr_refs, codes % nr_refs, counts)
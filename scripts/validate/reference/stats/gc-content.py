@@ -1,8 +1,23 @@
+import os
 import sys
+import argparse
 
-from Bio import SeqIO
-from Bio.SeqUtils import GC
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "..", ".."))
+from contigstats import gc_and_lengths, gc_percentages
 
-# Argument one is a fasta file
-for rec in SeqIO.parse(sys.argv[1], "fasta"):
-    print "%s\t%1.2f\t%d" % (rec.id, GC(rec.seq) / 100.0, len(rec.seq))
+parser = argparse.ArgumentParser(description="Prints the id, GC content and "
+                                 "length of every sequence in a fasta file")
+parser.add_argument("fastafile", help="Fasta file")
+parser.add_argument("--processes", type=int, default=1,
+                    help="Number of processes (default 1)")
+parser.add_argument("--no-cache", action="store_true",
+                    help="Don't read or write the GC and length cache file "
+                    "next to the fasta file")
+args = parser.parse_args()
+
+ids, lengths, gc_counts = gc_and_lengths(args.fastafile, args.processes,
+                                         not args.no_cache)
+for rec_id, gc, length in zip(ids, gc_percentages(lengths, gc_counts).tolist(),
+                              lengths.tolist()):
+    print "%s\t%1.2f\t%d" % (rec_id, gc / 100.0, length)
@@ -0,0 +1,65 @@
+"""
+The row by row SQL sweeps that coords-stats.py used before the interval
+sweeps were vectorized, copied unchanged, to check the NumPy statistics
+against. Both take a cursor on a Coords database from
+coords-stats.py's open_coords_db.
+
+The baseline selected the purest alignment of a contig with a bare column
+next to max(...) GROUP BY QRYID, which gives only the first alignment of
+maximum purity of every contig. first_purest reduces the selection of
+calc_purest_alignments, which keeps all of them, to the same alignments.
+"""
+import numpy
+
+
+def calc_genome_contig_cov_in_bases(cursor, cut_off=100):
+    refcov = {}  # nr of bases covered by contigs aligned with max purity
+    prev_e1 = 0
+    for row in cursor.execute("""SELECT * FROM (SELECT *, max(COVQ * IDY /
+                              10000) AS purity FROM Coords GROUP BY QRYID)
+                              WHERE COVQ * IDY / 10000 == purity AND LENQ >= :cut_off ORDER BY
+                              REFID, S1 ASC""", dict(cut_off=cut_off)):
+        if row["REFID"] in refcov:
+            if prev_e1 >= row["E1"]:
+                continue
+            elif prev_e1 >= row["S1"]:
+                refcov[row["REFID"]] += int((row["E1"] -
+                                            prev_e1) * (row["IDY"] / 100.0))
+            else:
+                refcov[row["REFID"]] += int((row["E1"] - row["S1"] + 1) *
+                                            (row["IDY"] / 100.0))
+        else:
+            refcov[row["REFID"]] = int((row["E1"] - row["S1"])
+                                       * (row["IDY"] / 100.0)) + 1
+        prev_e1 = row["E1"]
+
+    return(refcov)
+
+
+def calc_alignedbases_per_contig(cursor, cut_off=100):
+    q_aln_bases = {}  # nr of bases aligned per contig
+    prev_end = 0
+    for row in cursor.execute("""SELECT *, min(S2, E2) AS start, max(S2, E2) as end FROM COORDS WHERE LENQ >= :cut_off ORDER BY
+                              QRYID, start ASC""", dict(cut_off=cut_off)):
+        if row["QRYID"] in q_aln_bases:
+            if prev_end >= row["end"]:
+                continue
+            elif prev_end >= row["start"]:
+                q_aln_bases[row["QRYID"]] += row["end"] - prev_end
+            else:
+                q_aln_bases[row["QRYID"]] += row["end"] - row["start"] + 1
+        else:
+            q_aln_bases[row["QRYID"]] = row["end"] - row["start"]
+        prev_end = row["end"]
+
+    return(q_aln_bases)
+
+
+def first_purest(coords, purest):
+    """Returns purest with only the first selected alignment of every
+    contig."""
+    idx = numpy.flatnonzero(purest)
+    qryid, first_idx = numpy.unique(coords["QRYID"][idx], return_index=True)
+    first = numpy.zeros(len(purest), dtype=bool)
+    first[idx[first_idx]] = True
+    return(first)
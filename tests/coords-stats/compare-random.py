@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Compares the genome contig coverage and the aligned bases per contig of
+coords-stats.py, computed with the interval sweeps of intervals.py, to the
+row by row SQL sweeps they replaced in baseline.py, on random synthetic
+show-coords files. The alignments are drawn from few start positions, so
+many have equal starts or are nested in others, and have different IDY, so
+the weighting of the covered bases, the counting of the first alignment of
+every genome or contig and the reset between them are all checked.
+
+Prints OK or FAIL for every check and exits with 1 if one failed.
+
+Usage:
+    python compare-random.py [-n NR_FILES] [-s SEED]
+"""
+import os
+import imp
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+
+SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
+STATSDIR = os.path.join(SCRIPTDIR, "..", "..", "scripts", "validate",
+                        "nucmer", "stats")
+sys.path.insert(0, STATSDIR)
+coords_stats = imp.load_source("coords_stats",
+                               os.path.join(STATSDIR, "coords-stats.py"))
+import baseline
+
+CUT_OFF = 100
+
+
+def write_random_coords(coordsfile, rand):
+    """Writes a random show-coords -rclTH file to coordsfile."""
+    refs = dict(("genome%i" % i, rand.randint(2000, 20000)) for i in
+                range(rand.randint(1, 5)))
+    # Few distinct starts give equal starts and nested alignments
+    ref_starts = dict((r, [rand.randint(1, l - 1000) for i in range(8)])
+                      for r, l in refs.iteritems())
+    with open(coordsfile, "w") as fh:
+        for c in range(rand.randint(1, 60)):
+            lenq = rand.choice([80, 99, 100, 150, 400, 1000])
+            qry_starts = [rand.randint(1, lenq) for i in range(3)]
+            for a in range(rand.randint(1, 6)):
+                ref = rand.choice(sorted(refs))
+                s1 = rand.choice(ref_starts[ref])
+                len1 = rand.choice([1, 2, 50, 200, 600, 1000])
+                s2 = rand.choice(qry_starts)
+                e2 = rand.randint(s2, lenq)
+                if rand.random() < 0.3:
+                    s2, e2 = e2, s2
+                len2 = abs(e2 - s2) + 1
+                idy = rand.choice([90.0, 95.5, 98.12, 99.9, 100.0])
+                fh.write("\t".join(str(x) for x in (
+                    s1, s1 + len1 - 1, s2, e2, len1, len2, idy, refs[ref],
+                    lenq, round(100.0 * len1 / refs[ref], 2),
+                    round(100.0 * len2 / lenq, 2), ref, "contig%i" % c)) +
+                    "\n")
+
+
+def compare(coordsfile, dbfile):
+    """Returns a list of the checks of coordsfile that failed."""
+    dbc = coords_stats.open_coords_db(coordsfile, dbfile)
+    try:
+        coords = coords_stats.read_coords(dbc)
+        purest, max_purity = coords_stats.calc_purest_alignments(coords,
+                                                                 CUT_OFF)
+        failed = []
+        if coords_stats.calc_genome_contig_cov_in_bases(
+                coords, baseline.first_purest(coords, purest)) != \
+                baseline.calc_genome_contig_cov_in_bases(dbc.cursor(),
+                                                         CUT_OFF):
+            failed.append("genome contig coverage")
+        if coords_stats.calc_alignedbases_per_contig(coords, CUT_OFF) != \
+                baseline.calc_alignedbases_per_contig(dbc.cursor(), CUT_OFF):
+            failed.append("aligned bases per contig")
+    finally:
+        dbc.close()
+
+    return(failed)
+
+
+def main(nr_files, seed):
+    rand = random.Random(seed)
+    tmp_dir = tempfile.mkdtemp()
+    nr_failed = 0
+    # The database messages of every file are not of interest
+    stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+    try:
+        for i in range(nr_files):
+            coordsfile = os.path.join(tmp_dir, "random%i.coords" % i)
+            write_random_coords(coordsfile, rand)
+            failed = compare(coordsfile, coordsfile + ".sqlite")
+            if len(failed) > 0:
+                nr_failed += 1
+                kept = os.path.join(os.getcwd(), "failed%i.coords" % i)
+                shutil.copy(coordsfile, kept)
+                print "FAIL: %s differ for %s" % (", ".join(failed), kept)
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+        shutil.rmtree(tmp_dir)
+
+    if nr_failed == 0:
+        print "OK: baseline statistics of %i random coords files" % nr_files
+    return(0 if nr_failed == 0 else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--nr-files", type=int, default=200,
+                        help="Number of random coords files (default: 200)")
+    parser.add_argument("-s", "--seed", type=int, default=3,
+                        help="Random seed (default: 3)")
+    args = parser.parse_args()
+    sys.exit(main(args.nr_files, args.seed))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Compares the statistics of coords-stats.py that are computed with NumPy from
+the Coords columns to the SQL queries and row by row sweeps they replaced, on
+the alignments of a show-coords -rclTH file (default: nucmer.coords next to
+this script). The fixture has contigs with several alignments of maximum
+purity, on the same and on other genomes.
+
+The old queries selected the purest alignment of a contig with a bare column
+next to max(...) GROUP BY QRYID, which gives a single alignment per contig,
+the first in scan order, even if others have the same purity. The NumPy
+selection keeps all of them. Checked are:
+
+    - the selection equals a join on the maximum purity, which keeps ties
+    - the maximum purity per contig equals the old query
+    - the genome contig coverage equals the old sweep in baseline.py when
+      the selection is reduced to the first alignment of each contig
+    - the aligned bases per contig equal the old sweep in baseline.py
+
+Prints OK or FAIL for every check and exits with 1 if one failed.
+
+Usage:
+    python compare-sql.py [coordsfile]
+"""
+import os
+import imp
+import sys
+import shutil
+import tempfile
+
+import numpy
+
+SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
+STATSDIR = os.path.join(SCRIPTDIR, "..", "..", "scripts", "validate",
+                        "nucmer", "stats")
+sys.path.insert(0, STATSDIR)
+coords_stats = imp.load_source("coords_stats",
+                               os.path.join(STATSDIR, "coords-stats.py"))
+import baseline
+
+CUT_OFF = 100
+
+# Subquery of the old statistics with the purest alignment of every contig
+OLD_PUREST = """SELECT * FROM (SELECT *, max(COVQ * IDY / 10000) AS purity
+                FROM Coords GROUP BY QRYID) WHERE COVQ * IDY / 10000 == purity
+                AND LENQ >= :cut_off"""
+
+
+def fetch_all(cursor, query):
+    """Returns the result of query as a dictionary of NumPy arrays by column
+    name, like the old fetch_columns."""
+    cursor.execute(query, dict(cut_off=CUT_OFF))
+    names = [d[0] for d in cursor.description]
+    rows = cursor.fetchall()
+    columns = zip(*rows) if len(rows) > 0 else [[] for n in names]
+    return(dict((n, numpy.array(c)) for n, c in zip(names, columns)))
+
+
+def old_max_purity_per_contig(cursor):
+    q_max_purity = {}
+    for row in cursor.execute(OLD_PUREST, dict(cut_off=CUT_OFF)):
+        q_max_purity[row["QRYID"]] = dict(max_purity=row["purity"],
+                                          length=row["LENQ"])
+    return(q_max_purity)
+
+
+def purest_with_ties(cursor):
+    """Returns the IDs of all alignments with the maximum purity of their
+    contig."""
+    cols = fetch_all(cursor, """SELECT C.ID FROM Coords C JOIN (SELECT QRYID,
+                     max(COVQ * IDY / 10000) AS purity FROM Coords GROUP BY
+                     QRYID) M ON C.QRYID = M.QRYID WHERE C.COVQ * C.IDY /
+                     10000 == M.purity AND C.LENQ >= :cut_off ORDER BY
+                     C.ID""")
+    return(cols["ID"])
+
+
+def check(result, expected, msg):
+    if result == expected:
+        print "OK: %s" % msg
+        return(True)
+    print "FAIL: %s, expected %s got %s" % (msg, expected, result)
+    return(False)
+
+
+def main(coordsfile):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dbc = coords_stats.open_coords_db(coordsfile,
+                                          os.path.join(tmp_dir, "coords.db"))
+        cur = dbc.cursor()
+        coords = coords_stats.read_coords(dbc)
+        # A chunk size smaller than the table reads it in several chunks
+        chunked, names = coords_stats.fetch_columns(
+            dbc.cursor(), "SELECT REFID, QRYID, S1 FROM Coords ORDER BY ID",
+            coords_stats.COORDS_DTYPES, codes=("REFID", "QRYID"),
+            chunk_size=7)
+        purest, max_purity = coords_stats.calc_purest_alignments(coords,
+                                                                 CUT_OFF)
+
+        # IDs are the line numbers of the alignments in the coords file
+        ids = numpy.flatnonzero(purest) + 1
+        nr_ties = len(ids) - len(numpy.unique(coords["QRYID"][purest]))
+        ok = [
+            check(nr_ties > 0, True, "fixture has tied purest alignments"),
+            check([chunked[c].tolist() for c in ("REFID", "QRYID", "S1")] +
+                  [names["REFID"].tolist(), names["QRYID"].tolist()],
+                  [coords[c].tolist() for c in ("REFID", "QRYID", "S1")] +
+                  [coords["refids"].tolist(), coords["qryids"].tolist()],
+                  "columns read in chunks"),
+            check(ids.tolist(), purest_with_ties(cur).tolist(),
+                  "purest alignments with ties"),
+            check(coords_stats.calc_max_purity_per_contig(coords, purest,
+                                                          max_purity),
+                  old_max_purity_per_contig(cur), "max purity per contig"),
+            check(coords_stats.calc_genome_contig_cov_in_bases(
+                coords, baseline.first_purest(coords, purest)),
+                baseline.calc_genome_contig_cov_in_bases(cur, CUT_OFF),
+                "genome contig coverage without ties"),
+            check(coords_stats.calc_alignedbases_per_contig(coords, CUT_OFF),
+                  baseline.calc_alignedbases_per_contig(cur, CUT_OFF),
+                  "aligned bases per contig")]
+        dbc.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return(0 if all(ok) else 1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 or "-h" in sys.argv or "--help" in sys.argv:
+        print __doc__
+        sys.exit(0 if len(sys.argv) == 2 else 1)
+    sys.exit(main(sys.argv[1] if len(sys.argv) == 2 else
+                  os.path.join(SCRIPTDIR, "nucmer.coords")))
@@ -0,0 +1,80 @@
+#!/bin/bash
+HELPDOC=$( cat <<EOF
+Tests packing of short jobs by lib/scheduler.mk with the local stand-in for
+sbatch in tests/bin. Runs the pipeline in Makefile with a job per target and
+with the validations packed in jobs of 20 minutes, checks the number of jobs
+and that both give the same summary.
+
+Usage:
+    bash `basename $0`
+EOF
+)
+# Parse options
+while getopts ":h" opt; do
+    case $opt in
+        h)
+            echo "$HELPDOC"
+            exit 0
+            ;;
+        \?)
+            echo "Invalid option: -$OPTARG" >&2
+            echo "$HELPDOC"
+            exit 1
+            ;;
+    esac
+done
+shift $(($OPTIND - 1))
+
+set -o errexit
+set -o nounset
+# From: http://tinyurl.com/85qrydz
+SCRIPTDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+export PATH=$SCRIPTDIR/../bin:$PATH
+
+TMPDIR=`mktemp -d`
+trap "rm -rf $TMPDIR" EXIT
+# The job script logs to $HOME/jobs.log
+export HOME=$TMPDIR
+
+# Runs the pipeline in directory $1 with make options $2.., waits for the jobs
+# and prints the number of jobs
+function run_pipeline() {
+    local dir=$1
+    shift
+    mkdir -p $dir
+    cp $SCRIPTDIR/Makefile $dir
+    printf "a\nb\nc\n" > $dir/input.txt
+    (cd $dir && make -s -f $SCRIPTDIR/Makefile-sbatch "$@" > /dev/null)
+    local nr_jobs=`cat $dir/sbatch-standin/jobs.tsv | wc -l`
+    while [ `ls $dir/sbatch-standin | grep -c '\.rc$'` -lt $nr_jobs ]; do
+        sleep 0.1
+    done
+    if [ `cat $dir/sbatch-standin/*.rc | grep -vc '^0$'` -ne 0 ]; then
+        echo "Failed jobs in $dir" >&2
+        exit 1
+    fi
+    echo $nr_jobs
+}
+
+function check_equal() {
+    if [ "$1" != "$2" ]; then
+        echo "FAIL: $3, expected $2 got $1" >&2
+        exit 1
+    fi
+    echo "OK: $3"
+}
+
+check_equal `run_pipeline $TMPDIR/jobs` 9 "a job per target"
+check_equal `run_pipeline $TMPDIR/packed SCHEDULER_PACK_RUNTIME=20` 7 \
+    "validations packed in jobs of 20 minutes"
+check_equal "`cat $TMPDIR/packed/summary.tsv`" "`cat $TMPDIR/jobs/summary.tsv`" \
+    "same summary"
+check_equal "`cut -f 2,4 $TMPDIR/packed/sbatch-standin/jobs.tsv | grep -c 'make -ke val_.*tsv val_.*tsv$'`" 2 \
+    "two validation jobs of two targets"
+
+# Dry run prints the packs with the assemblies they depend on
+mkdir $TMPDIR/dry
+cp $SCRIPTDIR/Makefile $TMPDIR/dry
+touch $TMPDIR/dry/input.txt
+check_equal "`cd $TMPDIR/dry && make -n -f $SCRIPTDIR/Makefile-sbatch SCHEDULER_PACK_RUNTIME=20 | grep -c '^sbatch -d afterok:asm_21.fa,afterok:asm_25.fa .* -t 40 .* make -ke val_21.tsv val_25.tsv$'`" 1 \
+    "dry run of a pack"